@@ -0,0 +1,221 @@
+"""
+Download throughput benchmarks against local stand-in servers.
+
+Run with airspeed velocity (results are stored in .asv/results and can be
+compared between commits with `asv compare` or `asv continuous`):
+
+    asv run --bench download
+
+or without asv for a quick check (results are appended to a JSON-lines
+file that can be compared with an earlier run):
+
+    python -m benchmarks.download --out download_results.jsonl
+"""
+import os
+import shutil
+import tempfile
+import time
+
+import pandas as pd
+
+from . import servers
+
+BACKENDS = ['http', 'ftp', 'sftp']
+NJOBS = [1, 2, 4, 8]
+DATES = pd.date_range('2012-01-01', periods=16, freq='1D')
+FILE_SIZE = 2 ** 20
+RECORD = 'smos_cci'
+
+
+class DownloadSession:
+    """
+    A stand-in server with a synthetic tree and a catalog that points to
+    it. The local store is emptied before each run. The state files (host
+    limits, missing files, coverage) are kept in the workdir until close.
+    """
+
+    def __init__(
+        self,
+        backend,
+        dates=DATES,
+        size=FILE_SIZE,
+        record=RECORD,
+        **standin_kwargs,
+    ):
+        self.workdir = tempfile.mkdtemp(prefix='brewery-bench-')
+        self.remote_root = os.path.join(self.workdir, 'remote')
+        self.local_root = os.path.join(self.workdir, 'local')
+        self.dates = dates
+        self.record_name = record
+
+        records = servers.template_records()
+        records = {record: records[record]}
+        remote_paths = servers.make_synthetic_tree(
+            self.remote_root, dates, size=size, records=records
+        )
+
+        standin = servers.STANDINS[backend]
+        self.standin = standin(self.remote_root, **standin_kwargs)
+        self.standin.start()
+
+        self.catalog_file = servers.make_catalog(
+            os.path.join(self.workdir, 'catalog.yaml'),
+            self.standin,
+            remote_paths,
+            self.local_root,
+        )
+        # keeps the state of the runs out of ~/.databrewery
+        self._state_dir = os.environ.get('DATABREWERY_STATE_DIR', None)
+        os.environ['DATABREWERY_STATE_DIR'] = os.path.join(
+            self.workdir, 'state'
+        )
+
+    def record(self):
+        from databrewery import Catalog
+
+        catalog = Catalog(self.catalog_file, verbose=0)
+        return getattr(catalog, self.record_name)
+
+    def run(self, njobs):
+        """
+        Downloads all files with `njobs` connections into an empty local
+        store and returns a dictionary with the throughput.
+        """
+        shutil.rmtree(self.local_root, ignore_errors=True)
+        record = self.record()
+
+        t0 = time.perf_counter()
+        results = record.download_data(self.dates, njobs=njobs)
+        seconds = time.perf_counter() - t0
+
+        nbytes = record.metrics.to_dataframe()['bytes'].sum()
+        nfiles = len(results['downloaded'])
+        return dict(
+            backend=self.standin.scheme,
+            njobs=njobs,
+            files=nfiles,
+            bytes=int(nbytes),
+            seconds=seconds,
+            files_per_s=nfiles / seconds,
+            MB_per_s=nbytes / 2 ** 20 / seconds,
+            latency=self.standin.latency,
+            bandwidth=self.standin.bandwidth,
+            fault_rate=self.standin.fault_rate,
+        )
+
+    def close(self):
+        self.standin.stop()
+        shutil.rmtree(self.workdir, ignore_errors=True)
+        if self._state_dir is None:
+            os.environ.pop('DATABREWERY_STATE_DIR', None)
+        else:
+            os.environ['DATABREWERY_STATE_DIR'] = self._state_dir
+
+
+class DownloadThroughput:
+    """
+    Throughput of Record.download_data per backend and number of jobs.
+    The stand-ins add 20 ms of latency per file and cap each connection at
+    20 MB/s, which is closer to a remote data server than raw loopback.
+    """
+
+    params = (BACKENDS, NJOBS)
+    param_names = ['backend', 'njobs']
+    timeout = 300
+    number = 1
+    repeat = 3
+
+    def setup(self, backend, njobs):
+        self.session = DownloadSession(
+            backend, latency=0.02, bandwidth=20 * 2 ** 20
+        )
+
+    def teardown(self, backend, njobs):
+        self.session.close()
+
+    def time_download_data(self, backend, njobs):
+        self.session.run(njobs)
+
+    def track_files_per_second(self, backend, njobs):
+        return self.session.run(njobs)['files_per_s']
+
+    track_files_per_second.unit = 'files/s'
+
+    def track_MB_per_second(self, backend, njobs):
+        return self.session.run(njobs)['MB_per_s']
+
+    track_MB_per_second.unit = 'MB/s'
+
+
+def run(
+    backends=BACKENDS, njobs=NJOBS, out=None, **standin_kwargs,
+):
+    """
+    Runs the benchmark for each backend and number of jobs without asv.
+    Results are returned as a DataFrame and appended to `out` (JSON-lines).
+    """
+    import json
+
+    run_id = pd.Timestamp.now().strftime('%Y-%m-%dT%H:%M:%S')
+    rows = []
+    for backend in backends:
+        session = DownloadSession(backend, **standin_kwargs)
+        try:
+            for n in njobs:
+                row = session.run(n)
+                row['run'] = run_id
+                rows += (row,)
+        finally:
+            session.close()
+
+    if out is not None:
+        with open(out, 'a') as file:
+            for row in rows:
+                file.write(json.dumps(row) + '\n')
+
+    return pd.DataFrame(rows)
+
+
+def compare(results_file, threshold=0.1):
+    """
+    Compares the last run in a JSON-lines results file with the run before.
+    Returns the rows where MB/s dropped by more than `threshold` (fraction).
+    """
+    df = pd.read_json(results_file, lines=True, convert_dates=False)
+    runs = df['run'].unique()
+    if len(runs) < 2:
+        return df.iloc[:0]
+
+    key = ['backend', 'njobs']
+    new = df[df['run'] == runs[-1]].set_index(key)
+    old = df[df['run'] == runs[-2]].set_index(key)
+    change = new['MB_per_s'] / old['MB_per_s'] - 1
+    return change[change < -threshold].to_frame('MB_per_s_change')
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--backends', nargs='+', default=BACKENDS)
+    parser.add_argument('--njobs', nargs='+', type=int, default=NJOBS)
+    parser.add_argument('--latency', type=float, default=0.02)
+    parser.add_argument('--bandwidth', type=float, default=20 * 2 ** 20)
+    parser.add_argument('--fault-rate', type=float, default=0)
+    parser.add_argument('--out', default=None)
+    args = parser.parse_args()
+
+    table = run(
+        args.backends,
+        args.njobs,
+        out=args.out,
+        latency=args.latency,
+        bandwidth=args.bandwidth,
+        fault_rate=args.fault_rate,
+    )
+    print(table.to_string(index=False))
+    if args.out is not None:
+        regressions = compare(args.out)
+        if len(regressions) > 0:
+            print('\nThroughput dropped compared to the previous run:')
+            print(regressions)
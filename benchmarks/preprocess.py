@@ -0,0 +1,308 @@
+"""
+Micro-benchmarks of the preprocess functions on synthetic global grids.
+
+The synthetic datasets have a smooth random land mask (NaN over ~30% of the
+grid plus Antarctica) at 4 km, 0.25 deg and 1 deg resolution, either as
+numpy arrays or as dask arrays chunked along time.
+
+With airspeed velocity (wall time, peak RSS and allocations):
+
+    asv run --bench preprocess
+
+or as a script that runs each case in a fresh process and prints a table:
+
+    python -m benchmarks.preprocess --grids 1deg 0.25deg
+"""
+import numpy as np
+import pandas as pd
+
+from databrewery import preprocess as prep
+
+GRIDS = {  # name: (lat spacing in degrees, max number of time steps)
+    '4km': (1 / 24, 2),
+    '0.25deg': (0.25, 31),
+    '1deg': (1.0, 31),
+}
+BACKENDS = ['numpy', 'dask']
+MAX_BYTES = 2 * 2 ** 30  # cases that would produce more data are skipped
+
+# function name: (time frequency, number of time steps, input layout)
+# layout 'raw' has latitude/longitude names and longitudes from 0 to 360
+FUNCTIONS = {
+    'rename_to_latlon': ('1D', 8, 'raw'),
+    'center_coords_at_0': ('1D', 8, 'raw360'),
+    'interpolate_025': ('1D', 8, 'std'),
+    'interpolate_1deg': ('1D', 8, 'std'),
+    'resample_time_1D': ('6h', 8, 'std'),
+    'resample_time_1M': ('1D', 31, 'std'),
+    'fill_time_monthly_to_daily': ('MS', 1, 'std'),
+}
+PIPELINES = {
+    'regrid_1deg': (
+        ('1D', 8, 'raw'),
+        ['rename_to_latlon', 'center_coords_at_0', 'interpolate_1deg'],
+    ),
+    'monthly_mean': (
+        ('1D', 31, 'raw'),
+        ['rename_to_latlon', 'center_coords_at_0', 'resample_time_1M'],
+    ),
+}
+# output size relative to the input (for skipping cases that are too big)
+GROWTH = {'interpolate_025': 16, 'fill_time_monthly_to_daily': 31}
+
+
+def land_mask(nlat, nlon, land_fraction=0.3, seed=0):
+    """
+    A smooth random land mask (True = land) with continents of a few
+    thousand kilometres and land south of 70S. Low resolution noise is
+    interpolated to the grid so that all resolutions share the coastlines.
+    """
+    from scipy.ndimage import zoom
+
+    rng = np.random.RandomState(seed)
+    noise = rng.rand(18, 36)
+    smooth = zoom(noise, (nlat / 18, nlon / 36), order=1)[:nlat, :nlon]
+    land = smooth > np.quantile(smooth, 1 - land_fraction)
+
+    lat = np.linspace(-90, 90, nlat)
+    land[lat < -70] = True
+    return land
+
+
+def make_dataset(
+    grid='1deg', freq='1D', periods=8, layout='std', backend='numpy'
+):
+    """
+    Creates a synthetic sea surface temperature like dataset.
+
+    Parameters
+    ==========
+    grid: str
+        one of GRIDS (4km, 0.25deg, 1deg)
+    freq: str
+        the time step of the data
+    periods: int
+        the number of time steps (limited by the grid maximum)
+    layout: str
+        std = lat/lon with -180:180; raw = latitude/longitude with
+        0:360; raw360 = lat/lon with 0:360
+    backend: str
+        numpy or dask (chunked by time step)
+    """
+    import xarray as xr
+
+    step, max_steps = GRIDS[grid]
+    periods = min(periods, max_steps)
+    nlat, nlon = int(round(180 / step)), int(round(360 / step))
+
+    lat = np.linspace(-90 + step / 2, 90 - step / 2, nlat)
+    lon = np.linspace(-180 + step / 2, 180 - step / 2, nlon)
+    time = pd.date_range('2012-01-01', periods=periods, freq=freq)
+
+    rng = np.random.RandomState(1)
+    mask = land_mask(nlat, nlon)
+    sst = 28 * np.cos(np.deg2rad(lat))[:, None] * np.ones(nlon)
+    data = np.empty((periods, nlat, nlon), dtype='float32')
+    for t in range(periods):
+        data[t] = sst + rng.normal(0, 0.5, size=(nlat, nlon))
+        data[t][mask] = np.nan
+
+    latname, lonname = 'lat', 'lon'
+    if layout in ['raw', 'raw360']:
+        lon = np.where(lon < 0, lon + 360, lon)
+        order = np.argsort(lon)
+        lon, data = lon[order], data[:, :, order]
+    if layout == 'raw':
+        latname, lonname = 'latitude', 'longitude'
+
+    xds = xr.Dataset(
+        {'sst': (('time', latname, lonname), data)},
+        coords={'time': time, latname: lat, lonname: lon},
+        attrs={'history': ''},
+    )
+
+    if backend == 'dask':
+        xds = xds.chunk({'time': 1})
+
+    return xds
+
+
+def get_case(grid, name, backend):
+    """
+    Returns the function (or pipeline) and its synthetic input dataset.
+    Raises NotImplementedError (= skipped by asv) if the case is too big
+    for the benchmark machine or if dask is not installed.
+    """
+    if backend == 'dask':
+        try:
+            import dask  # noqa: F401
+        except ImportError:
+            raise NotImplementedError('dask is not installed')
+
+    if name in PIPELINES:
+        (freq, periods, layout), names = PIPELINES[name]
+        funcs = [getattr(prep, n) for n in names]
+
+        def func(xds):
+            return prep.apply_process_pipeline(xds, funcs)
+
+    else:
+        freq, periods, layout = FUNCTIONS[name]
+        names = [name]
+        func = getattr(prep, name)
+
+    step, max_steps = GRIDS[grid]
+    ncells = (180 / step) * (360 / step) * min(periods, max_steps)
+    growth = max(GROWTH.get(n, 1) for n in names)
+    if ncells * 4 * (1 + growth) > MAX_BYTES:
+        raise NotImplementedError(f'{name} on the {grid} grid is too big')
+
+    xds = make_dataset(grid, freq, periods, layout, backend)
+
+    return func, xds
+
+
+def run_case(func, xds):
+    """runs the function and makes sure lazy (dask) results are computed"""
+    out = func(xds.copy())
+    return out.load()
+
+
+def measure_allocations(func, xds):
+    """
+    Traces python and numpy allocations with tracemalloc (slow, so this is
+    kept apart from the timing).
+
+    Returns
+    =======
+    peak_MB: float
+        the peak of memory allocated while running the function
+    blocks: int
+        the number of allocated memory blocks still alive on return
+    """
+    import gc
+    import tracemalloc
+
+    gc.collect()
+    tracemalloc.start()
+    before = tracemalloc.take_snapshot()
+    tracemalloc.reset_peak()
+    start = tracemalloc.get_traced_memory()[0]
+
+    out = run_case(func, xds)
+
+    peak = tracemalloc.get_traced_memory()[1] - start
+    after = tracemalloc.take_snapshot()
+    tracemalloc.stop()
+
+    diff = after.compare_to(before, 'lineno')
+    blocks = sum(max(stat.count_diff, 0) for stat in diff)
+    del out
+
+    return peak / 2 ** 20, blocks
+
+
+class _PreprocessBenchmark:
+    timeout = 600
+    param_names = ['grid', 'function', 'backend']
+
+    def setup(self, grid, name, backend):
+        self.func, self.xds = get_case(grid, name, backend)
+
+    def time_run(self, grid, name, backend):
+        run_case(self.func, self.xds)
+
+    def peakmem_run(self, grid, name, backend):
+        run_case(self.func, self.xds)
+
+    def track_alloc_peak_MB(self, grid, name, backend):
+        return measure_allocations(self.func, self.xds)[0]
+
+    track_alloc_peak_MB.unit = 'MB'
+
+    def track_alloc_blocks(self, grid, name, backend):
+        return measure_allocations(self.func, self.xds)[1]
+
+    track_alloc_blocks.unit = 'blocks'
+
+
+class PreprocessFunctions(_PreprocessBenchmark):
+    params = (list(GRIDS), list(FUNCTIONS), BACKENDS)
+
+
+class PreprocessPipelines(_PreprocessBenchmark):
+    params = (list(GRIDS), list(PIPELINES), BACKENDS)
+    param_names = ['grid', 'pipeline', 'backend']
+
+
+def _measure_in_process(grid, name, backend, repeat):
+    import resource
+    import time
+
+    try:
+        func, xds = get_case(grid, name, backend)
+    except NotImplementedError as skipped:
+        return dict(skipped=str(skipped))
+
+    run_case(func, xds)  # warm up (imports, caches)
+    rss0 = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    times = []
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        run_case(func, xds)
+        times += (time.perf_counter() - t0,)
+    rss1 = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    alloc_peak, blocks = measure_allocations(func, xds)
+
+    return dict(
+        wall_s=min(times),
+        peak_rss_MB=rss1 / 2 ** 10,  # ru_maxrss is in KB on linux
+        peak_rss_increase_MB=(rss1 - rss0) / 2 ** 10,
+        alloc_peak_MB=alloc_peak,
+        alloc_blocks=blocks,
+    )
+
+
+def run(grids=GRIDS, names=None, backends=BACKENDS, repeat=3):
+    """
+    Runs every case in a fresh process so that the peak RSS of one case does
+    not hide the peak of the next. Returns a pandas.DataFrame.
+    """
+    from concurrent.futures import ProcessPoolExecutor
+    from multiprocessing import get_context
+
+    names = list(FUNCTIONS) + list(PIPELINES) if names is None else names
+
+    rows = []
+    for grid in grids:
+        for name in names:
+            for backend in backends:
+                with ProcessPoolExecutor(1, get_context('spawn')) as pool:
+                    result = pool.submit(
+                        _measure_in_process, grid, name, backend, repeat
+                    ).result()
+                row = dict(grid=grid, function=name, backend=backend)
+                row.update(result)
+                rows += (row,)
+
+    return pd.DataFrame(rows)
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--grids', nargs='+', default=list(GRIDS))
+    parser.add_argument('--functions', nargs='+', default=None)
+    parser.add_argument('--backends', nargs='+', default=BACKENDS)
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--out', default=None, help='csv file for results')
+    args = parser.parse_args()
+
+    table = run(args.grids, args.functions, args.backends, args.repeat)
+    with pd.option_context('display.width', 200, 'display.precision', 3):
+        print(table.to_string(index=False))
+    if args.out is not None:
+        table.to_csv(args.out, index=False)
@@ -0,0 +1,868 @@
+"""
+Local stand-in servers for the download benchmarks.
+
+Each stand-in serves a directory tree over one protocol (HTTP, FTP, SFTP or
+S3) on localhost and can be slowed down or made unreliable:
+
+    latency: float
+        seconds of delay before each file request is answered
+    bandwidth: float
+        maximum transfer rate per connection in bytes per second
+    fault_rate: float
+        fraction (0-1) of file requests that fail. HTTP answers 503,
+        FTP answers 421 and SFTP fails to open the file.
+    max_connections: int
+        the server capacity. HTTP answers 503 to file requests beyond the
+        capacity and FTP refuses connections with 421.
+
+The synthetic trees mirror the URL layout of the records in
+catalog_template.yaml so that the benchmarks run through the same
+date formatting and listing code as the real catalog.
+"""
+import os
+import random
+import socket
+import threading
+import time
+from http.server import HTTPServer
+from socketserver import ThreadingMixIn
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+CATALOG_TEMPLATE = os.path.join(HERE, '..', 'catalog_template.yaml')
+
+USERNAME = 'brewer'
+PASSWORD = 'hops'
+
+
+# http.server.ThreadingHTTPServer is new in Python 3.7
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+def get_free_port():
+    with socket.socket() as sock:
+        sock.bind(('localhost', 0))
+        return sock.getsockname()[1]
+
+
+class StandIn:
+    """
+    Base class for the stand-in servers. Use as a context manager or call
+    start() and stop(). The server runs in a daemon thread.
+    """
+
+    scheme = None
+
+    def __init__(
+        self,
+        root,
+        latency=0,
+        bandwidth=None,
+        fault_rate=0,
+        seed=None,
+        max_connections=None,
+    ):
+        self.root = os.path.abspath(root)
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.fault_rate = fault_rate
+        self.max_connections = max_connections
+        self.host = 'localhost'
+        self.port = get_free_port()
+        self.active = 0
+        self.peak_active = 0
+        self.refused = 0
+        self._random = random.Random(seed)
+        self._active_lock = threading.Lock()
+        self._thread = None
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *args):
+        self.stop()
+
+    def __repr__(self):
+        return (
+            f'{self.__class__.__name__}({self.scheme}://{self.host}:'
+            f'{self.port}, latency={self.latency}, '
+            f'bandwidth={self.bandwidth}, fault_rate={self.fault_rate})'
+        )
+
+    @property
+    def netloc(self):
+        """the network location in the catalog URL"""
+        return self.host
+
+    @property
+    def remote_login(self):
+        """the entries of the catalog `remote` block (except for url)"""
+        return dict(username=USERNAME, password=PASSWORD, port=self.port)
+
+    def delay(self):
+        if self.latency:
+            time.sleep(self.latency)
+
+    def fault(self):
+        return self._random.random() < self.fault_rate
+
+    def enter(self):
+        """
+        Counts a file request that starts. Returns False (and does not
+        count it) if the server is at capacity.
+        """
+        with self._active_lock:
+            full = self.max_connections is not None
+            if full and (self.active >= self.max_connections):
+                self.refused += 1
+                return False
+            self.active += 1
+            self.peak_active = max(self.peak_active, self.active)
+            return True
+
+    def leave(self):
+        with self._active_lock:
+            self.active -= 1
+
+    def throttle(self, nbytes, t0):
+        """sleeps until `nbytes` sent since `t0` fit in the bandwidth"""
+        if self.bandwidth:
+            wait = nbytes / self.bandwidth - (time.perf_counter() - t0)
+            if wait > 0:
+                time.sleep(wait)
+
+    def start(self):
+        self._thread = threading.Thread(target=self._serve, daemon=True)
+        self._thread.start()
+        self._wait_until_listening()
+
+    def _wait_until_listening(self, timeout=10):
+        t0 = time.time()
+        while time.time() - t0 < timeout:
+            try:
+                socket.create_connection((self.host, self.port), 1).close()
+                return
+            except OSError:
+                time.sleep(0.05)
+        raise TimeoutError(f'{self} did not start')
+
+    def _serve(self):
+        raise NotImplementedError
+
+    def stop(self):
+        raise NotImplementedError
+
+
+class HTTPStandIn(StandIn):
+    """
+    threaded HTTP server with basic authentication. Directories have index
+    pages unless `index=False` (403 Forbidden as on a server with indexes
+    switched off). Files are sent in byte ranges (206 Partial Content)
+    unless `ranges=False`. The paths of all GET requests are kept in
+    `paths` and the Range headers in `ranges_requested`.
+    """
+
+    scheme = 'http'
+
+    def __init__(self, root, index=True, ranges=True, **kwargs):
+        super().__init__(root, **kwargs)
+        self.index = index
+        self.ranges = ranges
+        self.paths = []
+        self.ranges_requested = []
+
+    def _serve(self):
+        import base64
+        from functools import partial
+        from http.server import SimpleHTTPRequestHandler
+
+        standin = self
+        token = base64.b64encode(f'{USERNAME}:{PASSWORD}'.encode()).decode()
+
+        class Handler(SimpleHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def log_message(self, *args):
+                pass
+
+            def do_GET(self):
+                standin.paths.append(self.path)
+                if not standin.enter():
+                    self.send_error(503)
+                    return
+                try:
+                    super().do_GET()
+                finally:
+                    standin.leave()
+
+            def list_directory(self, path):
+                if not standin.index:
+                    self.send_error(403)
+                    return None
+                return super().list_directory(path)
+
+            def send_head(self):
+                if self.headers.get('Authorization') != f'Basic {token}':
+                    self.send_error(401)
+                    return None
+                standin.delay()
+                if standin.fault():
+                    self.send_error(503)
+                    return None
+                self.count = None
+                header = self.headers.get('Range')
+                path = self.translate_path(self.path)
+                if (header is None) or (not standin.ranges):
+                    return super().send_head()
+                if os.path.isdir(path):
+                    return super().send_head()
+                standin.ranges_requested.append(header)
+                return self.send_range(path, header)
+
+            def send_range(self, path, header):
+                import re
+
+                try:
+                    source = open(path, 'rb')
+                except OSError:
+                    self.send_error(404)
+                    return None
+                size = os.fstat(source.fileno()).st_size
+                match = re.match(r'bytes=(\d+)-(\d*)$', header)
+                start = int(match[1])
+                end = min(int(match[2] or size - 1), size - 1)
+                if start > end:
+                    source.close()
+                    self.send_error(416)
+                    return None
+                self.send_response(206)
+                self.send_header('Content-Type', self.guess_type(path))
+                content_range = f'bytes {start}-{end}/{size}'
+                self.send_header('Content-Range', content_range)
+                self.send_header('Content-Length', str(end - start + 1))
+                self.end_headers()
+                source.seek(start)
+                self.count = end - start + 1
+                return source
+
+            def end_headers(self):
+                if standin.ranges:
+                    self.send_header('Accept-Ranges', 'bytes')
+                super().end_headers()
+
+            def copyfile(self, source, outputfile):
+                if not standin.bandwidth:
+                    # sent by the kernel (os.sendfile)
+                    self.connection.sendfile(
+                        source, offset=source.tell(), count=self.count
+                    )
+                    return
+                t0 = time.perf_counter()
+                sent = 0
+                remaining = self.count
+                while remaining != 0:
+                    size = 64 * 2 ** 10
+                    if remaining is not None:
+                        size = min(size, remaining)
+                        remaining -= size
+                    chunk = source.read(size)
+                    if not chunk:
+                        break
+                    outputfile.write(chunk)
+                    sent += len(chunk)
+                    standin.throttle(sent, t0)
+
+        handler = partial(Handler, directory=self.root)
+        self._server = ThreadingHTTPServer((self.host, self.port), handler)
+        self._server.daemon_threads = True
+        self._server.serve_forever(poll_interval=0.1)
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+
+class FTPStandIn(StandIn):
+    """
+    pyftpdlib server with one thread per connection. With mlsd=False the
+    server answers MLSD with 500 (like servers without RFC 3659).
+    """
+
+    scheme = 'ftp'
+
+    def __init__(self, root, mlsd=True, **kwargs):
+        super().__init__(root, **kwargs)
+        self.mlsd = mlsd
+        self.commands = []
+
+    def _serve(self):
+        from pyftpdlib.authorizers import DummyAuthorizer
+        from pyftpdlib.handlers import FTPHandler, ThrottledDTPHandler
+        from pyftpdlib.servers import ThreadedFTPServer
+
+        standin = self
+
+        authorizer = DummyAuthorizer()
+        authorizer.add_user(USERNAME, PASSWORD, self.root, perm='elr')
+        authorizer.add_anonymous(self.root)
+
+        class DTPHandler(ThrottledDTPHandler):
+            write_limit = self.bandwidth or 0
+
+        class Handler(FTPHandler):
+            dtp_handler = DTPHandler
+
+            def pre_process_command(self, line, cmd, arg):
+                standin.commands += (cmd,)
+                return super().pre_process_command(line, cmd, arg)
+
+            def ftp_MLSD(self, path):
+                if not standin.mlsd:
+                    self.respond('500 Command "MLSD" not understood.')
+                    return
+                return super().ftp_MLSD(path)
+
+            def ftp_RETR(self, file):
+                standin.delay()
+                if standin.fault():
+                    self.respond('421 Service not available (injected).')
+                    return
+                return super().ftp_RETR(file)
+
+        Handler.authorizer = authorizer
+        Handler.banner = 'dataBrewery stand-in'
+
+        self._server = ThreadedFTPServer((self.host, self.port), Handler)
+        self._server.max_cons = self.max_connections or 256
+        self._server.serve_forever(timeout=0.1, handle_exit=False)
+
+    def stop(self):
+        self._server.close_all()
+
+
+class SFTPStandIn(StandIn):
+    """in-process paramiko SFTP server with password authentication"""
+
+    scheme = 'sftp'
+
+    def start(self):
+        import logging
+        import paramiko
+
+        # dropped client connections are expected (e.g. fault injection)
+        logging.getLogger('paramiko').setLevel(logging.CRITICAL)
+
+        self._host_key = paramiko.RSAKey.generate(2048)
+        self._sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self._sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self._sock.bind((self.host, self.port))
+        self._sock.listen(64)
+        self._transports = []
+
+        self._thread = threading.Thread(target=self._serve, daemon=True)
+        self._thread.start()
+
+    def _serve(self):
+        import paramiko
+
+        while True:
+            try:
+                conn, addr = self._sock.accept()
+            except OSError:  # socket closed by stop
+                break
+            transport = paramiko.Transport(conn)
+            transport.add_server_key(self._host_key)
+            transport.set_subsystem_handler(
+                'sftp', paramiko.SFTPServer, _make_sftp_interface(self)
+            )
+            try:
+                transport.start_server(server=_make_ssh_server())
+            except (paramiko.SSHException, EOFError):
+                continue
+            self._transports += (transport,)
+
+    def stop(self):
+        self._sock.close()
+        for transport in self._transports:
+            transport.close()
+
+
+def _make_ssh_server():
+    """accepts the stand-in username and password for an sftp session"""
+    import paramiko
+
+    class Server(paramiko.ServerInterface):
+        def check_auth_password(self, username, password):
+            if (username, password) == (USERNAME, PASSWORD):
+                return paramiko.AUTH_SUCCESSFUL
+            return paramiko.AUTH_FAILED
+
+        def get_allowed_auths(self, username):
+            return 'password'
+
+        def check_channel_request(self, kind, chanid):
+            if kind == 'session':
+                return paramiko.OPEN_SUCCEEDED
+            return paramiko.OPEN_FAILED_ADMINISTRATIVELY_PROHIBITED
+
+    return Server()
+
+
+def _make_sftp_interface(standin):
+    """read only SFTP interface that serves the stand-in root directory"""
+    import paramiko
+    from paramiko import SFTPAttributes, SFTPHandle, SFTPServer
+
+    class Handle(SFTPHandle):
+        def __init__(self, fobj, flags=0):
+            super().__init__(flags)
+            self.readfile = fobj
+            self._t0 = time.perf_counter()
+            self._sent = 0
+
+        def read(self, offset, length):
+            data = super().read(offset, length)
+            if isinstance(data, bytes):
+                self._sent += len(data)
+                standin.throttle(self._sent, self._t0)
+            return data
+
+    class Interface(paramiko.SFTPServerInterface):
+        def _local(self, path):
+            path = os.path.normpath('/' + path.lstrip('/'))
+            return os.path.join(standin.root, path.lstrip('/'))
+
+        def list_folder(self, path):
+            local = self._local(path)
+            try:
+                names = os.listdir(local)
+            except OSError as error:
+                return SFTPServer.convert_errno(error.errno)
+            out = []
+            for name in names:
+                attr = SFTPAttributes.from_stat(
+                    os.stat(os.path.join(local, name))
+                )
+                attr.filename = name
+                out += (attr,)
+            return out
+
+        def stat(self, path):
+            try:
+                return SFTPAttributes.from_stat(os.stat(self._local(path)))
+            except OSError as error:
+                return SFTPServer.convert_errno(error.errno)
+
+        lstat = stat
+
+        def open(self, path, flags, attr):
+            standin.delay()
+            if standin.fault():
+                return paramiko.SFTP_FAILURE
+            try:
+                fobj = open(self._local(path), 'rb')
+            except OSError as error:
+                return SFTPServer.convert_errno(error.errno)
+            return Handle(fobj, flags)
+
+    return Interface
+
+
+class CDSStandIn(StandIn):
+    """
+    Mimics the (legacy) Climate Data Store API used by cdsapi. Requests wait
+    in the queue for `queue_time` seconds and then run for `run_time`
+    seconds before a synthetic netCDF file with the requested variables and
+    times (see make_cds_netcdf) can be downloaded. Requests that are found
+    in `fail_requests` (a list of dicts with items that must match the
+    request) fail. With a `fault_rate`, polls of the request states fail
+    with 503. Use `url` and `key` for the cdsapi.Client.
+    """
+
+    scheme = 'cds'
+
+    def __init__(
+        self, root, queue_time=0.5, run_time=0.2, fail_requests=(), **kwargs
+    ):
+        super().__init__(root, **kwargs)
+        self.queue_time = queue_time
+        self.run_time = run_time
+        self.fail_requests = list(fail_requests)
+        self.tasks = {}
+        self.submitted = 0
+        self.max_active = 0
+        self._lock = threading.Lock()
+
+    @property
+    def url(self):
+        return f'http://{self.host}:{self.port}/api/v2'
+
+    @property
+    def key(self):
+        return f'1:{PASSWORD}'
+
+    def _state(self, task):
+        elapsed = time.time() - task['submitted']
+        if task['failed']:
+            return 'failed'
+        if elapsed < self.queue_time:
+            return 'queued'
+        if elapsed < self.queue_time + self.run_time:
+            return 'running'
+        return 'completed'
+
+    def _active(self):
+        return sum(
+            self._state(t) in ('queued', 'running')
+            for t in self.tasks.values()
+            if not t['deleted']
+        )
+
+    def _serve(self):
+        import json
+        import uuid
+        from http.server import BaseHTTPRequestHandler
+
+        standin = self
+        os.makedirs(self.root, exist_ok=True)
+
+        def source(rid):
+            path = os.path.join(standin.root, f'.cds-{rid}.nc')
+            with standin._lock:
+                if not os.path.isfile(path):
+                    make_cds_netcdf(path, standin.tasks[rid]['request'])
+            return path
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def log_message(self, *args):
+                pass
+
+            def _json(self, obj, code=200):
+                body = json.dumps(obj).encode()
+                self.send_response(code)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def _reply(self, rid):
+                task = standin.tasks[rid]
+                state = standin._state(task)
+                reply = dict(request_id=rid, state=state)
+                if state == 'completed':
+                    reply.update(
+                        location=f'/download/{rid}.nc',
+                        content_length=os.path.getsize(source(rid)),
+                        content_type='application/x-netcdf',
+                    )
+                elif state == 'failed':
+                    reply['error'] = dict(message='injected', reason='test')
+                return reply
+
+            def do_POST(self):
+                size = int(self.headers.get('Content-Length', 0))
+                request = json.loads(self.rfile.read(size))
+                standin.delay()
+                failed = any(
+                    all(request.get(k) == v for k, v in match.items())
+                    for match in standin.fail_requests
+                )
+                rid = uuid.uuid4().hex
+                with standin._lock:
+                    standin.tasks[rid] = dict(
+                        request=request,
+                        dataset=self.path.split('/')[-1],
+                        submitted=time.time(),
+                        failed=failed,
+                        deleted=False,
+                    )
+                    standin.submitted += 1
+                    standin.max_active = max(
+                        standin.max_active, standin._active()
+                    )
+                self._json(self._reply(rid))
+
+            def do_GET(self):
+                parts = self.path.strip('/').split('/')
+                if parts[-1] == 'status.json':
+                    return self._json({})
+                rid = parts[-1].replace('.nc', '')
+                task = standin.tasks.get(rid)
+                if (task is None) or task['deleted']:
+                    return self._json(dict(message='not found'), 404)
+                if parts[-2] == 'tasks':
+                    if standin.fault():
+                        return self._json(dict(reason='injected'), 503)
+                    return self._json(self._reply(rid))
+                with open(source(rid), 'rb') as file:
+                    body = file.read()
+                self.send_response(200)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def do_DELETE(self):
+                rid = self.path.strip('/').split('/')[-1]
+                if rid in standin.tasks:
+                    standin.tasks[rid]['deleted'] = True
+                self._json({})
+
+        self._server = ThreadingHTTPServer((self.host, self.port), Handler)
+        self._server.daemon_threads = True
+        self._server.serve_forever(poll_interval=0.1)
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+
+class S3StandIn(StandIn):
+    """
+    moto S3 server. The files of the root directory are uploaded to a
+    bucket when the server starts (see upload). Latency, bandwidth and
+    faults are not simulated.
+    """
+
+    scheme = 's3'
+
+    def __init__(self, root, bucket=None, **kwargs):
+        super().__init__(root, **kwargs)
+        # moto keeps the buckets of all servers of the process
+        self.bucket = f'brewery-{self.port}' if bucket is None else bucket
+
+    @property
+    def netloc(self):
+        return self.bucket
+
+    @property
+    def endpoint_url(self):
+        return f'http://{self.host}:{self.port}'
+
+    @property
+    def remote_login(self):
+        return dict(
+            username=USERNAME,
+            password=PASSWORD,
+            endpoint_url=self.endpoint_url,
+            region='us-east-1',
+        )
+
+    def start(self):
+        from moto.server import ThreadedMotoServer
+
+        self._server = ThreadedMotoServer(
+            ip_address=self.host, port=self.port, verbose=False
+        )
+        self._server.start()
+        self._wait_until_listening()
+        self.upload()
+
+    def upload(self):
+        """puts the files of the root directory in the bucket"""
+        import boto3
+
+        client = boto3.client(
+            's3',
+            endpoint_url=self.endpoint_url,
+            region_name='us-east-1',
+            aws_access_key_id=USERNAME,
+            aws_secret_access_key=PASSWORD,
+        )
+        buckets = [b['Name'] for b in client.list_buckets()['Buckets']]
+        if self.bucket not in buckets:
+            client.create_bucket(Bucket=self.bucket)
+        for directory, dirs, names in os.walk(self.root):
+            for name in names:
+                if name.startswith('.'):
+                    continue
+                path = os.path.join(directory, name)
+                key = os.path.relpath(path, self.root).replace(os.sep, '/')
+                client.upload_file(path, self.bucket, key)
+
+    def stop(self):
+        self._server.stop()
+
+
+STANDINS = {
+    'http': HTTPStandIn,
+    'ftp': FTPStandIn,
+    'sftp': SFTPStandIn,
+    's3': S3StandIn,
+    'cds': CDSStandIn,
+}
+
+
+def make_netcdf(path, size=2 ** 20):
+    """
+    Writes a synthetic single time step netCDF file of roughly `size` bytes
+    with a float32 variable on a lat/lon grid.
+    """
+    import netCDF4
+    import numpy as np
+
+    ny = max(int((size / 4 / 2) ** 0.5), 2)
+    nx = ny * 2
+    rng = np.random.RandomState(0)
+
+    with netCDF4.Dataset(path, 'w') as nc:
+        nc.createDimension('time', 1)
+        nc.createDimension('lat', ny)
+        nc.createDimension('lon', nx)
+        nc.createVariable('lat', 'f4', ('lat',))[:] = np.linspace(
+            -90, 90, ny
+        )
+        nc.createVariable('lon', 'f4', ('lon',))[:] = np.linspace(
+            -180, 180, nx
+        )
+        var = nc.createVariable('var', 'f4', ('time', 'lat', 'lon'))
+        var[:] = rng.rand(1, ny, nx).astype('f4')
+
+    return path
+
+
+def make_cds_netcdf(path, request, ny=4, nx=8):
+    """
+    Writes a small netCDF file like the one the CDS returns for an ERA5
+    request: one variable per requested variable and a time axis with every
+    valid combination of the requested years, months, days and times.
+    """
+    import netCDF4
+    import numpy as np
+    import pandas as pd
+
+    def as_list(value):
+        return [value] if isinstance(value, str) else list(value)
+
+    times = []
+    for year in as_list(request['year']):
+        for month in as_list(request['month']):
+            for day in as_list(request['day']):
+                for hour in as_list(request['time']):
+                    try:
+                        t = pd.Timestamp(f'{year}-{month}-{day}T{hour}')
+                    except ValueError:  # e.g. the 31st of a short month
+                        continue
+                    times += (t,)
+    times = sorted(times)
+    t0 = pd.Timestamp('1900-01-01')
+    hours = [(t - t0) // pd.Timedelta('1h') for t in times]
+
+    rng = np.random.RandomState(0)
+    with netCDF4.Dataset(path, 'w') as nc:
+        nc.createDimension('time', len(times))
+        nc.createDimension('latitude', ny)
+        nc.createDimension('longitude', nx)
+        time = nc.createVariable('time', 'i4', ('time',))
+        time.units = 'hours since 1900-01-01 00:00:00.0'
+        time.calendar = 'gregorian'
+        time[:] = hours
+        lat = nc.createVariable('latitude', 'f4', ('latitude',))
+        lat[:] = np.linspace(90, -90, ny)
+        lon = nc.createVariable('longitude', 'f4', ('longitude',))
+        lon[:] = np.linspace(0, 360, nx, endpoint=False)
+        dims = ('time', 'latitude', 'longitude')
+        for name in as_list(request['variable']):
+            var = nc.createVariable(name, 'f4', dims)
+            var[:] = rng.rand(len(times), ny, nx).astype('f4')
+
+    return path
+
+
+def template_records(catalog_file=CATALOG_TEMPLATE):
+    """
+    Returns the records of the catalog template that contain a date in the
+    URL as a dict of {name: record_dict}
+    """
+    import yaml
+
+    catalog = yaml.safe_load(open(catalog_file))
+    records = {}
+    for name, record in catalog.items():
+        if name.upper() == name:
+            continue
+        if '{t:' in record['remote']['url']:
+            records[name] = record
+    return records
+
+
+def make_synthetic_tree(root, dates, size=2 ** 20, records=None):
+    """
+    Creates the remote directory tree of the given template records in
+    `root`, with one synthetic netCDF file for each date.
+
+    Parameters
+    ==========
+    root: str
+        the directory served by the stand-ins
+    dates: pandas.DatetimeIndex
+        the dates for which files are created
+    size: int
+        approximate size of each file in bytes
+    records: dict
+        {name: record_dict}; defaults to the template records
+
+    Returns
+    =======
+    remote_paths: dict
+        the URL path templates ({t:...} formatting) for each record
+    """
+    import shutil
+    from urllib.parse import urlparse
+
+    records = template_records() if records is None else records
+
+    os.makedirs(root, exist_ok=True)
+    source = make_netcdf(os.path.join(root, '.synthetic.nc'), size=size)
+
+    remote_paths = {}
+    for name, record in records.items():
+        url_path = urlparse(record['remote']['url']).path
+        remote_paths[name] = url_path
+        for date in dates:
+            path = os.path.join(root, url_path.format(t=date).lstrip('/'))
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            if not os.path.isfile(path):
+                shutil.copyfile(source, path)
+
+    return remote_paths
+
+
+def make_catalog(
+    catalog_file, standin, remote_paths, local_root, mirrors=()
+):
+    """
+    Writes a catalog file where each record points to the stand-in server.
+    Records keep their template names and descriptions. Other stand-ins
+    with the same tree can be given as `mirrors`.
+    """
+    import yaml
+
+    records = template_records()
+    catalog = {}
+    for name, url_path in remote_paths.items():
+        record = records[name]
+        remote = dict(url=f'{standin.scheme}://{standin.netloc}{url_path}')
+        remote.update(standin.remote_login)
+        if mirrors:
+            remote['mirrors'] = []
+            for mirror in mirrors:
+                url = f'{mirror.scheme}://{mirror.netloc}{url_path}'
+                remote['mirrors'] += (dict(url=url, **mirror.remote_login),)
+        local_store = os.path.join(
+            local_root, name, os.path.basename(url_path)
+        )
+        catalog[name] = dict(
+            description=record['description'],
+            doi=record['doi'],
+            variables=record['variables'],
+            remote=remote,
+            local_store=local_store,
+        )
+
+    with open(catalog_file, 'w') as file:
+        yaml.safe_dump(catalog, file)
+
+    return catalog_file
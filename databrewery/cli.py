@@ -0,0 +1,64 @@
+"""
+The `brewery` command.
+
+    brewery serve <catalog>   serves the local_store to other nodes
+                              (see serve.py)
+    brewery work <queue>      downloads the files of a work queue
+                              (see workqueue.py)
+"""
+import argparse
+
+
+def njobs_type(value):
+    """an int or 'auto' (see Record.download_data)"""
+    return value if value == 'auto' else int(value)
+
+
+def make_parser():
+    from .serve import CACHE_PORT
+
+    parser = argparse.ArgumentParser(
+        prog='brewery', description='Downloads date based datasets'
+    )
+    commands = parser.add_subparsers(dest='command')
+    # add_subparsers(required=True) is new in Python 3.7
+    commands.required = True
+
+    serve = commands.add_parser(
+        'serve', help='serves the local_store as a read-through cache'
+    )
+    serve.add_argument('catalog', help='the catalog file')
+    serve.add_argument('--host', default='', help='all addresses by default')
+    serve.add_argument('--port', type=int, default=CACHE_PORT)
+    serve.add_argument(
+        '--records', nargs='+', default=None, help='all records by default'
+    )
+    serve.add_argument('--verbose', type=int, default=1)
+
+    work = commands.add_parser(
+        'work', help='downloads the files of a work queue'
+    )
+    work.add_argument('queue', help='the queue database')
+    work.add_argument('--njobs', type=njobs_type, default=1)
+    work.add_argument(
+        '--wait', type=float, default=0, help='seconds to wait for files'
+    )
+    work.add_argument('--verbose', type=int, default=0)
+    return parser
+
+
+def main(args=None):
+    args = make_parser().parse_args(args)
+    if args.command == 'serve':
+        from .serve import serve
+
+        serve(args.catalog, args.host, args.port, args.records, args.verbose)
+    elif args.command == 'work':
+        from .workqueue import work, worker_name
+
+        nbatches = work(args.queue, args.njobs, args.wait, args.verbose)
+        print(f'{worker_name()} downloaded {nbatches} batches')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,224 @@
+"""
+Adaptive per-host concurrency for downloads (used with njobs='auto').
+
+The number of connections to a host is controlled with AIMD (additive
+increase, multiplicative decrease), as in TCP congestion control. The
+limit grows by one while the throughput keeps improving and is halved when
+the server refuses connections (connection refused, FTP 421, HTTP 429/503)
+or when the latency rises well above the lowest latency seen. The learned
+limit is stored per host (see state.JSONStore) and is the starting point of
+the next session.
+"""
+import threading
+import time
+
+OVERLOAD_HTTP_CODES = (429, 503)
+
+_limiters = {}
+_limiters_lock = threading.Lock()
+
+
+def is_overload_error(error):
+    """
+    True if the error means that the server has too many connections or
+    requests, i.e. that the client should back off.
+    """
+    import ftplib
+
+    if isinstance(error, (ConnectionRefusedError, ConnectionResetError)):
+        return True
+    if isinstance(error, ftplib.error_temp):
+        # some servers refuse the data connection with 425
+        message = str(error)
+        many = 'too many connections' in message.lower()
+        return message.startswith('421') or many
+
+    from .retry import http_status
+
+    # S3 answers SlowDown with 503
+    return http_status(error) in OVERLOAD_HTTP_CODES
+
+
+def get_limiter(host, **kwargs):
+    """
+    Returns the HostLimiter of the host. Records that download from the same
+    host at the same time share the limiter (and thus the limit).
+    """
+    with _limiters_lock:
+        if host not in _limiters:
+            _limiters[host] = HostLimiter(host, **kwargs)
+        limiter = _limiters[host]
+        if 'max_limit' in kwargs:
+            limiter.max_limit = max(kwargs['max_limit'], limiter.min_limit)
+    return limiter
+
+
+class HostLimiter:
+    """
+    Limits the number of concurrent downloads from one host with AIMD.
+
+    Workers call acquire() before each file and release() after it, and
+    report the outcome with success() or overload(). The limit is adjusted
+    once per window (a number of completed files equal to the limit).
+    """
+
+    def __init__(
+        self,
+        host,
+        initial=2,
+        min_limit=1,
+        max_limit=16,
+        increase=1,
+        decrease=0.5,
+        latency_factor=3,
+        improvement=0.05,
+        store='host_limits.json',
+    ):
+        """
+        Parameters
+        ==========
+        host: str
+            the host name (key of the learned limit)
+        initial: int
+            the limit if none has been learned for the host yet
+        min_limit, max_limit: int
+            the bounds of the limit
+        increase: int
+            added to the limit when the throughput improved
+        decrease: float
+            the limit is multiplied with this factor on overload
+        latency_factor: float
+            backs off when the average latency exceeds this multiple of
+            the lowest latency seen
+        improvement: float
+            the fraction that the throughput must improve by to increase
+        store: str
+            the name of the state file, None to not remember the limit
+        """
+        from .state import JSONStore
+
+        self.host = host
+        self.min_limit = min_limit
+        self.max_limit = max(max_limit, min_limit)
+        self.increase = increase
+        self.decrease = decrease
+        self.latency_factor = latency_factor
+        self.improvement = improvement
+
+        self.store = None if store is None else JSONStore(store)
+        learned = {} if self.store is None else self.store.get(host, {})
+        self.limit = float(learned.get('limit', initial))
+        self.limit = min(max(self.limit, min_limit), self.max_limit)
+
+        self.active = 0
+        self.epoch = 0
+        self.history = []  # (time, limit, reason)
+        self._cond = threading.Condition()
+        self._latency = None
+        self._min_latency = None
+        self._last_rate = None
+        self._reset_window()
+
+    def __repr__(self):
+        return (
+            f'{self.__class__.__name__}({self.host}, limit={self.limit:.1f}, '
+            f'active={self.active})'
+        )
+
+    def _reset_window(self):
+        self._window_t0 = time.perf_counter()
+        self._window_bytes = 0
+        self._window_files = 0
+
+    def _set_limit(self, limit, reason):
+        limit = min(max(limit, self.min_limit), self.max_limit)
+        if limit != self.limit:
+            self.history += ((time.time(), limit, reason),)
+        self.limit = limit
+        self.epoch += 1
+        self._reset_window()
+        self._cond.notify_all()
+
+    def try_acquire(self):
+        """
+        Takes a download slot if one is free. Returns the epoch of the limit
+        (pass it to overload) or None if all slots are in use.
+        """
+        with self._cond:
+            if self.active < int(self.limit):
+                self.active += 1
+                return self.epoch
+        return None
+
+    def acquire(self):
+        """waits for a free download slot and returns the epoch"""
+        with self._cond:
+            while self.active >= int(self.limit):
+                self._cond.wait()
+            self.active += 1
+            return self.epoch
+
+    def release(self):
+        with self._cond:
+            self.active -= 1
+            self._cond.notify()
+
+    def success(self, seconds, nbytes, latency=None):
+        """
+        Reports a downloaded file.
+
+        Parameters
+        ==========
+        seconds: float
+            the time that the download took
+        nbytes: int
+            the size of the file
+        latency: float
+            the time to the first byte (defaults to seconds)
+        """
+        latency = seconds if latency is None else latency
+        with self._cond:
+            if self._latency is None:
+                self._latency = latency
+            self._latency = 0.8 * self._latency + 0.2 * latency
+            if self._min_latency is None:
+                self._min_latency = latency
+            self._min_latency = min(self._min_latency, latency)
+
+            self._window_bytes += nbytes
+            self._window_files += 1
+            if self._window_files < max(int(self.limit), 2):
+                return
+
+            elapsed = time.perf_counter() - self._window_t0
+            rate = self._window_bytes / max(elapsed, 1e-9)
+            threshold = self.latency_factor * self._min_latency
+            if (self._min_latency > 0) and (self._latency > threshold):
+                self._set_limit(self.limit * self.decrease, 'latency')
+                self._latency = self._min_latency
+            elif (self._last_rate is None) or (
+                rate > self._last_rate * (1 + self.improvement)
+            ):
+                self._set_limit(self.limit + self.increase, 'throughput')
+            else:
+                self._reset_window()
+            self._last_rate = rate
+
+    def overload(self, epoch):
+        """
+        Reports a refused connection or request. The limit is decreased only
+        once per epoch, so that a burst of refusals of downloads that were
+        started with the same limit counts as one.
+        """
+        with self._cond:
+            if epoch >= self.epoch:
+                self._last_rate = None
+                self._set_limit(self.limit * self.decrease, 'overload')
+
+    def save(self):
+        """remembers the limit of the host for the next session"""
+        if self.store is not None:
+            self.store[self.host] = dict(
+                limit=round(self.limit, 2),
+                updated=time.strftime('%Y-%m-%dT%H:%M:%S'),
+            )
@@ -6,6 +6,7 @@ from importlib import import_module
 import validators
 from schema import And, Optional, Or, Schema, Use
 
+from .storage import parse_size
 from .utils import URL, Path
 
 
@@ -49,6 +50,8 @@ def check_datepaths(record):
     )
 
     paths = [record['remote']['url'], record['local_store']]
+    for mirror in record['remote'].get('mirrors', []):
+        paths += (mirror if isinstance(mirror, str) else mirror['url'],)
 
     if 'pipelines' in record:
         for key in record['pipelines']:
@@ -116,6 +119,13 @@ def read_catalog(catalog_fname):
     return validated
 
 
+mirror_schema = {
+    'url': Use(URL),
+    Optional('username'): str,
+    Optional(Or('service', 'password', only_one=True)): str,
+    Optional('port'): int,
+}
+
 schema = Schema(
     {
         'description': And(
@@ -134,8 +144,72 @@ schema = Schema(
             Optional('username'): str,
             Optional(Or('service', 'password', only_one=True)): str,
             Optional('port'): int,
+            # other servers with the same files (see routing.py): URL
+            # templates or blocks with a url and their own login
+            Optional('mirrors'): [Or(And(str, Use(URL)), mirror_schema)],
+            # a read-through cache of another node (`brewery serve`, see
+            # serve.py): files are downloaded from the cache, not the url
+            Optional('cache'): And(str, Use(URL)),
+            # the upper limit of connections with njobs='auto'
+            Optional('max_connections'): int,
+            # retries of transient errors and the wait before the first
+            Optional('retries'): int,
+            Optional('retry_backoff'): Or(int, float),
+            # bytes per read from the server (default 1 MiB)
+            Optional('buffer_size'): int,
+            # seconds that directory listings are cached (default 300)
+            Optional('listing_ttl'): Or(int, float),
+            # leases of local files shared by several processes: seconds
+            # until a lease that is not renewed is stale (0: no leases) and
+            # seconds to wait for a file that another process downloads
+            Optional('lease_ttl'): Or(int, float),
+            Optional('lease_timeout'): Or(int, float),
+            # HTTP, FTP and S3: byte ranges per file that are downloaded at
+            # the same time and the minimum bytes per range (default 64 MiB)
+            Optional('segments'): int,
+            Optional('segment_size'): int,
+            # SFTP only: bytes per read request (at most 32 KiB), read
+            # requests in flight, SSH window in bytes and SFTP channels per
+            # connection
+            Optional('request_size'): int,
+            Optional('max_requests'): int,
+            Optional('window_size'): int,
+            Optional('channels'): int,
+            # HTTP only: read directory index pages (default true)
+            Optional('directory_index'): bool,
+            # HTTP only: seconds to wait for a connection and for data, one
+            # number or [connect, read] (default 60)
+            Optional('timeout'): Or(int, float, [Or(int, float)]),
+            # S3 only: the endpoint of S3 compatible stores (e.g. MinIO),
+            # the region, HTTP connections per client and keys per listing
+            Optional('endpoint_url'): str,
+            Optional('region'): str,
+            Optional('max_pool_connections'): int,
+            Optional('page_size'): int,
+            # Climate Data Store only: number of requests in the CDS queue
+            # at the same time and the maximum seconds between state polls
+            Optional('max_in_flight'): int,
+            Optional('poll_interval'): Or(int, float),
+            # CDS request: variable names, hours (list or step in hours),
+            # area [N, W, S, E], grid [dlat, dlon] and the size limit
+            Optional('variables'): [str],
+            Optional('hours'): Or(int, [Or(int, str)]),
+            Optional('area'): And([Or(int, float)], lambda a: len(a) == 4),
+            Optional('grid'): Or(int, float, [Or(int, float)]),
+            Optional('product_type'): str,
+            Optional('max_fields'): int,
         },
         'local_store': Use(Path),
+        # a quota of the local_store (see storage.py): the most bytes (e.g.
+        # 500 GB), the files that are removed first (least recently or
+        # least frequently used), [start, end] dates that are never removed
+        # and a name that records share the quota with
+        Optional('storage'): {
+            'quota': Or(int, And(str, Use(parse_size))),
+            Optional('policy'): Or('lru', 'lfu'),
+            Optional('pinned'): [And([Use(str)], lambda r: len(r) == 2)],
+            Optional('pool'): str,
+        },
         Optional('pipelines'): {
             str: {
                 'data_path': Use(Path, error='data_path must be a valid path'),
@@ -70,6 +70,9 @@ class Catalog:
         from .config import read_catalog
 
         self.verbose = verbose
+        self.catalog_file = str(catalog_file)
+        # record name: the error that stopped the record in the last sync
+        self.sync_errors = {}
         self._config_dict = read_catalog(catalog_file)
         self._create_records()
         self.VARS = VariableAccess(self)
@@ -77,11 +80,138 @@ class Catalog:
     def _create_records(self):
         """
         Runs through the catalog dictionary (YAML file)
-        and creates an instance for each catalog entry (record)
+        and creates an instance for each catalog entry (record). Records
+        with a storage quota get their budget (see storage.py)
         """
+        from .storage import make_budgets
+
         for key in self._config_dict.keys():
-            record = Record(key, self._config_dict[key], verbose=self.verbose)
+            record = Record(
+                key,
+                self._config_dict[key],
+                verbose=self.verbose,
+                catalog_file=self.catalog_file,
+            )
             setattr(self, key, record)
+        make_budgets([getattr(self, key) for key in self._config_dict])
+
+    def sync(
+        self,
+        dates,
+        records=None,
+        max_connections=8,
+        per_host=None,
+        priorities=None,
+        mirror=False,
+    ):
+        """
+        Downloads the files of several records together. Files from all
+        records are interleaved in one scheduler with a shared pool of
+        connections, so that idle time on one host is filled with work for
+        another host (see scheduler.SyncScheduler). Records with mirrors
+        are downloaded on their own from the fastest mirror, with
+        `per_host` connections per mirror (see Record.download_data).
+
+        Parameters
+        ==========
+        dates: date-like string or object
+            the dates to download (see Record.download_data)
+        records: list
+            names of the records to sync, defaults to all records
+        max_connections: int
+            the total number of connections
+        per_host: int, dict or 'auto'
+            the maximum number of connections per host, or a dictionary
+            of host: limit (host:port if the remote has a port). With
+            'auto' the limits adapt to the servers
+        priorities: dict
+            record name: weight (default 1). Records with a larger weight
+            get a larger share of the connections
+        mirror: bool
+            download existing files again if the remote file has changed
+            (see Record.download_data)
+
+        Returns
+        =======
+        results: dict
+            record name: download results of the record. The errors that
+            stopped records are kept in `sync_errors`
+        """
+        from .scheduler import sync
+
+        names = list(self._config_dict) if records is None else records
+        records = [getattr(self, name) for name in names]
+        self._print(
+            f'Syncing {len(records)} records with {max_connections} '
+            'connections'
+        )
+        results, self.sync_errors = sync(
+            records,
+            dates,
+            max_connections=max_connections,
+            per_host=per_host,
+            priorities=priorities,
+            mirror=mirror,
+        )
+
+        for name in names:
+            counts = {k: len(v) for k, v in results[name].items()}
+            self._print(f'{name: <15} {counts}')
+
+        return results
+
+    def plan(self, dates, records=None, connections=4, validate=False):
+        """
+        Shows what a sync would do without downloading anything (dry run).
+        Local directories are scanned once each and remote directories are
+        listed concurrently (and cached), see planner.py.
+
+        Parameters
+        ==========
+        dates: date-like string or object
+            the dates to plan (see Record.download_data)
+        records: list
+            names of the records, defaults to all records
+        connections: int
+            the number of connections per record used for listings
+        validate: bool
+            opens existing local files to check that they are valid
+            (slower). By default a file exists if it is not empty
+
+        Returns
+        =======
+        plan: pandas.DataFrame
+            a row per file with record, host, remote, local, state
+            (local_exists, missing, remote_not_exist or unknown),
+            local_bytes and expected_bytes
+        """
+        from .planner import plan
+
+        names = list(self._config_dict) if records is None else records
+        records = [getattr(self, name) for name in names]
+        table = plan(records, dates, connections, validate)
+
+        if self.verbose >= 1:
+            summary = table.groupby(['record', 'state']).size()
+            print(summary.unstack(fill_value=0))
+
+        return table
+
+    def _print(self, *msg):
+        if self.verbose >= 1:
+            print(*msg)
+
+    @property
+    def metrics(self):
+        """
+        Download metrics of all records in the catalog. Use
+        `metrics.summary(by='host')` to aggregate or `metrics.to_prometheus`
+        to export for monitoring.
+        """
+        from .metrics import DownloadMetrics
+
+        records = [getattr(self, key) for key in self._config_dict]
+        return DownloadMetrics.concat([r.metrics for r in records])
 
     def __str__(self):
         import re
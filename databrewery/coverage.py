@@ -0,0 +1,217 @@
+"""
+What is known to be missing on the remote servers, kept between sessions.
+
+Remote files that did not exist are kept in a negative cache per record
+(MissingCache), so that the same missing dates are not probed again in
+every session. The entries expire after a while, because near real time
+products fill their gaps later.
+
+The temporal coverage of a record (the first and last date with a remote
+file) is found from directory listings (discover_coverage) and stored with
+an expiry time. Requested dates outside the coverage are skipped before
+connecting, e.g. the hundreds of dates past the end of a product that an
+open ended slice (`slice('2000', None)`) asks for.
+"""
+import time
+
+MISSING_TTL = 86400
+COVERAGE_TTL = 86400
+
+
+class MissingCache:
+    """
+    remote path: time when it was found missing, for the files of a record
+    """
+
+    def __init__(self, name, ttl=MISSING_TTL, port=None):
+        """
+        Parameters
+        ==========
+        name: str
+            the record name (the file is missing_<name>.json)
+        ttl: float
+            seconds after which a missing file is probed again
+        port: int
+            the port of the server if it is not in the URLs
+        """
+        from .state import JSONStore
+
+        self.name = name
+        self.ttl = ttl
+        self.port = port
+        self.store = JSONStore(f'missing_{name}.json')
+
+    def _key(self, remote):
+        """the URL with the port (servers on other ports are different)"""
+        from urllib.parse import urlparse
+
+        url = urlparse(str(remote))
+        if (self.port is None) or (url.port is not None):
+            return str(remote)
+        return url._replace(netloc=f'{url.netloc}:{self.port}').geturl()
+
+    def __repr__(self):
+        return f'{self.__class__.__name__}({self.name}, n={len(self)})'
+
+    def __len__(self):
+        return len([k for k in self.store if not self._expired(k)])
+
+    def _expired(self, key):
+        return time.time() - self.store[key] >= self.ttl
+
+    def __contains__(self, remote):
+        key = self._key(remote)
+        return (key in self.store) and not self._expired(key)
+
+    def add(self, remotes):
+        now = time.time()
+        remotes = {self._key(r): now for r in remotes}
+        if remotes:
+            self.store.update(remotes)
+
+    def discard(self, remotes):
+        self.store.discard([self._key(r) for r in remotes])
+
+    def prune(self):
+        """removes the expired entries"""
+        self.store.discard([k for k in self.store if self._expired(k)])
+
+    def clear(self):
+        self.store.discard(list(self.store))
+
+
+def get_coverage(name, ttl=COVERAGE_TTL):
+    """
+    The stored coverage of a record or None if it is unknown or older than
+    `ttl` seconds. See discover_coverage.
+    """
+    from .state import JSONStore
+
+    coverage = JSONStore('coverage.json').get(name, None)
+    if coverage is None:
+        return None
+    if time.time() - coverage['checked'] >= ttl:
+        return None
+    return coverage
+
+
+def clip_dates(dates, coverage):
+    """
+    Splits the dates into those inside and outside of the coverage. The
+    start (end) only clips if files were missing at the start (end) of the
+    dates that were searched, otherwise the coverage may be longer.
+
+    Returns
+    =======
+    inside, outside: pandas.DatetimeIndex
+    """
+    import pandas as pd
+    from .utils import get_dates
+
+    dates = get_dates(dates)
+    if isinstance(dates, pd.Timestamp):
+        dates = pd.DatetimeIndex([dates])
+    if coverage is None:
+        return dates, dates[:0]
+
+    outside = dates != dates
+    if coverage['start'] is None:
+        pass
+    elif coverage['start'] > coverage['first']:
+        outside |= dates < pd.Timestamp(coverage['start'])
+    if coverage['end'] is None:
+        # nothing was found in the searched dates
+        first, last = [pd.Timestamp(coverage[k]) for k in ['first', 'last']]
+        outside |= (dates >= first) & (dates <= last)
+    elif coverage['end'] < coverage['last']:
+        outside |= dates > pd.Timestamp(coverage['end'])
+    return dates[~outside], dates[outside]
+
+
+def discover_coverage(record, dates, max_age=600):
+    """
+    Finds the first and last of the dates that have a remote file. The
+    directories of the dates are listed from the start until a file is
+    found and from the end until a file is found, so that usually only a
+    few directories are listed. Listings are cached (see
+    planner.cached_listing).
+
+    Parameters
+    ==========
+    record: Record
+        a record with a remote that can be listed (FTP, SFTP and HTTP
+        with directory index pages)
+    dates: date-like string or object
+        the dates to search (see Record.download_data)
+    max_age: float
+        the maximum age in seconds of cached listings
+
+    Returns
+    =======
+    coverage: dict
+        start and end (the first and last date found, None if no files
+        were found), first and last (the dates that were searched) and
+        checked (the time of the search). None if the remote cannot be
+        listed.
+    """
+    import os
+    from urllib.parse import urlparse
+    from .planner import cached_listing, _match
+    from .state import JSONStore
+
+    dates = clip_dates(dates, None)[0].sort_values()
+    remote_url = record.config.remote.url
+    if not len(dates):
+        return None
+
+    # the remote path of each date, grouped by directory in date order
+    groups = []
+    for date in dates:
+        path = urlparse(str(remote_url.format(t=date))).path
+        directory = os.path.dirname(path)
+        if groups and (groups[-1][0] == directory):
+            groups[-1][1].append((date, path))
+        else:
+            groups.append((directory, [(date, path)]))
+
+    downloader = record._initiate_connection()
+    downloader.verbose = 0
+    try:
+        if not downloader.listable:
+            return None
+
+        def found(group):
+            directory, date_paths = group
+            listing = cached_listing(downloader, directory, max_age)
+            return [d for d, p in date_paths if _match(listing, p)[0]]
+
+        start, end = None, None
+        for group in groups:
+            dates_found = found(group)
+            if dates_found:
+                start = dates_found[0]
+                break
+        if start is not None:
+            for group in groups[::-1]:
+                dates_found = found(group)
+                if dates_found:
+                    end = dates_found[-1]
+                    break
+    except NotImplementedError:
+        # HTTP servers without index pages
+        return None
+    finally:
+        downloader.close_connection()
+
+    def iso(date):
+        return None if date is None else date.isoformat()
+
+    coverage = dict(
+        start=iso(start),
+        end=iso(end),
+        first=iso(dates[0]),
+        last=iso(dates[-1]),
+        checked=time.time(),
+    )
+    JSONStore('coverage.json')[record.name] = coverage
+    return coverage
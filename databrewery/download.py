@@ -1,8 +1,36 @@
 import os
+import threading
+import time
 import warnings
+from html.parser import HTMLParser
+
+from .lease import LEASE_TIMEOUT, LEASE_TTL
+from .metrics import STATUS_NAMES, DownloadMetrics, new_event
+from .utils import _netcdf_lock
 
 warnings.filterwarnings('ignore', category=DeprecationWarning)
 
+# the size of the transfer buffer of each connection
+DEFAULT_BUFFER_SIZE = 2 ** 20
+# the minimum seconds between updates of the progress bars
+PROGRESS_INTERVAL = 0.2
+# SFTP files are only split over several channels in segments of this size
+SFTP_MIN_SEGMENT = 8 * 2 ** 20
+# SFTP: paramiko sends read requests of at most 32 KiB
+SFTP_MAX_REQUEST = 2 ** 15
+# HTTP and FTP files are split into byte ranges of at least this size
+DEFAULT_SEGMENT_SIZE = 64 * 2 ** 20
+# seconds that a directory listing is cached on a connection
+LISTING_TTL = 300
+# HTTP: seconds to wait for the connection and between bytes of a response
+HTTP_TIMEOUT = 60
+
+# boto3 clients (with their connection pools) shared by the S3 downloaders
+_s3_clients = {}
+_s3_clients_lock = threading.Lock()
+# seek + write of write_at where os.pwrite is missing (Windows)
+_seek_lock = threading.Lock()
+
 
 class Downloader:
     """
@@ -16,6 +44,12 @@ class Downloader:
 
     _cache_flist = []
     _cache_dir = ''
+    # True if listdir_sizes gives the files in a remote directory
+    listable = False
+    # the number of byte ranges per file if `segments` is not given
+    default_segments = 1
+    # True if _read_range reads byte ranges, i.e. files can be split
+    segmentable = False
 
     def __init__(
         self,
@@ -24,6 +58,15 @@ class Downloader:
         service=None,
         password=None,
         verbose=2,
+        retries=3,
+        retry_backoff=1.0,
+        retry_overload=True,
+        manifest=None,
+        buffer_size=DEFAULT_BUFFER_SIZE,
+        segments=None,
+        segment_size=DEFAULT_SEGMENT_SIZE,
+        lease_ttl=LEASE_TTL,
+        lease_timeout=LEASE_TIMEOUT,
         **kwargs,
     ):
         """
@@ -41,9 +84,38 @@ class Downloader:
             the password, if service is not provided
         verbose: int
             the level of verbosity
+        retries: int
+            the number of times that a failed connection or download is
+            tried again (see retry.RetryPolicy)
+        retry_backoff: float
+            seconds to wait before the first retry (doubles every retry)
+        retry_overload: bool
+            if False, errors of an overloaded server (see
+            concurrency.is_overload_error) are raised without retrying, so
+            that the caller can reduce the number of connections
+        manifest: mirror.Manifest
+            mirror mode: existing local files are downloaded again if the
+            remote file changed since it was recorded in the manifest
+        buffer_size: int
+            bytes per read from the server. The buffer is allocated once
+            per connection and reused for all files
+        segments: int
+            HTTP, FTP and S3: files are downloaded in up to this many byte
+            ranges at the same time (see _download_segments). The default
+            is 8 for S3 and 1 (not split) otherwise
+        segment_size: int
+            the minimum bytes per range, i.e. only files of at least two
+            segment sizes are split
+        lease_ttl: float
+            seconds after which the lease of a local file is stale if its
+            holder stops renewing it (see lease.py). 0 downloads without
+            leases
+        lease_timeout: float
+            seconds to wait for a file that another process downloads
         **kwargs: keyword=value pairs
             passed on the the relevant connection initiater
         """
+        from .retry import RetryPolicy, get_breaker
 
         if (password is None) & (username is not None):
             from keyring import get_password, set_password
@@ -63,13 +135,93 @@ class Downloader:
 
         self._check_host_valid(host)
         self.verbose = verbose
-
-        self._method_init(host, username, password, **kwargs)
+        self.host = host
+        self.port = kwargs.get('port', None)
+
+        # metrics are collected per downloader and merged by the Record
+        self.metrics = DownloadMetrics()
+        self.queue_depth = 0
+        # the local file that is downloaded and the file that is written
+        self.current_file = None
+        self.current_local = None
+        self._event = new_event()
+
+        self.retry = RetryPolicy(retries, retry_backoff)
+        self.breaker = get_breaker(host)
+        self.retry_overload = retry_overload
+        self.manifest = manifest
+        self._last_stat = None
+        self.buffer_size = buffer_size
+        self._buffer = None
+        if segments is None:
+            segments = self.default_segments
+        self.segments = segments
+        self.segment_size = segment_size
+        self.lease_ttl = lease_ttl
+        self.lease_timeout = lease_timeout
+        self._login = (host, username, password, kwargs)
+
+        t0 = time.perf_counter()
+        self._connect()
+        self._connect_time = time.perf_counter() - t0
 
     def _method_init(self, host, username, password, **kwargs):
         """placehoder method for download sheme methods (FTP|SFTP|HTTP)"""
         pass
 
+    def _connect(self):
+        """connects to the server, retries if the error is transient"""
+        host, username, password, kwargs = self._login
+        attempt = 0
+        while True:
+            self.breaker.check()
+            try:
+                self._method_init(host, username, password, **kwargs)
+                return
+            except Exception as error:
+                if not self._should_retry(error, attempt):
+                    raise error
+                self._wait_to_retry(error, attempt, f'connect to {host}')
+                attempt += 1
+
+    def reconnect(self):
+        """closes the connection (if still open) and connects again"""
+        try:
+            self.close_connection()
+        except Exception:
+            pass  # the connection is probably broken already
+        self._cache_dir = ''
+        self._cache_flist = []
+        self._connect()
+
+    def _should_retry(self, error, attempt):
+        """
+        True if the error is transient and retries are left. Transient
+        errors count as failures of the host (see retry.CircuitBreaker),
+        also on the last attempt and with retries: 0.
+        """
+        from .concurrency import is_overload_error
+        from .lease import LeaseTimeout
+        from .retry import is_retryable
+
+        if is_overload_error(error) and not self.retry_overload:
+            return False
+        if isinstance(error, LeaseTimeout):
+            return False  # it waited long enough
+        if not is_retryable(error):
+            return False
+        self.breaker.failure()
+        return attempt < self.retry.retries
+
+    def _wait_to_retry(self, error, attempt, action):
+        wait = self.retry.delay(attempt)
+        self._print(
+            f'Retry {attempt + 1}/{self.retry.retries} in {wait:.1f} s '
+            f'to {action} ({type(error).__name__}: {error})',
+            lvl=1,
+        )
+        time.sleep(wait)
+
     def _check_host_valid(self, host):
         import re
 
@@ -88,6 +240,25 @@ class Downloader:
         """placeholder"""
         pass
 
+    def download_files(self, remote_local_files):
+        """
+        Downloads several files on this connection.
+
+        Parameters
+        ==========
+        remote_local_files: list
+            pairs of (remote, local) paths
+
+        Yields
+        ======
+        (remote, local, status_code) for each file in the order that the
+        files finish (see download_file for the status codes)
+        """
+        n_files = len(remote_local_files)
+        for i, (remote, local) in enumerate(remote_local_files):
+            self.queue_depth = n_files - i - 1
+            yield remote, local, self.download_file(remote, local)
+
     def download_file(self, remote, local):
         """
         Downloads a file at the given remote url and saves locally
@@ -105,28 +276,291 @@ class Downloader:
             0: downloaded
             1: remote file does not exist
             2: file exists locally
+            3: updated (mirror mode: the remote file changed)
+            4: failed (the CDS request of the file failed)
+
+        Transient errors are retried after reconnecting (see retry.py).
+        Raises retry.HostUnavailable if the host keeps failing.
+        """
+        attempt = 0
+        while True:
+            self.breaker.check()
+            self._start_event(remote, local)
+            self._event['retries'] = attempt
+            try:
+                status = self._download_file(remote, local)
+            except (Exception, KeyboardInterrupt) as error:
+                self._finish_event(None, local, error=error)
+                if not self._should_retry(error, attempt):
+                    raise error
+                # partially downloaded file
+                partial = self.current_local
+                if (partial is not None) and os.path.isfile(partial):
+                    os.remove(partial)
+                self.current_local = None
+                action = f'download {shorten_path_for_print(local)}'
+                self._wait_to_retry(error, attempt, action)
+                attempt += 1
+                self.reconnect()
+                continue
+            self._finish_event(status, local)
+            self.breaker.success()
+
+            return status
+
+    def _download_file(self, remote, local):
+        """
+        Downloads the file unless it exists. Other processes that download
+        to the same local_store are kept out with a lease (see lease.py):
+        a process that finds the file leased waits for it.
         """
+        from .lease import Lease
+
         slocal = shorten_path_for_print(local)
-        if self.is_local_file_valid(local):
+        exists = self.is_local_file_valid(local)
+        if exists and (self.manifest is None):
             self._print(f'File exists locally: {slocal}', lvl=2)
             return 2
-
-        remote = self.get_remote_pathname_match(remote)
-        if remote is None:
-            return 1
+        # the valid local file must not be removed if the update fails
+        self.current_local = None
 
         # making local directory
         local_dir = os.path.split(local)[0]
         os.makedirs(local_dir, exist_ok=True, mode=511)
 
-        description = f'Downloading {slocal}'
+        if not self.lease_ttl:
+            return self._download_unleased(remote, local, exists)
+        lease = Lease(local, ttl=self.lease_ttl)
+        lease.acquire(self.lease_timeout)
+        try:
+            # another process may have downloaded the file since the check
+            # above, also if the lease was free by then
+            exists = exists or self.is_local_file_valid(local)
+            if exists and (self.manifest is None):
+                self._print(f'File exists locally: {slocal}', lvl=2)
+                return 2
+            return self._download_unleased(remote, local, exists)
+        finally:
+            lease.release()
+
+    def _download_unleased(self, remote, local, exists):
+        """
+        Downloads the file to a temporary file next to it that replaces
+        the local file once it is complete, so that other processes never
+        see a partial file.
+        """
+        slocal = shorten_path_for_print(local)
+        t0 = time.perf_counter()
+        remote = self.get_remote_pathname_match(remote)
+        self._event['listing'] = time.perf_counter() - t0
+        if remote is None:
+            return 2 if exists else 1
+
+        stat = None
+        if exists:
+            stat = self.remote_stat(remote)
+            size = os.path.getsize(local)
+            if not self.manifest.changed(local, stat, size):
+                self._print(f'File exists locally: {slocal}', lvl=2)
+                self.manifest.record(local, remote, stat)
+                return 2
+            # the new version replaces the local file once it is complete
+            target = f'{local}.brew-update'
+            description = f'Updating {slocal}'
+        else:
+            target = f'{local}.brew-download'
+            description = f'Downloading {slocal}'
+
+        self.current_local = target
+        # the metadata of the remote file, if it is known already
+        self._last_stat = stat
         if int(self.verbose) >= 2:
-            out = self._vdownload(remote, local, description)
+            out = self._vdownload(remote, target, description)
         else:
             self._print(description, lvl=1)
-            out = self._qdownload(remote, local)
+            out = self._qdownload(remote, target)
+
+        if out != 0:
+            return out
+        os.replace(target, local)
+        self.current_local = None
+        if exists:
+            out = 3
+        if self.manifest is not None:
+            stat = self._last_stat or stat or self.remote_stat(remote)
+            self.manifest.record(local, remote, stat)
         return out
 
+    def remote_stat(self, remote):
+        """
+        The size, modification time and ETag of a remote file (see
+        mirror.new_stat). None if the file does not exist or the protocol
+        does not give the metadata.
+        """
+        return None
+
+    def _start_event(self, remote, local):
+        """creates the metrics event for the file that is downloaded"""
+        from urllib.parse import urlparse
+
+        url = urlparse(str(remote))
+        self._event = new_event(
+            host=url.netloc or self.host,
+            scheme=url.scheme,
+            remote=str(remote),
+            local=str(local),
+            queue_depth=self.queue_depth,
+            connect=self._connect_time,
+        )
+        # connection time is only counted for the first file
+        self._connect_time = 0.0
+        self._event_t0 = time.perf_counter()
+        self.current_file = str(local)
+        self.current_local = str(local)
+
+    def _mark_first_byte(self):
+        if self._event['first_byte'] is None:
+            t1 = time.perf_counter()
+            self._event['first_byte'] = t1 - self._event_t0
+
+    def _finish_event(self, status, local, error=None):
+        event = self._event
+        event['total'] = time.perf_counter() - self._event_t0
+        if error is not None:
+            event['status'] = 'error'
+            event['error'] = type(error).__name__
+        else:
+            event['status'] = STATUS_NAMES.get(status, str(status))
+            self.current_local = None
+        if (status in (0, 3)) and os.path.isfile(local):
+            event['bytes'] = os.path.getsize(local)
+        self.metrics.add(event)
+
+    def _writer(self, fd, pbar=None):
+        """
+        returns a callback that writes chunks to the open file `fd` and
+        marks the arrival of the first byte for the download metrics.
+        write.flush() shows the remaining bytes on the progress bar.
+        """
+        event = self._event
+        progress = Progress(pbar)
+
+        def write(data):
+            if event['first_byte'] is None:
+                self._mark_first_byte()
+            progress.update(len(data))
+            fd.write(data)
+
+        write.flush = progress.flush
+        return write
+
+    def _copy_stream(self, source, fd, pbar=None):
+        """
+        Copies a stream to the open file `fd`. Sockets (recv_into) and
+        streams with readinto are read into the buffer of the connection,
+        so that no memory is allocated per chunk.
+
+        Returns
+        =======
+        nbytes: int
+            the number of bytes copied
+        """
+        if self._buffer is None:
+            self._buffer = memoryview(bytearray(self.buffer_size))
+        buffer = self._buffer
+        readinto = getattr(source, 'readinto', None) or source.recv_into
+
+        progress = Progress(pbar)
+        nbytes = 0
+        while True:
+            n = readinto(buffer)
+            if not n:
+                break
+            if nbytes == 0:
+                self._mark_first_byte()
+            fd.write(buffer[:n])
+            nbytes += n
+            progress.update(n)
+        progress.flush()
+        return nbytes
+
+    def _segment_ranges(self, size):
+        """
+        The byte ranges [start, stop) of a segmented download of `size`
+        bytes or None if the file is not split.
+        """
+        if (not self.segmentable) or (self.segments <= 1) or not size:
+            return None
+        nsegments = min(self.segments, size // self.segment_size)
+        if nsegments < 2:
+            return None
+        bounds = [size * i // nsegments for i in range(nsegments + 1)]
+        return list(zip(bounds[:-1], bounds[1:]))
+
+    def _download_segments(self, remote, local, size, ranges, pbar=None):
+        """
+        Downloads the byte ranges of a file at the same time, each with
+        `self._read_range` on its own connection. The ranges are written
+        with write_at into a preallocated partial file (local.brew-part),
+        which replaces `local` once all bytes arrived. Returns None (and
+        removes the partial file) if the server does not give ranges.
+        """
+        import threading
+        from concurrent.futures import ThreadPoolExecutor
+        from .retry import IncompleteDownload
+
+        partial = f'{local}.brew-part'
+        self.current_local = partial
+        progress = Progress(pbar)
+        lock = threading.Lock()
+        failed = threading.Event()
+
+        def update(nbytes):
+            if failed.is_set():
+                raise IncompleteDownload(f'{remote}: another range failed')
+            with lock:
+                self._mark_first_byte()
+                progress.update(nbytes)
+
+        def read_range(start, stop, fd):
+            try:
+                return self._read_range(remote, start, stop, fd, update)
+            except BaseException:
+                failed.set()
+                raise
+
+        with open(partial, 'wb') as file:
+            fd = file.fileno()
+            preallocate(fd, size)
+            with ThreadPoolExecutor(max_workers=len(ranges)) as pool:
+                futures = [
+                    pool.submit(read_range, start, stop, fd)
+                    for start, stop in ranges
+                ]
+                nbytes = [future.result() for future in futures]
+        progress.flush()
+        if None in nbytes:
+            os.remove(partial)
+            self.current_local = local
+            return None
+
+        for (start, stop), n in zip(ranges, nbytes):
+            if n != stop - start:
+                raise IncompleteDownload(
+                    f'{remote}: received {n} of {stop - start} bytes '
+                    f'of the range at {start}'
+                )
+        os.replace(partial, local)
+        self.current_local = local
+        return sum(nbytes)
+
+    def _read_range(self, remote, start, stop, fd, update):
+        """
+        placeholder: reads bytes [start, stop) into `fd` and returns the
+        bytes read, None if the server ignored the range (see segmentable)
+        """
+        pass
+
     def get_remote_pathname_match(self, remote_path):
         """
         pass a filename with *?[] and returns any matching filename
@@ -176,6 +610,22 @@ class Downloader:
     def listdir(self, path):
         return [path]
 
+    def listdir_sizes(self, directory):
+        """
+        Lists the directory with the file sizes in bytes (None if the
+        protocol does not give the size in the listing).
+
+        Returns
+        =======
+        sizes: dict
+            path: size
+        """
+        return {path: None for path in self.listdir(directory)}
+
+    def remote_size(self, remote):
+        """the size of a remote file in bytes (None if unknown)"""
+        return None
+
     def _print(self, *msg, lvl=1):
         """
         process printer where verbosity is defined by set level
@@ -196,9 +646,13 @@ class Downloader:
 
         # has an opener been passed, if not assumes file is valid
         if local_path.endswith('.nc'):
-            from netCDF4 import Dataset as opener
+            from netCDF4 import Dataset
 
-            error = OSError
+            try:
+                with _netcdf_lock, Dataset(local_path):
+                    return True
+            except OSError:
+                return False
         elif local_path.endswith('.zip'):
             from zipfile import ZipFile as opener, BadZipFile as error
         else:
@@ -217,13 +671,27 @@ class FTP(Downloader):
     """
     creates a connection under `self.ftp`
     this connection can be closed
+
+    Directories are listed with MLSD where the server supports it and with
+    LIST otherwise, so that the size, modification time and type of all
+    files in a directory arrive in one round-trip. The metadata is cached
+    with the listing (see listdir_meta and remote_meta) and is used for the
+    progress bar and to check that downloads are complete.
     """
 
+    listable = True
+    segmentable = True
+    # False once the server did not know MLSD (kept when reconnecting)
+    _mlsd = True
+
     def _method_init(self, host, username, password, **kwargs):
         import ftplib
 
-        self.ftp = ftplib.FTP(host)
+        self.ftp = ftplib.FTP()
+        self.ftp.connect(host, kwargs.get('port', 21))
         self.ftp.login(username, password)
+        # directory: {path: metadata}, cleared when reconnecting
+        self._listings = ListingCache(kwargs.get('listing_ttl', LISTING_TTL))
 
     def _vdownload(self, remote, local, pbar_desc):
         from tqdm import tqdm
@@ -231,53 +699,539 @@ class FTP(Downloader):
 
         remote = urlparse(remote).path
 
-        with open(local, 'wb') as fd:
-            size = self.get_file_size(remote)
-            with tqdm(
-                total=size, desc=pbar_desc, unit='B', unit_scale=True
-            ) as pbar:
-
-                def cb(data):
-                    pbar.update(len(data))
-                    fd.write(data)
-
-                self.ftp.retrbinary('RETR {}'.format(remote), cb)
+        size = self.get_file_size(remote)
+        ranges = self._segment_ranges(size)
+        with tqdm(
+            total=size, desc=pbar_desc, unit='B', unit_scale=True
+        ) as pbar:
+            if ranges is not None:
+                self._download_segments(remote, local, size, ranges, pbar)
+                resp = '226'
+            else:
+                with open(local, 'wb') as fd:
+                    resp = self._retrieve(remote, fd, pbar)
+        self._event['status_code'] = int(resp[:3])
+        self._check_complete(remote, local)
         return 0
 
     def _qdownload(self, remote, local):
         from urllib.parse import urlparse
 
         remote = urlparse(remote).path
-        with open(local, 'wb') as fd:
-            self.ftp.retrbinary('RETR {}'.format(remote), fd.write)
+        size = self.remote_meta(remote, command=False).get('size')
+        ranges = self._segment_ranges(size)
+        if ranges is not None:
+            self._download_segments(remote, local, size, ranges)
+            resp = '226'
+        else:
+            with open(local, 'wb') as fd:
+                resp = self._retrieve(remote, fd)
+        self._event['status_code'] = int(resp[:3])
+        self._check_complete(remote, local)
         return 0
 
+    def _retrieve(self, remote, fd, pbar=None):
+        """
+        RETR of a file into the open file `fd`. Unlike ftplib.retrbinary
+        (8 KiB chunks, a new bytes object per chunk), the data connection
+        is read into the buffer of the connection. Returns the reply.
+        """
+        self.ftp.voidcmd('TYPE I')
+        with self.ftp.transfercmd(f'RETR {remote}') as conn:
+            self._copy_stream(conn, fd, pbar)
+        return self.ftp.voidresp()
+
+    def _read_range(self, remote, start, stop, fd, update):
+        """
+        Reads bytes [start, stop) of a file with REST and RETR. FTP has one
+        transfer per connection, so each range logs in on a new connection,
+        which is closed when the range is complete (aborting the transfer).
+        """
+        import ftplib
+
+        host, username, password, kwargs = self._login
+        ftp = ftplib.FTP()
+        try:
+            ftp.connect(host, kwargs.get('port', 21))
+            ftp.login(username, password)
+            ftp.voidcmd('TYPE I')
+            with ftp.transfercmd(f'RETR {remote}', rest=start) as conn:
+                return read_range_into(
+                    conn.recv_into,
+                    fd,
+                    start,
+                    stop - start,
+                    update,
+                    self.buffer_size,
+                )
+        finally:
+            ftp.close()
+
+    def _check_complete(self, remote, local):
+        """raises IncompleteDownload if the size differs from the listing"""
+        from .retry import IncompleteDownload
+
+        expected = self.remote_meta(remote, command=False).get('size')
+        size = os.path.getsize(local)
+        if (expected is not None) and (size != expected):
+            raise IncompleteDownload(
+                f'{remote}: received {size} of {expected} bytes'
+            )
+
     def listdir(self, directory='.'):
         """Will always list the directory, even if a file is given"""
-        from ftplib import error_reply, error_temp
+        meta = self.listdir_meta(directory)
+        return sorted(p for p, m in meta.items() if m['type'] == 'file')
+
+    def listdir_sizes(self, directory='.'):
+        meta = self.listdir_meta(directory)
+        return {p: m['size'] for p, m in meta.items() if m['type'] == 'file'}
+
+    def listdir_meta(self, directory='.'):
+        """
+        Lists the directory with metadata in one round-trip: MLSD (RFC
+        3659) if the server supports it, otherwise LIST. The listing is
+        cached for the connection.
+
+        Returns
+        =======
+        listing: dict
+            path: dict(type='file'|'dir', size=bytes, modify=unix time).
+            size and modify are None if the server does not give them
+        """
+        from ftplib import error_perm, error_reply, error_temp
+        from .concurrency import is_overload_error
+
+        if directory in self._listings:
+            return self._listings[directory]
 
         try:
-            flist = self.ftp.nlst(directory)
-            return sorted(flist)
-        except error_temp:
-            return []
+            if self._mlsd:
+                try:
+                    listing = self._list_mlsd(directory)
+                except error_perm as error:
+                    # 500/502: MLSD is not known, 550: no such directory
+                    if not str(error).startswith(('500', '502', '504')):
+                        raise error
+                    self._mlsd = False
+            if not self._mlsd:
+                listing = self._list_list(directory)
+        except error_perm:
+            # e.g. 550: the directory does not exist (yet), not cached
+            return {}
+        except error_temp as error:
+            # a busy server is not a missing directory
+            if is_overload_error(error):
+                raise error
+            return {}
         except BrokenPipeError:
             raise error_temp('Server timeout. Try restarting the connection')
         except error_reply:
-            return []
+            return {}
+
+        self._listings[directory] = listing
+        return listing
+
+    def _list_mlsd(self, directory):
+        import posixpath
+
+        listing = {}
+        facts = ['type', 'size', 'modify']
+        for name, fact in self.ftp.mlsd(directory, facts=facts):
+            kind = fact.get('type', 'file')
+            if kind in ('cdir', 'pdir'):
+                continue
+            size = fact.get('size', None)
+            path = posixpath.join(directory, name.split('/')[-1])
+            listing[path] = dict(
+                type='dir' if kind == 'dir' else 'file',
+                size=None if size is None else int(size),
+                modify=parse_mlsd_time(fact.get('modify', None)),
+            )
+        return listing
+
+    def _list_list(self, directory):
+        import posixpath
+
+        lines = []
+        self.ftp.retrlines(f'LIST {directory}', lines.append)
+        listing = {}
+        for line in lines:
+            entry = parse_list_line(line)
+            if (entry is None) or (entry['name'] in ('.', '..')):
+                continue
+            name = entry.pop('name').split('/')[-1]
+            listing[posixpath.join(directory, name)] = entry
+        return listing
+
+    def remote_meta(self, remote, command=True):
+        """
+        The metadata (type, size, modify) of a remote file from the cached
+        listing of its directory. If the file is not in the listing and
+        `command` is True, the size is asked with SIZE.
+        """
+        import posixpath
+        from urllib.parse import urlparse
 
-    def get_file_size(self, path):
+        path = urlparse(str(remote)).path
+        listing = self.listdir_meta(posixpath.dirname(path))
+        meta = listing.get(path, None)
+        if meta is not None:
+            return meta
+        if not command:
+            return {}
         self.ftp.sendcmd('TYPE i')
-        return self.ftp.size(path)
+        return dict(type='file', size=self.ftp.size(path), modify=None)
+
+    def get_file_size(self, path):
+        return self.remote_meta(path).get('size', None)
+
+    def remote_stat(self, remote):
+        from .mirror import new_stat
+
+        meta = self.remote_meta(remote, command=False)
+        if not meta:
+            return None
+        return new_stat(meta['size'], meta['modify'])
 
     def close_connection(self):
         self.ftp.close()
 
 
+def parse_mlsd_time(value):
+    """MLSD modify fact (YYYYMMDDHHMMSS[.sss], UTC) to unix time"""
+    import calendar
+
+    if not value:
+        return None
+    seconds = calendar.timegm(time.strptime(value[:14], '%Y%m%d%H%M%S'))
+    fraction = value[15:] if len(value) > 15 else '0'
+    return seconds + float('0.' + fraction)
+
+
+def parse_list_line(line, now=None):
+    """
+    Parses a line of a LIST reply in the unix (ls -l) or DOS format.
+    Returns a dict with name, type, size and modify (unix time, None if
+    not parsed) or None if the line is not understood.
+    """
+    import calendar
+    import re
+
+    unix = re.match(
+        r'^([\-dlbcps])[\w\-]{9}\S*\s+\d+\s+\S+\s+\S+\s+(\d+)\s+'
+        r'(\w{3}\s+\d{1,2}\s+(?:\d{1,2}:\d{2}|\d{4}))\s+(.+)$',
+        line,
+    )
+    if unix is not None:
+        kind, size, date, name = unix.groups()
+        if kind == 'l':  # symbolic link: name -> target
+            name = name.split(' -> ')[0]
+        date = ' '.join(date.split())
+        try:
+            if ':' in date:
+                # recent files have no year, but are not in the future
+                now = time.gmtime() if now is None else now
+                parsed = time.strptime(
+                    f'{now.tm_year} {date}', '%Y %b %d %H:%M'
+                )
+                modify = calendar.timegm(parsed)
+                if modify > calendar.timegm(now) + 86400:
+                    parsed = time.strptime(
+                        f'{now.tm_year - 1} {date}', '%Y %b %d %H:%M'
+                    )
+                    modify = calendar.timegm(parsed)
+            else:
+                modify = calendar.timegm(time.strptime(date, '%b %d %Y'))
+        except ValueError:
+            modify = None
+        return dict(
+            name=name,
+            type='dir' if kind == 'd' else 'file',
+            size=int(size),
+            modify=modify,
+        )
+
+    dos = re.match(
+        r'^(\d{2}-\d{2}-\d{2,4})\s+(\d{1,2}:\d{2}[AP]M)\s+'
+        r'(<DIR>|\d+)\s+(.+)$',
+        line,
+    )
+    if dos is not None:
+        date, clock, size, name = dos.groups()
+        fmt = '%m-%d-%y' if len(date) == 8 else '%m-%d-%Y'
+        try:
+            parsed = time.strptime(f'{date} {clock}', f'{fmt} %I:%M%p')
+            modify = calendar.timegm(parsed)
+        except ValueError:
+            modify = None
+        is_dir = size == '<DIR>'
+        return dict(
+            name=name,
+            type='dir' if is_dir else 'file',
+            size=None if is_dir else int(size),
+            modify=modify,
+        )
+
+    return None
+
+
+class ListingCache:
+    """
+    The directory listings of a connection. A listing expires after `ttl`
+    seconds, so that a long-lived connection sees files that are
+    published later.
+    """
+
+    def __init__(self, ttl=LISTING_TTL):
+        self.ttl = ttl
+        self._items = {}
+
+    def __contains__(self, directory):
+        item = self._items.get(directory, None)
+        if item is None:
+            return False
+        if time.time() - item[0] > self.ttl:
+            del self._items[directory]
+            return False
+        return True
+
+    def __getitem__(self, directory):
+        return self._items[directory][1]
+
+    def __setitem__(self, directory, listing):
+        self._items[directory] = time.time(), listing
+
+    def clear(self):
+        self._items.clear()
+
+
+class Progress:
+    """
+    Updates a progress bar at most every PROGRESS_INTERVAL seconds, so that
+    the progress bar does not slow down fast downloads.
+    """
+
+    def __init__(self, pbar, interval=PROGRESS_INTERVAL):
+        self.pbar = pbar
+        self.interval = interval
+        self.pending = 0
+        self.last = time.perf_counter()
+
+    def update(self, nbytes):
+        if self.pbar is None:
+            return
+        self.pending += nbytes
+        now = time.perf_counter()
+        if now - self.last >= self.interval:
+            self.flush()
+            self.last = now
+
+    def flush(self):
+        if (self.pbar is not None) and self.pending:
+            self.pbar.update(self.pending)
+            self.pending = 0
+
+
+def preallocate(fd, size):
+    """reserves `size` bytes for the open file descriptor `fd`"""
+    try:
+        os.posix_fallocate(fd, 0, size)
+    except (AttributeError, OSError):
+        # not on macOS and not supported by all file systems
+        os.ftruncate(fd, size)
+
+
+def write_at(fd, data, offset):
+    """
+    Writes data to the file descriptor `fd` at `offset` without moving the
+    position of other writers (os.pwrite, or seek and write under a lock)
+    """
+    if hasattr(os, 'pwrite'):
+        return os.pwrite(fd, data, offset)
+    with _seek_lock:
+        os.lseek(fd, offset, os.SEEK_SET)
+        return os.write(fd, data)
+
+
+def read_range_into(readinto, fd, offset, length, update, buffer_size):
+    """
+    Reads up to `length` bytes with `readinto` (e.g. socket.recv_into) and
+    writes them to the file descriptor `fd` at `offset` (see write_at), so
+    that several ranges can be written to one file at the same time.
+    `update` is called with the number of bytes of each chunk. Returns the
+    bytes read.
+    """
+    buffer = memoryview(bytearray(max(1, min(buffer_size, length))))
+    nbytes = 0
+    while nbytes < length:
+        chunk = min(len(buffer), length - nbytes)
+        n = readinto(buffer[:chunk])
+        if not n:
+            break
+        write_at(fd, buffer[:n], offset + nbytes)
+        nbytes += n
+        update(n)
+    return nbytes
+
+
+def urlparse_path(url):
+    """the (unquoted) path of a URL"""
+    from urllib.parse import unquote, urlparse
+
+    return unquote(urlparse(url).path)
+
+
+class _IndexParser(HTMLParser):
+    """collects the links of an HTML page and the text after each link"""
+
+    def __init__(self):
+        super().__init__()
+        self.links = []  # [href, link text, text after the link]
+        self._part = None
+
+    def handle_starttag(self, tag, attrs):
+        if tag == 'a':
+            href = dict(attrs).get('href', None)
+            if href:
+                self.links.append([href, '', ''])
+                self._part = 1
+        elif tag in ('tr', 'li'):
+            # the text of a row belongs to the link of the row
+            self._part = None
+
+    def handle_endtag(self, tag):
+        if (tag == 'a') and (self._part == 1):
+            self._part = 2
+
+    def handle_data(self, data):
+        if self._part is not None:
+            self.links[-1][self._part] += data
+
+
+def parse_index_page(page, directory, base=None):
+    """
+    Parses a directory index page (Apache or nginx autoindex, THREDDS
+    catalog or any page with links to the files).
+
+    Parameters
+    ==========
+    page: str
+        the HTML of the index page
+    directory: str
+        the path of the directory on the server
+    base: str
+        the path of the index page (relative links are resolved from it),
+        defaults to the directory
+
+    Returns
+    =======
+    listing: dict
+        path: dict(type, size, modify) for the files and subdirectories.
+        The size is in bytes if the index gives the exact size (nginx,
+        Apache with `-h`) and None if it is rounded (e.g. 1.2M). The
+        modification time is in unix time (UTC assumed), None if not given.
+    """
+    import posixpath
+    from urllib.parse import parse_qs, unquote, urljoin, urlparse
+
+    directory = directory.rstrip('/')
+    base = directory + '/' if base is None else base
+
+    parser = _IndexParser()
+    parser.feed(page)
+
+    listing = {}
+    for href, text, tail in parser.links:
+        link = urlparse(urljoin(base, href))
+        if link.query:
+            # THREDDS: catalog.html?dataset=<id>/<file name>
+            dataset = parse_qs(link.query).get('dataset', [''])[0]
+            name = posixpath.basename(dataset)
+            if (not name) or (name != text.strip()):
+                continue  # e.g. the sorting links of Apache
+            kind = 'file'
+        else:
+            path = unquote(link.path)
+            kind = 'dir' if path.endswith('/') else 'file'
+            parent, name = posixpath.split(path.rstrip('/'))
+            if (parent != directory) or (not name):
+                continue  # parent directory and links elsewhere
+        size, modify = _parse_index_details(tail)
+        listing[f'{directory}/{name}'] = dict(
+            type=kind, size=None if kind == 'dir' else size, modify=modify
+        )
+    return listing
+
+
+def _parse_index_details(text):
+    """the size (None if rounded) and modification time after a link"""
+    import calendar
+    import re
+
+    modify = None
+    formats = [
+        (r'\d{4}-\d{2}-\d{2}[ T]\d{2}:\d{2}:\d{2}', '%Y-%m-%d %H:%M:%S'),
+        (r'\d{4}-\d{2}-\d{2}[ T]\d{2}:\d{2}', '%Y-%m-%d %H:%M'),
+        (r'\d{2}-[A-Z][a-z]{2}-\d{4} \d{2}:\d{2}', '%d-%b-%Y %H:%M'),
+    ]
+    for pattern, fmt in formats:
+        match = re.search(pattern, text)
+        if match is not None:
+            date = match.group().replace('T', ' ')
+            try:
+                modify = calendar.timegm(time.strptime(date, fmt))
+            except ValueError:
+                pass
+            text = text.replace(match.group(), ' ')
+            break
+
+    size = None
+    match = re.search(
+        r'(?<![\w.:-])(\d+(?:\.\d+)?)\s*([kKMGT]?)(i?B|bytes)?(?![\w.:-])',
+        text,
+    )
+    if match is not None:
+        number, prefix, unit = match.groups()
+        if ('.' not in number) and (not prefix):
+            size = int(number)
+    return size, modify
+
+
 class SFTP(Downloader):
+    """
+    creates a connection under `self.sftp` (pysftp) for listings
+
+    Files are read with pipelined requests: up to `max_requests` read
+    requests of `request_size` bytes are in flight at the same time
+    (paramiko prefetch), so that the throughput is not limited to one
+    request per round-trip. Files larger than SFTP_MIN_SEGMENT are split
+    over `channels` SFTP channels that are opened on the same SSH
+    connection and read in parallel. These options can be set in the
+    remote block of the catalog.
+    """
+
+    listable = True
+
     def _method_init(self, host, username, password, **kwargs):
+        import inspect
+        import paramiko
         import pysftp
 
+        # max_concurrent_prefetch_requests of readv is new in paramiko 3.3,
+        # older versions send all read requests of a segment at once
+        readv = inspect.signature(paramiko.SFTPFile.readv)
+        self._readv_limit = len(readv.parameters) > 2
+
+        kwargs = kwargs.copy()
+        request_size = kwargs.pop('request_size', SFTP_MAX_REQUEST)
+        self.request_size = min(request_size, SFTP_MAX_REQUEST)
+        self.max_requests = kwargs.pop('max_requests', 64)
+        nchannels = kwargs.pop('channels', 1)
+        # the SSH window must hold all requests that are in flight
+        in_flight = self.request_size * self.max_requests
+        window_size = kwargs.pop('window_size', max(2 * in_flight, 2 ** 21))
+
         cnopts = pysftp.CnOpts()
         cnopts.hostkeys = None
         sftp_options = dict(
@@ -286,37 +1240,87 @@ class SFTP(Downloader):
         sftp_options.update(kwargs)
 
         self.sftp = pysftp.Connection(**sftp_options)
+        transport = self.sftp.sftp_client.get_channel().get_transport()
+        self.channels = [
+            paramiko.SFTPClient.from_transport(
+                transport, window_size=window_size
+            )
+            for _ in range(max(1, nchannels))
+        ]
 
     def _vdownload(self, remote, local, pbar_desc):
         from tqdm import tqdm
         from urllib.parse import urlparse
 
         remote = urlparse(remote).path
-
-        class TqdmWrap(tqdm):
-            def viewBar(self, a, b):
-                self.total = int(b)
-                self.update(int(a - self.n))  # update pbar with increment
-
-        with open(local, 'wb') as fd:
-            with TqdmWrap(desc=pbar_desc, unit='b', unit_scale=True) as pbar:
-
-                def cb(data):
-                    pbar.update(len(data))
-                    fd.write(data)
-
-                self.sftp.get(remote, local, callback=pbar.viewBar)
+        with tqdm(desc=pbar_desc, unit='B', unit_scale=True) as pbar:
+            self._get(remote, local, pbar)
         return 0
 
     def _qdownload(self, remote, local):
         from urllib.parse import urlparse
 
         remote = urlparse(remote).path
-        with open(local, 'wb'):
-            self.sftp.get(remote, local)
-            return
+        self._get(remote, local)
         return 0
 
+    def _get(self, remote, local, pbar=None):
+        """
+        Downloads the file with pipelined reads, in segments over several
+        channels if the file is large enough.
+        """
+        import threading
+        from concurrent.futures import ThreadPoolExecutor
+        from .retry import IncompleteDownload
+
+        size = self.channels[0].stat(remote).st_size
+        if pbar is not None:
+            pbar.total = size
+        nsegments = min(len(self.channels), size // SFTP_MIN_SEGMENT)
+        nsegments = max(1, nsegments)
+        bounds = [size * i // nsegments for i in range(nsegments + 1)]
+
+        progress = Progress(pbar)
+        lock = threading.Lock()
+
+        def read_segment(client, start, stop, fd):
+            nbytes = 0
+            with client.open(remote, 'rb') as source:
+                chunks = [
+                    (offset, min(self.request_size, stop - offset))
+                    for offset in range(start, stop, self.request_size)
+                ]
+                if self._readv_limit:
+                    blocks = source.readv(chunks, self.max_requests)
+                else:
+                    blocks = source.readv(chunks)
+                for (offset, length), data in zip(chunks, blocks):
+                    write_at(fd, data, offset)
+                    nbytes += len(data)
+                    with lock:
+                        self._mark_first_byte()
+                        progress.update(len(data))
+            return nbytes
+
+        with open(local, 'wb') as file:
+            fd = file.fileno()
+            if nsegments == 1:
+                nbytes = read_segment(self.channels[0], 0, size, fd)
+            else:
+                segments = zip(self.channels, bounds[:-1], bounds[1:])
+                with ThreadPoolExecutor(max_workers=nsegments) as pool:
+                    futures = [
+                        pool.submit(read_segment, client, start, stop, fd)
+                        for client, start, stop in segments
+                    ]
+                    nbytes = sum(future.result() for future in futures)
+        progress.flush()
+
+        if nbytes != size:
+            raise IncompleteDownload(
+                f'{remote}: {nbytes} of {size} bytes downloaded'
+            )
+
     def listdir(self, directory=''):
         """Will always list the directory, even if a file is given"""
         import os
@@ -328,24 +1332,92 @@ class SFTP(Downloader):
         except FileNotFoundError:
             return []
 
+    def listdir_sizes(self, directory=''):
+        import posixpath
+        import stat
+
+        try:
+            attrs = self.sftp.listdir_attr(directory)
+        except FileNotFoundError:
+            return {}
+        return {
+            posixpath.join(directory, a.filename): a.st_size
+            for a in attrs
+            if not stat.S_ISDIR(a.st_mode or 0)
+        }
+
     def get_file_size(self, path):
         return self.sftp.stat(path).st_size
 
+    def remote_stat(self, remote):
+        from urllib.parse import urlparse
+        from .mirror import new_stat
+
+        try:
+            attrs = self.sftp.stat(urlparse(str(remote)).path)
+        except FileNotFoundError:
+            return None
+        return new_stat(attrs.st_size, attrs.st_mtime)
+
     def close_connection(self):
+        for client in getattr(self, 'channels', []):
+            client.close()
         self.sftp.close()
 
 
 class HTTP(Downloader):
+    """
+    Downloads with GET requests.
+
+    HTTP has no directory listing, but most servers give an index page of
+    the directory (Apache and nginx autoindex, THREDDS catalogs). The index
+    page is read once per directory and cached (see listdir_meta). It is
+    used to resolve wildcards in the URL and to skip files that are not in
+    the index without requesting them. Servers without index pages are
+    asked for each file (set `directory_index: false` in the catalog to
+    not try).
+    """
+
+    listable = True
+    segmentable = True
+
     def _method_init(self, host, username, password, **kwargs):
         from requests.auth import HTTPBasicAuth
 
         self.auth = HTTPBasicAuth(username, password)
+        self.port = kwargs.get('port', None)
+        self.scheme = kwargs.get('scheme', 'https')
+        # directory: {path: metadata} or None if there is no index page
+        self._listings = ListingCache(kwargs.get('listing_ttl', LISTING_TTL))
+        self._index = kwargs.get('directory_index', True)
+        # (connect, read) seconds; a hung server raises a retryable Timeout
+        timeout = kwargs.get('timeout', HTTP_TIMEOUT)
+        if isinstance(timeout, (list, tuple)):
+            timeout = tuple(timeout)
+        self.timeout = timeout
+
+    def _with_port(self, remote):
+        """inserts the port number from the catalog into the URL"""
+        if self.port is None:
+            return remote
+
+        from urllib.parse import urlparse
+
+        url = urlparse(remote)
+        return url._replace(netloc=f'{url.hostname}:{self.port}').geturl()
 
     def _vdownload(self, remote, local, pbar_desc):
         import requests
         from tqdm import tqdm
 
-        req = requests.get(remote, auth=self.auth, stream=True)
+        if self._download_ranges(remote, local, pbar_desc) == 0:
+            return 0
+        url = self._with_port(remote)
+        req = requests.get(
+            url, auth=self.auth, stream=True, timeout=self.timeout
+        )
+        self._event['status_code'] = req.status_code
+        self._last_stat = self._stat_from_headers(req.headers)
         if req.status_code == 401:
             req.raise_for_status()
         elif req.status_code == 404:
@@ -354,20 +1426,24 @@ class HTTP(Downloader):
         elif not req.ok:
             req.raise_for_status()
 
-        step = 5 * 2 ** 10
         size = int(req.headers.get('content-length', 0))
         pbar = tqdm(desc=pbar_desc, total=size, unit='B', unit_scale=True)
         with open(local, 'wb') as f:
-            for data in req.iter_content(step):
-                pbar.update(len(data))
-                f.write(data)
+            self._copy_response(req, f, pbar)
         pbar.close()
         return 0
 
     def _qdownload(self, remote, local):
         import requests
 
-        req = requests.get(remote, auth=self.auth, stream=True)
+        if self._download_ranges(remote, local) == 0:
+            return 0
+        url = self._with_port(remote)
+        req = requests.get(
+            url, auth=self.auth, stream=True, timeout=self.timeout
+        )
+        self._event['status_code'] = req.status_code
+        self._last_stat = self._stat_from_headers(req.headers)
         if req.status_code == 401:
             req.raise_for_status()
         elif req.status_code == 404:
@@ -376,82 +1452,940 @@ class HTTP(Downloader):
         elif not req.ok:
             req.raise_for_status()
 
-        step = 5 * 2 ** 10
         with open(local, 'wb') as f:
-            for data in req.iter_content(step):
-                f.write(data)
+            self._copy_response(req, f)
         return 0
 
+    def _download_ranges(self, remote, local, pbar_desc=None):
+        """
+        Downloads the file in byte ranges (see Downloader._download_segments)
+        if segments are set, the file is large enough and the server accepts
+        ranges. Returns None if the file is not split, the GET request then
+        also handles missing files and errors.
+
+        The size comes from the known metadata of the file (_last_stat) or
+        else from a HEAD request, which is skipped if the exact size in the
+        index page is too small to split the file.
+        """
+        import requests
+        from tqdm import tqdm
+
+        if self.segments <= 1:
+            return None
+        stat = self._last_stat
+        if (stat is None) or (stat['size'] is None):
+            size = self._listed_size(remote)
+            if (size is not None) and (self._segment_ranges(size) is None):
+                return None
+            url = self._with_port(remote)
+            req = requests.head(
+                url, auth=self.auth, allow_redirects=True, timeout=self.timeout
+            )
+            if (not req.ok) or (req.headers.get('accept-ranges') != 'bytes'):
+                return None
+            stat = self._stat_from_headers(req.headers)
+        ranges = self._segment_ranges(stat['size'])
+        if ranges is None:
+            return None
+
+        self._event['status_code'] = 206
+        self._last_stat = stat
+        pbar = None
+        if pbar_desc is not None:
+            pbar = tqdm(
+                desc=pbar_desc, total=stat['size'], unit='B', unit_scale=True
+            )
+        try:
+            size = stat['size']
+            if self._download_segments(remote, local, size, ranges, pbar):
+                return 0
+        finally:
+            if pbar is not None:
+                pbar.close()
+        return None  # the server ignored the ranges
+
+    def _listed_size(self, remote):
+        """the exact size in the (cached) index page, None if not given"""
+        from urllib.parse import unquote
+
+        path = unquote(urlparse_path(str(remote)))
+        listing = self.listdir_meta(os.path.dirname(path)) or {}
+        return listing.get(path, {}).get('size', None)
+
+    def _read_range(self, remote, start, stop, fd, update):
+        """
+        reads bytes [start, stop) of a file with a Range request. Returns
+        None if the server ignored the range.
+        """
+        import requests
+
+        url = self._with_port(remote)
+        headers = {
+            'Range': f'bytes={start}-{stop - 1}',
+            'Accept-Encoding': 'identity',
+        }
+        with requests.get(
+            url,
+            auth=self.auth,
+            headers=headers,
+            stream=True,
+            timeout=self.timeout,
+        ) as req:
+            if not req.ok:
+                req.raise_for_status()
+            if req.status_code != 206:
+                # the file is downloaded in one stream
+                return None
+            return read_range_into(
+                req.raw.readinto,
+                fd,
+                start,
+                stop - start,
+                update,
+                self.buffer_size,
+            )
+
+    def _copy_response(self, req, fd, pbar=None):
+        """
+        Writes the body of a streamed response to `fd`. Unencoded bodies
+        are read from the raw stream into the buffer of the connection.
+        """
+        encoding = req.headers.get('content-encoding', 'identity')
+        if encoding == 'identity':
+            return self._copy_stream(req.raw, fd, pbar)
+        # gzip etc. are decoded by requests
+        write = self._writer(fd, pbar)
+        for data in req.iter_content(self.buffer_size):
+            write(data)
+        write.flush()
+
     def get_remote_pathname_match(self, remote_path):
-        return remote_path
+        """
+        Resolves wildcards with the index page of the directory and returns
+        None if the file is not in the index. Without an index page the URL
+        is returned unchanged.
+        """
+        from fnmatch import fnmatch
+        from urllib.parse import quote, unquote, urlparse
+
+        url = urlparse(str(remote_path))
+        path = unquote(url.path)
+        listing = self.listdir_meta(os.path.dirname(path))
+        if listing is None:
+            return remote_path
+
+        if path in listing:
+            matches = [path]
+        else:
+            files = [p for p, m in listing.items() if m['type'] == 'file']
+            matches = [p for p in files if fnmatch(p, path)]
+        if len(matches) == 1:
+            return url._replace(path=quote(matches[0])).geturl()
+
+        sremote = shorten_path_for_print(remote_path)
+        if matches:
+            msg = f'URL returns {len(matches)} matches: {sremote}'
+            self._print(msg, lvl=3)
+        else:
+            self._print(f'Remote file does not exist: {sremote}', lvl=3)
+        return None
+
+    def _index_url(self, directory):
+        """the URL of the index page of a directory"""
+        path = directory.rstrip('/') + '/'
+        # THREDDS lists the files of the file server in the catalog
+        if '/thredds/fileServer/' in path:
+            path = path.replace('/thredds/fileServer/', '/thredds/catalog/')
+            path += 'catalog.html'
+        netloc = self.host if self.port is None else f'{self.host}:{self.port}'
+        return f'{self.scheme}://{netloc}{path}'
+
+    def listdir_meta(self, directory):
+        """
+        Reads the index page of the directory. The listing is cached.
+
+        Returns
+        =======
+        listing: dict
+            path: dict(type, size, modify) (see parse_index_page), empty if
+            the directory does not exist and None if the server gives no
+            index page
+        """
+        import requests
+
+        directory = directory.rstrip('/')
+        if directory in self._listings:
+            return self._listings[directory]
+
+        listing = None
+        if self._index:
+            url = self._index_url(directory)
+            req = requests.get(url, auth=self.auth, timeout=self.timeout)
+            content_type = req.headers.get('content-type', '')
+            if req.status_code == 404:
+                listing = {}
+            elif (req.status_code == 429) or (req.status_code >= 500):
+                # transient, retried by download_file
+                req.raise_for_status()
+            elif req.ok and ('html' in content_type):
+                base = urlparse_path(req.url)
+                listing = parse_index_page(req.text, directory, base)
+            else:
+                # e.g. 403 Forbidden: indexes are switched off
+                self._index = False
+
+        self._listings[directory] = listing
+        return listing
+
+    def listdir(self, directory):
+        listing = self.listdir_meta(directory)
+        if listing is None:
+            return [directory]
+        return sorted(p for p, m in listing.items() if m['type'] == 'file')
+
+    def listdir_sizes(self, directory):
+        """
+        The files of the index page with the size in bytes (None unless the
+        index gives the exact size). Raises NotImplementedError if the
+        server gives no index page.
+        """
+        listing = self.listdir_meta(directory)
+        if listing is None:
+            raise NotImplementedError(f'{self.host} has no index pages')
+        files = [p for p, m in listing.items() if m['type'] == 'file']
+        return {p: listing[p]['size'] for p in files}
+
+    def remote_size(self, remote):
+        """
+        The size from the Content-Length of a HEAD request. Returns None if
+        the size is not given and -1 if the file does not exist.
+        """
+        stat = self.remote_stat(remote)
+        return -1 if stat is None else stat['size']
+
+    def remote_stat(self, remote):
+        """the metadata from the headers of a HEAD request"""
+        import requests
+
+        url = self._with_port(remote)
+        req = requests.head(
+            url, auth=self.auth, allow_redirects=True, timeout=self.timeout
+        )
+        if req.status_code == 404:
+            return None
+        elif not req.ok:
+            req.raise_for_status()
+        return self._stat_from_headers(req.headers)
+
+    @staticmethod
+    def _stat_from_headers(headers):
+        from email.utils import parsedate_to_datetime
+        from .mirror import new_stat
+
+        size = headers.get('content-length', None)
+        modify = headers.get('last-modified', None)
+        if modify is not None:
+            modify = parsedate_to_datetime(modify).timestamp()
+        # compressed transfers have the compressed length
+        if headers.get('content-encoding', 'identity') != 'identity':
+            size = None
+        return new_stat(
+            None if size is None else int(size),
+            modify,
+            headers.get('etag', None),
+        )
+
+
+class S3(Downloader):
+    """
+    Downloads objects from S3 and S3 compatible object stores (e.g. MinIO).
+    The URL is s3://bucket/key.
+
+    Prefixes are listed with paginated ListObjectsV2 requests, one
+    "directory" (delimiter /) at a time, and the listing is cached per
+    prefix with the size, modification time and ETag of the objects.
+    Large objects are read with ranged GETs at the same time (8 by
+    default, see Downloader._download_segments).
+
+    The boto3 client and its pool of HTTP connections are shared by all
+    downloaders with the same endpoint and credentials (see
+    get_s3_client). Without a username the requests are not signed (public
+    buckets, e.g. NOAA open data); otherwise the username is the access
+    key ID and the password (or keyring service) the secret key. The
+    remote block can set the endpoint_url, region, max_pool_connections
+    and page_size (keys per listing request).
+    """
+
+    listable = True
+    segmentable = True
+    default_segments = 8
+
+    def _method_init(self, host, username, password, **kwargs):
+        self.bucket = host
+        self.client = get_s3_client(
+            username,
+            password,
+            endpoint_url=kwargs.get('endpoint_url', None),
+            region=kwargs.get('region', None),
+            max_pool_connections=kwargs.get('max_pool_connections', 32),
+        )
+        self.page_size = kwargs.get('page_size', 1000)
+        # directory: {path: metadata}, cleared when reconnecting
+        self._listings = ListingCache(kwargs.get('listing_ttl', LISTING_TTL))
+
+    @staticmethod
+    def _key(remote):
+        """the object key of a URL or path"""
+        return urlparse_path(str(remote)).lstrip('/')
+
+    def _vdownload(self, remote, local, pbar_desc):
+        from tqdm import tqdm
+
+        with tqdm(desc=pbar_desc, unit='B', unit_scale=True) as pbar:
+            return self._get(remote, local, pbar)
+
+    def _qdownload(self, remote, local):
+        return self._get(remote, local)
+
+    def _get(self, remote, local, pbar=None):
+        """
+        Downloads an object, in ranges if it is large enough. The size is
+        checked against the listing.
+        """
+        from .mirror import new_stat
+        from .retry import IncompleteDownload
+
+        meta = self.remote_meta(remote)
+        if meta is None:
+            self._print(f'Object does not exist: {remote}', lvl=1)
+            return 1
+        size = meta['size']
+        if pbar is not None:
+            pbar.total = size
+        self._last_stat = new_stat(size, meta['modify'], meta['etag'])
+
+        ranges = self._segment_ranges(size)
+        if ranges is not None:
+            self._event['status_code'] = 206
+            self._download_segments(remote, local, size, ranges, pbar)
+        else:
+            response = self.client.get_object(
+                Bucket=self.bucket, Key=self._key(remote)
+            )
+            self._event['status_code'] = 200
+            with open(local, 'wb') as fd:
+                self._copy_stream(response['Body'], fd, pbar)
+
+        received = os.path.getsize(local)
+        if received != size:
+            raise IncompleteDownload(
+                f'{remote}: received {received} of {size} bytes'
+            )
+        return 0
+
+    def _read_range(self, remote, start, stop, fd, update):
+        """
+        reads bytes [start, stop) of the object with a ranged GET. The ETag
+        must match the listing, so that all ranges are of the same version
+        """
+        from botocore.exceptions import ClientError
+        from .retry import IncompleteDownload
+
+        options = dict(
+            Bucket=self.bucket,
+            Key=self._key(remote),
+            Range=f'bytes={start}-{stop - 1}',
+        )
+        etag = (self.remote_meta(remote) or {}).get('etag', None)
+        if etag is not None:
+            options['IfMatch'] = etag
+        try:
+            response = self.client.get_object(**options)
+        except ClientError as error:
+            code = error.response.get('Error', {}).get('Code', None)
+            if code != 'PreconditionFailed':
+                raise error
+            # the object changed: the retry lists the prefix again
+            raise IncompleteDownload(f'{remote} changed while downloading')
+        body = response['Body']
+        try:
+            return read_range_into(
+                body.readinto,
+                fd,
+                start,
+                stop - start,
+                update,
+                self.buffer_size,
+            )
+        finally:
+            body.close()
+
+    def listdir(self, directory=''):
+        """Will always list the directory, even if a file is given"""
+        meta = self.listdir_meta(directory)
+        return sorted(p for p, m in meta.items() if m['type'] == 'file')
+
+    def listdir_sizes(self, directory=''):
+        meta = self.listdir_meta(directory)
+        return {p: m['size'] for p, m in meta.items() if m['type'] == 'file'}
+
+    def listdir_meta(self, directory=''):
+        """
+        Lists the objects and common prefixes under the directory with
+        ListObjectsV2 (all pages). The listing is cached for the connection.
+
+        Returns
+        =======
+        listing: dict
+            /key: dict(type='file'|'dir', size=bytes, modify=unix time,
+            etag). Empty if there are no objects under the prefix
+        """
+        directory = directory.rstrip('/')
+        if directory in self._listings:
+            return self._listings[directory]
+
+        prefix = directory.lstrip('/')
+        prefix = f'{prefix}/' if prefix else ''
+        paginator = self.client.get_paginator('list_objects_v2')
+        pages = paginator.paginate(
+            Bucket=self.bucket,
+            Prefix=prefix,
+            Delimiter='/',
+            PaginationConfig=dict(PageSize=self.page_size),
+        )
+        listing = {}
+        for page in pages:
+            for common in page.get('CommonPrefixes', []):
+                path = '/' + common['Prefix'].rstrip('/')
+                listing[path] = dict(
+                    type='dir', size=None, modify=None, etag=None
+                )
+            for obj in page.get('Contents', []):
+                listing['/' + obj['Key']] = dict(
+                    type='file',
+                    size=obj['Size'],
+                    modify=obj['LastModified'].timestamp(),
+                    etag=obj.get('ETag', None),
+                )
+
+        self._listings[directory] = listing
+        return listing
+
+    def remote_meta(self, remote):
+        """the metadata of an object from the cached listing (or None)"""
+        import posixpath
+
+        path = '/' + self._key(remote)
+        listing = self.listdir_meta(posixpath.dirname(path))
+        meta = listing.get(path, None)
+        if (meta is None) or (meta['type'] != 'file'):
+            return None
+        return meta
+
+    def get_file_size(self, path):
+        return (self.remote_meta(path) or {}).get('size', None)
+
+    def remote_size(self, remote):
+        return self.get_file_size(remote)
+
+    def remote_stat(self, remote):
+        from .mirror import new_stat
+
+        meta = self.remote_meta(remote)
+        if meta is None:
+            return None
+        return new_stat(meta['size'], meta['modify'], meta['etag'])
+
+    def close_connection(self):
+        # the client and its connections are shared (see get_s3_client)
+        self._listings.clear()
+
+
+def get_s3_client(
+    username,
+    password,
+    endpoint_url=None,
+    region=None,
+    max_pool_connections=32,
+):
+    """
+    Returns a boto3 S3 client that is shared by the downloaders with the same
+    endpoint and credentials (boto3 clients are thread safe), so that HTTP
+    connections are reused. Anonymous clients do not sign requests. Retries
+    are left to the downloaders (see retry.py).
+    """
+    import boto3
+    from botocore import UNSIGNED
+    from botocore.config import Config
+
+    anonymous = username in (None, 'anonymous')
+    key = (endpoint_url, region, username, password, max_pool_connections)
+    with _s3_clients_lock:
+        if key in _s3_clients:
+            return _s3_clients[key]
+
+        options = dict(
+            max_pool_connections=max_pool_connections,
+            retries=dict(total_max_attempts=1),
+        )
+        if anonymous:
+            options['signature_version'] = UNSIGNED
+        session = boto3.session.Session()
+        client = session.client(
+            's3',
+            endpoint_url=endpoint_url,
+            region_name=region,
+            aws_access_key_id=None if anonymous else username,
+            aws_secret_access_key=None if anonymous else password,
+            config=Config(**options),
+        )
+        _s3_clients[key] = client
+        return client
 
 
 class CDS(Downloader):
     """
     Special class for Climate Data Store that will fetch data for the given
-    variables
+    variables.
+
+    The remote URL has the form cds://<dataset>/{t:%Y-%m}, where the date
+    in the path is the month that is requested. The variables, hours, area
+    and grid can be set in the catalog remote block. Requests are planned
+    (see plan_cds_requests) to stay within the CDS size limit with as few
+    requests as possible, and are submitted without waiting (see
+    download_files), so that many requests can wait in the CDS queue at the
+    same time.
     """
 
-    def _method_init(self, host, username, password, **cdsapi_client_kwargs):
+    def _method_init(
+        self,
+        host,
+        username,
+        password,
+        max_in_flight=8,
+        poll_interval=30,
+        variables=None,
+        hours=None,
+        area=None,
+        grid=None,
+        product_type='reanalysis',
+        max_fields=120000,
+        **cdsapi_client_kwargs,
+    ):
         import cdsapi
-
-        self.cds = cdsapi.Client(**cdsapi_client_kwargs)
-
-        self.times = [f'{t:02d}:00' for t in range(24)]
-        self.variables = [  # from Climate Data Store website
+        from .state import JSONStore
+
+        cdsapi_client_kwargs.pop('port', None)
+        cdsapi_client_kwargs.setdefault('quiet', self.verbose < 2)
+        cdsapi_client_kwargs.setdefault('progress', self.verbose >= 2)
+        # transient errors are retried with the retry policy of the remote
+        # (see retry.py) rather than 500 times, 120 s apart, by cdsapi
+        cdsapi_client_kwargs.setdefault('retry_max', 1)
+        # results must not be deleted on the server when the python object
+        # is garbage collected, otherwise a restarted job cannot pick them up
+        self.cds = cdsapi.Client(
+            wait_until_complete=False, delete=False, **cdsapi_client_kwargs
+        )
+        self.dataset = host
+        self.max_in_flight = max_in_flight
+        self.poll_interval = poll_interval
+        # request IDs of submitted requests, persisted between sessions
+        self.requests = JSONStore('cds_requests.json')
+
+        self.product_type = product_type
+        self.area = area
+        self.grid = [grid, grid] if isinstance(grid, (int, float)) else grid
+        self.max_fields = max_fields
+        self.times = _cds_hours(hours)
+        self.variables = variables or [  # from Climate Data Store website
             '10m_u_component_of_wind',
             '10m_v_component_of_wind',
             'mean_sea_level_pressure',
-            # 'sea_surface_temperature',
-            # 'sea_ice_cover',
-            # 'air_density_over_the_oceans',
-            # 'eastward_turbulent_surface_stress',
-            # 'northward_turbulent_surface_stress',
-            # 'surface_latent_heat_flux',
-            # 'surface_net_solar_radiation',
-            # 'surface_net_thermal_radiation',
-            # 'surface_sensible_heat_flux',
-            # 'evaporation',
-            # 'total_precipitation',
-            # '2m_dewpoint_temperature',
-            # '2m_temperature'
         ]
 
-    def download_file(self, date, local):
+    @staticmethod
+    def _get_date(remote):
+        """the requested month from a pandas.Timestamp or the URL path"""
+        from pandas import Timestamp
+        from urllib.parse import urlparse
+
+        if isinstance(remote, Timestamp):
+            date = remote
+        else:
+            path = urlparse(str(remote)).path
+            date = Timestamp(path.strip('/').split('/')[-1])
+        return Timestamp(year=date.year, month=date.month, day=1)
+
+    def _base_request(self):
+        """the parts of the request that are the same for all files"""
+        request = {
+            'product_type': self.product_type,
+            'format': 'netcdf',
+            'time': self.times,
+        }
+        if self.area is not None:
+            request['area'] = list(self.area)
+        if self.grid is not None:
+            request['grid'] = list(self.grid)
+        return request
+
+    def plan(self, dates):
         """
-        date is pandas.Timestamp object
-        local is the path to a local directory
+        Plans the requests for the months of the given dates.
+        See plan_cds_requests for details.
         """
-        from pandas import Timestamp
+        return plan_cds_requests(
+            [self._get_date(d) for d in dates],
+            self.variables,
+            base_request=self._base_request(),
+            max_fields=self.max_fields,
+        )
 
-        assert isinstance(
-            date, Timestamp
-        ), 'ERA5 input argument must be a pandas.Timestamp'
+    @staticmethod
+    def _part_path(local, request):
+        """
+        Where the result of a request is stored until the local files are
+        assembled. The name is derived from the request so that a restarted
+        job finds its results again.
+        """
+        import hashlib
+        import json
 
-        slocal = shorten_path_for_print(local)
-        if self.is_local_file_valid(local):
-            self._print('File exists locally:', slocal, lvl=2)
-            return 2
+        key = json.dumps(request, sort_keys=True).encode()
+        digest = hashlib.sha1(key).hexdigest()[:12]
+        directory = os.path.split(local)[0]
+        return os.path.join(directory, f'.cds-part-{digest}.nc')
 
-        # making local directory
-        local_dir = os.path.split(local)[0]
-        if not os.path.isdir(local_dir):
-            os.makedirs(local_dir, exist_ok=True, mode=744)
-
-        self.cds.retrieve(  # according to Climate Data Store API
-            'reanalysis-era5-single-levels',
-            {
-                'product_type': 'reanalysis',
-                'format': 'netcdf',
-                'variable': self.variables,
-                'year': f'{date.year:04d}',
-                'month': f'{date.month:02d}',
-                'day': [f'{d:02d}' for d in range(1, 32)],
-                'time': self.times,
-            },
-            local,
+    def _submit(self, part_path, request):
+        """
+        Submits the request for a part, or picks up a request that was
+        submitted in an earlier session. Returns a cdsapi Result.
+        """
+        from cdsapi.api import Result
+        from requests import HTTPError
+
+        stored = self.requests.get(part_path)
+        if (stored is not None) and (stored['request'] == request):
+            result = Result(self.cds, {'request_id': stored['request_id']})
+            try:
+                result.update()
+                self._print(f'Resuming CDS request {part_path}', lvl=2)
+                return result
+            except HTTPError:  # the request expired on the server
+                self.requests.pop(part_path)
+
+        result = self.cds.retrieve(self.dataset, request)
+        self.requests[part_path] = dict(
+            request_id=result.reply['request_id'],
+            request=request,
+            dataset=self.dataset,
         )
-        return 0
+        self._print(f'Submitted CDS request {part_path}', lvl=2)
+        return result
+
+    def _fetch(self, part_path, result):
+        """downloads a completed result to the part path"""
+        remote = f'cds://{self.dataset}/{result.reply.get("request_id")}'
+        self._start_event(remote, part_path)
+        try:
+            self._print(f'Downloading {shorten_path_for_print(part_path)}')
+            os.makedirs(os.path.split(part_path)[0], exist_ok=True, mode=511)
+            result.download(part_path)
+            self._mark_first_byte()
+            self._event['status_code'] = 200
+        except (Exception, KeyboardInterrupt) as error:
+            self._finish_event(None, part_path, error=error)
+            if os.path.isfile(part_path):
+                os.remove(part_path)
+            raise error
+        self._finish_event(0, part_path)
+
+        self.requests.pop(part_path)
+        try:
+            result.delete()  # frees the result on the CDS server
+        except Exception:
+            pass  # the result expires on the server
+
+    def _failed(self, part_path, result):
+        from warnings import warn
+
+        error = result.reply.get('error', {})
+        warn(f'CDS request failed ({part_path}): {error.get("message")}')
+        self.requests.pop(part_path)
+
+    def _with_retries(self, action, func, *args):
+        """
+        func(*args), retried if the error is transient (see
+        Downloader.download_file)
+        """
+        attempt = 0
+        while True:
+            self.breaker.check()
+            try:
+                out = func(*args)
+            except Exception as error:
+                if not self._should_retry(error, attempt):
+                    raise error
+                self._wait_to_retry(error, attempt, action)
+                attempt += 1
+                continue
+            self.breaker.success()
+            return out
+
+    @staticmethod
+    def _gave_up(part_path, error):
+        """
+        raises fatal errors. Transient errors that outlasted the retries
+        only fail the files of the part, and the stored request is kept
+        so that the next session picks it up again.
+        """
+        from warnings import warn
+        from .retry import is_retryable
+
+        if not is_retryable(error):
+            raise error
+        warn(f'CDS request failed ({part_path}): {error}')
+
+    @staticmethod
+    def _assemble(local, part_paths, month):
+        """
+        Writes the local file from the parts that contain its month. Parts
+        are split by variable and/or time, so they are combined by coords.
+        """
+        import xarray as xr
+
+        dsets = []
+        for path in part_paths:
+            xds = xr.open_dataset(path)
+            tdim = 'valid_time' if 'valid_time' in xds.dims else 'time'
+            dsets += (xds.sel(**{tdim: f'{month:%Y-%m}'}),)
+
+        tmp = local + '.tmp'
+        xr.combine_by_coords(dsets).to_netcdf(tmp)
+        for xds in dsets:
+            xds.close()
+        os.replace(tmp, local)
+
+    def download_files(self, remote_local_files):
+        """
+        Plans the CDS requests for all missing files and submits them to
+        the CDS queue with at most `max_in_flight` requests at a time.
+        Request states are polled and results are downloaded as soon as they
+        are complete. Request IDs are stored so that a restarted job picks
+        up queued requests instead of submitting them again.
+
+        Yields (remote, local, status_code) in the order that files finish.
+        The files of a request that failed on the CDS have status 4. The
+        submission, polling and download of each request are retried if
+        the error is transient (see retry.py).
+        """
+        from collections import deque
+
+        months = {}
+        remotes = {}
+        for remote, local in remote_local_files:
+            if self.is_local_file_valid(local):
+                self._start_event(remote, local)
+                self._finish_event(2, local)
+                yield remote, local, 2
+            else:
+                months[local] = self._get_date(remote)
+                remotes[local] = remote
+
+        # the parts (requests) and the local files that each part covers
+        parts = {}
+        needs = {local: set() for local in months}
+        for item in self.plan(list(months.values())):
+            locals_ = [k for k, m in months.items() if m in item['months']]
+            path = self._part_path(locals_[0], item['request'])
+            parts[path] = dict(request=item['request'], locals=locals_)
+            for local in locals_:
+                needs[local].add(path)
+
+        done = set()
+
+        def finish_files(path, failed=False):
+            """yields the files that are complete after a part finished"""
+            for local in parts[path]['locals']:
+                if local in done:
+                    continue
+                if failed:
+                    status = 4
+                    self._start_event(remotes[local], local)
+                    self._finish_event(status, local)
+                elif all(os.path.isfile(p) for p in needs[local]):
+                    self._assemble(local, needs[local], months[local])
+                    status = 0
+                else:
+                    continue
+                done.add(local)
+                yield remotes[local], local, status
+            # parts are removed once all the files they cover are written
+            for other in list(parts):
+                if all(k in done for k in parts[other]['locals']):
+                    if os.path.isfile(other):
+                        os.remove(other)
+
+        pending = deque()
+        for path in parts:
+            if self.is_local_file_valid(path):  # from an earlier session
+                yield from finish_files(path)
+            else:
+                pending += (path,)
+
+        in_flight = {}
+        sleep = 1
+        while pending or in_flight:
+            while pending and (len(in_flight) < self.max_in_flight):
+                path = pending.popleft()
+                action = f'submit {shorten_path_for_print(path)}'
+                request = parts[path]['request']
+                try:
+                    result = self._with_retries(
+                        action, self._submit, path, request
+                    )
+                except Exception as error:
+                    self._gave_up(path, error)
+                    yield from finish_files(path, failed=True)
+                    continue
+                in_flight[path] = result
+
+            finished = False
+            for path, result in list(in_flight.items()):
+                self.queue_depth = len(pending) + len(in_flight) - 1
+                state = result.reply.get('state')
+                spath = shorten_path_for_print(path)
+                try:
+                    if state in ('queued', 'running', None):
+                        self._with_retries(f'poll {spath}', result.update)
+                        state = result.reply.get('state')
+                    if state == 'completed':
+                        self._with_retries(
+                            f'download {spath}', self._fetch, path, result
+                        )
+                except Exception as error:
+                    self._gave_up(path, error)
+                    in_flight.pop(path)
+                    finished = True
+                    yield from finish_files(path, failed=True)
+                    continue
+                if state == 'completed':
+                    in_flight.pop(path)
+                    finished = True
+                    yield from finish_files(path)
+                elif state == 'failed':
+                    in_flight.pop(path)
+                    finished = True
+                    self._failed(path, result)
+                    yield from finish_files(path, failed=True)
+
+            if finished:
+                sleep = 1
+            elif in_flight:
+                time.sleep(sleep)
+                sleep = min(sleep * 1.5, self.poll_interval)
+
+    def download_file(self, remote, local):
+        """
+        Downloads the month given by the remote URL (or pandas.Timestamp)
+        and waits until the CDS request is complete.
+        """
+        for remote, local, status in self.download_files([(remote, local)]):
+            return status
+
+
+def _cds_hours(hours):
+    """
+    CDS time strings from a list of hours (int or 'HH:MM') or from a step
+    in hours (e.g. 6 gives 00:00, 06:00, 12:00, 18:00). None = all hours.
+    """
+    if hours is None:
+        hours = 1
+    if isinstance(hours, int):
+        hours = range(0, 24, hours)
+    return [h if isinstance(h, str) else f'{h:02d}:00' for h in hours]
+
+
+def plan_cds_requests(months, variables, base_request=None, max_fields=120000):
+    """
+    Groups or splits monthly CDS requests so that each request stays below
+    the CDS size limit while keeping the number of requests small.
+
+    The size of a request is counted in fields (variables x days x hours).
+    Months of the same year are batched into one request as long as they
+    fit. If one month with all variables is too large, the variables are
+    split into evenly sized groups, and if one variable is too large for a
+    month, the month is split into blocks of days.
+
+    Parameters
+    ==========
+    months: list of pandas.Timestamp
+        the months that are requested (the day is ignored)
+    variables: list
+        the CDS variable names
+    base_request: dict
+        the other items of the request (e.g. time, area, grid, format).
+        `time` gives the number of hours per day
+    max_fields: int
+        the maximum number of fields in one request
+
+    Returns
+    =======
+    plan: list of dicts
+        each with `request` (the full CDS request) and `months` (the
+        months that are in the request)
+    """
+    import math
+    from pandas import Timestamp
+
+    base_request = {} if base_request is None else base_request
+    nhours = len(base_request.get('time', range(24)))
+    months = sorted(set(Timestamp(m.year, m.month, 1) for m in months))
+    all_days = [f'{d:02d}' for d in range(1, 32)]
+
+    def make_request(year, month_list, var_group, days=all_days):
+        request = dict(base_request)
+        request.update(
+            variable=list(var_group),
+            year=f'{year:04d}',
+            month=[f'{m.month:02d}' for m in month_list],
+            day=days,
+        )
+        return dict(request=request, months=list(month_list))
+
+    plan = []
+    for year in sorted(set(m.year for m in months)):
+        year_months = [m for m in months if m.year == year]
+
+        max_vars = max_fields // (nhours * 31)
+        if max_vars >= 1:
+            ngroups = math.ceil(len(variables) / max_vars)
+            size = math.ceil(len(variables) / ngroups)
+            starts = range(0, len(variables), size)
+            var_groups = [variables[i:][:size] for i in starts]
+            for group in var_groups:
+                batch = []
+                for month in year_months:
+                    ndays = sum(m.days_in_month for m in batch + [month])
+                    if batch and (len(group) * nhours * ndays > max_fields):
+                        plan += (make_request(year, batch, group),)
+                        batch = []
+                    batch += (month,)
+                plan += (make_request(year, batch, group),)
+        else:
+            days_per_request = max_fields // nhours
+            if days_per_request < 1:
+                raise ValueError(
+                    f'max_fields ({max_fields}) is smaller than the number '
+                    f'of hours in one day ({nhours})'
+                )
+            for month in year_months:
+                for var in variables:
+                    for i in range(0, 31, days_per_request):
+                        days = all_days[i:][:days_per_request]
+                        plan += (make_request(year, [month], [var], days),)
+
+    return plan
 
 
 def shorten_path_for_print(path, maxlen=100):
@@ -479,7 +2413,7 @@ def shorten_path_for_print(path, maxlen=100):
 def determine_connection_type(remote_url_unformatted):
     """
     helper to determine what downloading protocol or scheme use.
-    Currently supports: http, https, ftp, sftp, cds
+    Currently supports: http, https, ftp, sftp, s3, cds
     """
     from urllib.parse import urlparse
 
@@ -496,6 +2430,7 @@ def determine_connection_type(remote_url_unformatted):
         'http': HTTP,
         'https': HTTP,
         'ftp': FTP,
+        's3': S3,
         'cds': CDS,
     }
 
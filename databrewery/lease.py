@@ -0,0 +1,205 @@
+"""
+Leases on local files, so that processes that share a local_store (e.g.
+cluster jobs on an NFS file system) do not download the same file at the
+same time.
+
+A lease is a small file next to the local file (<local>.brew-lease) that
+names its holder (host, pid and thread). It is created atomically with
+os.link, which is also atomic on NFS. The holder touches the lease every
+ttl / 3 seconds while it downloads. Other processes wait until the lease
+is released and then use the downloaded file (see Downloader.download_file).
+A lease that was not touched for `ttl` seconds, or whose holder process is
+gone (on the same host), is stale: it is broken and the file is claimed
+again.
+"""
+import json
+import os
+import socket
+import threading
+import time
+
+# seconds after which a lease that is not renewed is stale
+LEASE_TTL = 60
+# seconds to wait for a lease of another process
+LEASE_TIMEOUT = 1800
+# seconds between checks of a lease that is held by another process
+LEASE_POLL = 0.5
+
+
+class LeaseTimeout(TimeoutError):
+    """raised when a lease is held by another process for too long"""
+
+    pass
+
+
+def lease_path(local):
+    return f'{local}.brew-lease'
+
+
+def pid_alive(pid):
+    """
+    True if a process with the pid runs on this host. Always True where
+    signal 0 does not probe processes (on Windows it is CTRL_C_EVENT), the
+    lease then goes stale after its ttl.
+    """
+    if os.name != 'posix':
+        return True
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True  # another user's process
+    return True
+
+
+class Lease:
+    """
+    A lease on a local file. Use acquire() and release() or a with
+    statement. The lease is renewed in a background thread while held.
+    """
+
+    def __init__(self, local, ttl=LEASE_TTL, poll=LEASE_POLL):
+        """
+        Parameters
+        ==========
+        local: str
+            the local file that is downloaded
+        ttl: float
+            seconds after which a lease that is not renewed is stale
+        poll: float
+            seconds between checks while another process holds the lease
+        """
+        import uuid
+
+        self.local = str(local)
+        self.path = lease_path(self.local)
+        self.ttl = ttl
+        self.poll = poll
+        self.holder = dict(
+            host=socket.gethostname(),
+            pid=os.getpid(),
+            thread=threading.get_ident(),
+            token=uuid.uuid4().hex,
+        )
+        self.held = False
+        # True if the lease was held by another process when acquired
+        self.waited = False
+        self._stop = threading.Event()
+        self._renewer = None
+
+    def __repr__(self):
+        state = 'held' if self.held else 'free'
+        return f'{self.__class__.__name__}({self.local}, {state})'
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *args):
+        self.release()
+
+    def try_acquire(self):
+        """claims the lease if it is free. Returns True if claimed"""
+        tmp = f'{self.path}.{self.holder["token"]}'
+        with open(tmp, 'w') as file:
+            json.dump(self.holder, file)
+        try:
+            # fails if the lease exists, unlike a rename
+            os.link(tmp, self.path)
+        except FileExistsError:
+            return False
+        finally:
+            os.remove(tmp)
+        self.held = True
+        self._start_renewing()
+        return True
+
+    def acquire(self, timeout=LEASE_TIMEOUT):
+        """
+        Claims the lease, waits while it is held by another process and
+        breaks it if it is stale. Raises LeaseTimeout after `timeout`
+        seconds (None waits as long as the lease is renewed).
+        """
+        t0 = time.time()
+        while not self.try_acquire():
+            self.waited = True
+            if self.break_if_stale():
+                continue
+            if (timeout is not None) and (time.time() - t0 >= timeout):
+                raise LeaseTimeout(
+                    f'{self.local} is downloaded by {self.read_holder()} '
+                    f'for more than {timeout:.0f} s'
+                )
+            time.sleep(self.poll)
+
+    def release(self):
+        """removes the lease if it is still held by this object"""
+        if not self.held:
+            return
+        self.held = False
+        self._stop.set()
+        if self._renewer is not None:
+            self._renewer.join()
+        if self.read_holder() == self.holder:
+            try:
+                os.remove(self.path)
+            except FileNotFoundError:
+                pass
+
+    def read_holder(self):
+        """the holder of the lease or None if it is free or unreadable"""
+        try:
+            with open(self.path) as file:
+                return json.load(file)
+        except (FileNotFoundError, ValueError):
+            return None
+
+    def is_stale(self, holder, mtime):
+        """True if the lease was not renewed or its process is gone"""
+        if time.time() - mtime >= self.ttl:
+            return True
+        if holder is None:
+            return False
+        same_host = holder.get('host') == self.holder['host']
+        return same_host and not pid_alive(holder.get('pid', -1))
+
+    def break_if_stale(self):
+        """
+        Removes the lease if it is stale. Returns True if the lease was
+        removed (or is gone).
+        """
+        try:
+            stat = os.stat(self.path)
+        except FileNotFoundError:
+            return True
+        holder = self.read_holder()
+        if not self.is_stale(holder, stat.st_mtime):
+            return False
+
+        # only one of the processes that found the stale lease removes it
+        grave = f'{self.path}.{self.holder["token"]}.stale'
+        try:
+            os.rename(self.path, grave)
+        except FileNotFoundError:
+            return True
+        if os.stat(grave).st_ino != stat.st_ino:
+            # a new lease was taken in between: it is put back
+            try:
+                os.link(grave, self.path)
+            except FileExistsError:
+                pass
+        os.remove(grave)
+        return True
+
+    def _start_renewing(self):
+        self._stop.clear()
+        self._renewer = threading.Thread(target=self._renew, daemon=True)
+        self._renewer.start()
+
+    def _renew(self):
+        while not self._stop.wait(self.ttl / 3):
+            try:
+                os.utime(self.path)
+            except FileNotFoundError:
+                return
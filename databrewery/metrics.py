@@ -0,0 +1,404 @@
+"""
+Instrumentation of downloads. Every file that passes through a Downloader
+produces an event (a dictionary) with the timing of the connection, the
+listing lookup, the first byte and the full transfer. Events can be
+aggregated per record or per host and exported to JSON-lines or to a
+Prometheus text file (for the node exporter textfile collector).
+"""
+
+import threading
+import time
+
+EVENT_FIELDS = (
+    'timestamp',  # unix time when the file was started
+    'record',  # name of the catalog record
+    'host',  # remote host (netloc)
+    'scheme',  # ftp | sftp | http | https | cds
+    'remote',  # remote path
+    'local',  # local path
+    'status',  # downloaded | remote_not_exist | local_exists | updated | error
+    'status_code',  # protocol status (HTTP code or FTP reply code)
+    'connect',  # seconds to connect (only the first file of a connection)
+    'listing',  # seconds spent matching the remote file name
+    'first_byte',  # seconds from start of request to the first byte
+    'total',  # seconds for the whole file
+    'bytes',  # number of bytes written locally
+    'retries',  # number of times the file was retried
+    'queue_depth',  # number of files still waiting in the job
+    'error',  # name of the exception if the download failed
+)
+
+STATUS_NAMES = {
+    0: 'downloaded',
+    1: 'remote_not_exist',
+    2: 'local_exists',
+    3: 'updated',
+    4: 'failed',
+}
+
+
+def new_event(**kwargs):
+    """
+    Returns an empty download event with all fields in EVENT_FIELDS.
+    Keyword arguments are used to fill the fields.
+    """
+    event = dict.fromkeys(EVENT_FIELDS)
+    event.update(
+        timestamp=time.time(),
+        connect=0.0,
+        listing=0.0,
+        bytes=0,
+        retries=0,
+        queue_depth=0,
+    )
+    event.update(kwargs)
+    return event
+
+
+class DownloadMetrics:
+    """
+    A thread-safe collection of download events.
+
+    Each Downloader has its own DownloadMetrics instance that is merged
+    into the Record's metrics once the downloader is done. This keeps the
+    collection cheap on the download threads.
+    """
+
+    def __init__(self, record=None):
+        self.record = record
+        self.events = []
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.events)
+
+    def __repr__(self):
+        return (
+            f'{self.__class__.__name__}('
+            f'record={self.record}, events={len(self)})'
+        )
+
+    def add(self, event):
+        if event.get('record') is None:
+            event['record'] = self.record
+        with self._lock:
+            self.events += (event,)
+
+    def extend(self, other):
+        """adds the events of another DownloadMetrics or list of events"""
+        events = other.events if isinstance(other, DownloadMetrics) else other
+        with self._lock:
+            self.events += list(events)
+
+    def reset(self):
+        with self._lock:
+            self.events = []
+
+    @classmethod
+    def concat(cls, metrics_list):
+        """combines several DownloadMetrics (e.g. from many records)"""
+        out = cls()
+        for metrics in metrics_list:
+            out.extend(metrics)
+        return out
+
+    def to_dataframe(self):
+        """returns the events as a pandas.DataFrame (one row per file)"""
+        from pandas import DataFrame
+
+        return DataFrame(list(self.events), columns=EVENT_FIELDS)
+
+    def summary(self, by='host'):
+        """
+        Aggregates the events per host, record or both.
+
+        Parameters
+        ==========
+        by: str or list
+            the event field(s) to group by; typically 'host', 'record'
+            or ['record', 'host']
+
+        Returns
+        =======
+        summary: pandas.DataFrame
+            files, bytes, time and throughput (MB/s) per group. The mean
+            connect, listing and first byte times are in seconds.
+        """
+        df = self.to_dataframe()
+        for key in ['connect', 'listing', 'first_byte', 'total']:
+            df[key] = df[key].astype(float)
+        df['bytes'] = df['bytes'].astype(float)
+
+        for name in STATUS_NAMES.values():
+            df[name] = df['status'] == name
+        df['errors'] = df['status'] == 'error'
+
+        grouped = df.groupby(by)
+        summary = grouped.agg(
+            files=('status', 'size'),
+            downloaded=('downloaded', 'sum'),
+            remote_not_exist=('remote_not_exist', 'sum'),
+            local_exists=('local_exists', 'sum'),
+            errors=('errors', 'sum'),
+            retries=('retries', 'sum'),
+            bytes=('bytes', 'sum'),
+            seconds=('total', 'sum'),
+            connect=('connect', 'mean'),
+            listing=('listing', 'mean'),
+            first_byte=('first_byte', 'mean'),
+            max_queue_depth=('queue_depth', 'max'),
+        )
+        transfer = df[df.downloaded].groupby(by)['total'].sum()
+        transfer = transfer.reindex(summary.index).fillna(0)
+        mbytes = summary['bytes'] / 2 ** 20
+        summary['MB_per_s'] = (mbytes / transfer).where(transfer > 0, 0)
+
+        return summary
+
+    def to_jsonl(self, path, append=True):
+        """
+        Writes one JSON event per line. By default events are appended so
+        that the same file can be used over several runs.
+        """
+        import json
+
+        mode = 'a' if append else 'w'
+        with self._lock:
+            events = list(self.events)
+        with open(path, mode) as file:
+            for event in events:
+                file.write(json.dumps(event, default=str) + '\n')
+
+    def to_prometheus(self, path, prefix='databrewery_download'):
+        """
+        Writes the metrics in the Prometheus text exposition format.
+        The file is written atomically (temporary file + rename) so that
+        the node exporter never scrapes a half written file. The file name
+        should end with `.prom` for the textfile collector.
+        """
+        import os
+
+        text = self.prometheus_text(prefix=prefix)
+        tmp = f'{path}.{os.getpid()}.tmp'
+        with open(tmp, 'w') as file:
+            file.write(text)
+        os.replace(tmp, path)
+
+    def prometheus_text(self, prefix='databrewery_download'):
+        """returns the metrics in the Prometheus text format as a string"""
+        if len(self) == 0:
+            return ''
+
+        df = self.to_dataframe()
+        df['record'] = df['record'].fillna('')
+        labels = ['record', 'host']
+
+        def fmt_labels(keys, values):
+            pairs = [f'{k}="{_prom_escape(v)}"' for k, v in zip(keys, values)]
+            return '{' + ','.join(pairs) + '}'
+
+        lines = []
+
+        def add_metric(name, kind, helptxt, series):
+            lines.append(f'# HELP {prefix}_{name} {helptxt}')
+            lines.append(f'# TYPE {prefix}_{name} {kind}')
+            keys = series.index.names
+            for idx, value in series.items():
+                idx = idx if isinstance(idx, tuple) else (idx,)
+                lbl = fmt_labels(keys, idx)
+                lines.append(f'{prefix}_{name}{lbl} {_prom_value(value)}')
+
+        add_metric(
+            'files_total',
+            'counter',
+            'Number of files processed by status',
+            df.groupby(labels + ['status']).size(),
+        )
+        add_metric(
+            'bytes_total',
+            'counter',
+            'Number of bytes written to the local store',
+            df.groupby(labels)['bytes'].sum(),
+        )
+        add_metric(
+            'retries_total',
+            'counter',
+            'Number of retried file downloads',
+            df.groupby(labels)['retries'].sum(),
+        )
+        phases = df.melt(
+            id_vars=labels,
+            value_vars=['connect', 'listing', 'first_byte', 'total'],
+            var_name='phase',
+        )
+        phases['value'] = phases['value'].astype(float)
+        add_metric(
+            'seconds_total',
+            'counter',
+            'Time spent in each phase of the download',
+            phases.groupby(labels + ['phase'])['value'].sum(),
+        )
+        summary = self.summary(by=labels)
+        add_metric(
+            'throughput_bytes_per_second',
+            'gauge',
+            'Mean transfer rate of downloaded files',
+            summary['MB_per_s'] * 2 ** 20,
+        )
+        add_metric(
+            'queue_depth',
+            'gauge',
+            'Files waiting in the job at the time of the last event',
+            df.groupby(labels)['queue_depth'].last(),
+        )
+        add_metric(
+            'last_event_timestamp_seconds',
+            'gauge',
+            'Unix time of the last download event',
+            df.groupby(labels)['timestamp'].max(),
+        )
+
+        return '\n'.join(lines) + '\n'
+
+
+def _prom_value(value):
+    value = float(value)
+    return str(int(value)) if value.is_integer() else repr(value)
+
+
+def _prom_escape(value):
+    value = str(value)
+    return value.replace('\\', r'\\').replace('"', r'\"').replace('\n', r'\n')
+
+
+PROFILE_FIELDS = (
+    'file',  # the file that was processed (if known)
+    'stage',  # position of the function in the pipeline
+    'function',  # name of the function
+    'wall',  # wall time in seconds
+    'cpu',  # process CPU time in seconds
+    'peak_memory',  # peak of memory allocated by the function (bytes)
+    'memory_delta',  # memory still allocated after the function (bytes)
+    'output_size',  # size of the returned object (bytes)
+)
+
+
+class PipelineProfile:
+    """
+    Per stage timing and memory of preprocessing pipelines.
+
+    Pass an instance to preprocess.apply_process_pipeline to record each
+    function in the pipeline. Memory is traced with tracemalloc, which
+    slows down pure python code but not numpy. Note that functions that
+    return lazy (dask) objects only show the time to build the graph.
+    """
+
+    def __init__(self, trace_memory=True):
+        self.trace_memory = trace_memory
+        self.stages = []
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.stages)
+
+    def __repr__(self):
+        return f'{self.__class__.__name__}(stages={len(self)})'
+
+    def run(self, func, obj, stage=0, file=None):
+        """
+        Calls func(obj) and records the stage.
+        Returns the output of the function.
+        """
+        import tracemalloc
+
+        trace = self.trace_memory
+        tracing_before = tracemalloc.is_tracing()
+        if trace and not tracing_before:
+            tracemalloc.start()
+        if trace and hasattr(tracemalloc, 'reset_peak'):
+            tracemalloc.reset_peak()
+        mem0 = tracemalloc.get_traced_memory()[0] if trace else 0
+
+        cpu0 = time.process_time()
+        wall0 = time.perf_counter()
+        out = func(obj)
+        wall = time.perf_counter() - wall0
+        cpu = time.process_time() - cpu0
+
+        mem1, peak = tracemalloc.get_traced_memory() if trace else (0, 0)
+        if trace and not tracing_before:
+            tracemalloc.stop()
+
+        record = dict(
+            file=None if file is None else str(file),
+            stage=stage,
+            function=getattr(func, '__name__', str(func)),
+            wall=wall,
+            cpu=cpu,
+            peak_memory=max(peak - mem0, 0) if trace else None,
+            memory_delta=mem1 - mem0 if trace else None,
+            output_size=_object_size(out),
+        )
+        with self._lock:
+            self.stages += (record,)
+
+        return out
+
+    def to_dataframe(self):
+        """returns the stages as a pandas.DataFrame (one row per call)"""
+        from pandas import DataFrame
+
+        return DataFrame(list(self.stages), columns=PROFILE_FIELDS)
+
+    def to_json(self, start=0):
+        """the stages (from index `start` onward) as a JSON string"""
+        import json
+
+        return json.dumps(self.stages[start:], default=str)
+
+    def summary(self):
+        """
+        Aggregates the stages of all files per pipeline function.
+
+        Returns
+        =======
+        summary: pandas.DataFrame
+            calls, total and mean wall time, CPU time, the largest peak
+            memory (MB), the mean output size (MB) and the fraction of the
+            total wall time spent in each function
+        """
+        df = self.to_dataframe()
+        for key in ['wall', 'cpu', 'peak_memory', 'output_size']:
+            df[key] = df[key].astype(float)
+
+        summary = df.groupby(['stage', 'function']).agg(
+            calls=('wall', 'size'),
+            wall_total=('wall', 'sum'),
+            wall_mean=('wall', 'mean'),
+            cpu_total=('cpu', 'sum'),
+            peak_memory_MB=('peak_memory', 'max'),
+            output_size_MB=('output_size', 'mean'),
+        )
+        summary['peak_memory_MB'] /= 2 ** 20
+        summary['output_size_MB'] /= 2 ** 20
+        summary['wall_fraction'] = (
+            summary['wall_total'] / summary['wall_total'].sum()
+        )
+
+        return summary
+
+
+def _object_size(obj):
+    """bytes of xarray/pandas/numpy objects, otherwise sys.getsizeof"""
+    import sys
+
+    nbytes = getattr(obj, 'nbytes', None)
+    if nbytes is not None:
+        return int(nbytes)
+    memory_usage = getattr(obj, 'memory_usage', None)
+    if callable(memory_usage):
+        try:
+            return int(memory_usage(deep=True).sum())
+        except (TypeError, ValueError):
+            pass
+    return sys.getsizeof(obj)
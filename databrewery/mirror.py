@@ -0,0 +1,104 @@
+"""
+Manifest of downloaded files for the mirror mode (download_data with
+mirror=True).
+
+For every downloaded file the manifest keeps what the remote server said
+about it (size, modification time and HTTP ETag). In mirror mode a local
+file is downloaded again only if the remote file changed since then, e.g.
+when a provider reprocesses a product and keeps the file names. Manifests
+are stored per record in the state directory (see state.py).
+"""
+import threading
+
+STAT_KEYS = ('size', 'modify', 'etag')
+
+
+def new_stat(size=None, modify=None, etag=None):
+    """the remote metadata of a file as used in the manifest"""
+    return dict(size=size, modify=modify, etag=etag)
+
+
+class Manifest:
+    """
+    local path: dict(remote, size, modify, etag) for the files of a record.
+    Changes are written in batches (every `batch` files and on flush).
+    """
+
+    def __init__(self, name, batch=100):
+        """
+        Parameters
+        ==========
+        name: str
+            the record name (the file is manifest_<name>.json)
+        batch: int
+            the number of changes that are kept before saving
+        """
+        from .state import JSONStore
+
+        self.name = name
+        self.batch = batch
+        self.store = JSONStore(f'manifest_{name}.json')
+        self._pending = {}
+        self._lock = threading.Lock()
+
+    def __repr__(self):
+        return f'{self.__class__.__name__}({self.name}, n={len(self)})'
+
+    def __len__(self):
+        with self._lock:
+            return len(set(self.store) | set(self._pending))
+
+    def get(self, local):
+        with self._lock:
+            entry = self._pending.get(str(local), None)
+        if entry is None:
+            entry = self.store.get(str(local), None)
+        return entry
+
+    def changed(self, local, stat, local_size=None):
+        """
+        True if the remote file differs from the one in the manifest.
+        Files that are not in the manifest yet (downloaded before mirror
+        mode was used) are only compared by size.
+
+        Parameters
+        ==========
+        local: str
+            the local path
+        stat: dict
+            the current remote metadata (see new_stat), None if unknown
+        local_size: int
+            the size of the local file
+        """
+        if stat is None:
+            return False
+
+        entry = self.get(local)
+        if entry is None:
+            size = stat.get('size')
+            return (size is not None) and (size != local_size)
+
+        for key in STAT_KEYS:
+            old, new = entry.get(key), stat.get(key)
+            if (old is not None) and (new is not None) and (old != new):
+                return True
+        return False
+
+    def record(self, local, remote, stat):
+        """stores the remote metadata of a downloaded file"""
+        if stat is None:
+            return
+        entry = dict(remote=str(remote))
+        entry.update({k: stat.get(k) for k in STAT_KEYS})
+        with self._lock:
+            self._pending[str(local)] = entry
+            full = len(self._pending) >= self.batch
+        if full:
+            self.flush()
+
+    def flush(self):
+        """saves the pending changes"""
+        with self._lock:
+            pending, self._pending = self._pending, {}
+        if pending:
+            self.store.update(pending)
@@ -0,0 +1,230 @@
+"""
+Dry run of a sync: what would be downloaded, without downloading.
+
+Local files are checked with one directory scan per local directory (file
+sizes only, files are not opened unless `validate=True`). Remote
+directories are listed once each (with sizes where the protocol gives them)
+on a few connections per record at the same time, and the listings are
+cached for the rest of the session. HTTP directories are read from their
+index pages where the server gives them; the size of a missing file is
+taken from a HEAD request if the index does not give the exact size.
+"""
+import os
+import threading
+import time
+
+PLAN_COLUMNS = [
+    'record',
+    'host',
+    'remote',
+    'local',
+    'state',  # local_exists | missing | remote_not_exist | unknown
+    'local_bytes',
+    'expected_bytes',
+]
+
+_listing_cache = {}
+_listing_lock = threading.Lock()
+
+
+def scan_local_dirs(paths):
+    """
+    Returns the size of each of the given local paths (None if missing),
+    with a single os.scandir per directory.
+    """
+    by_dir = {}
+    for path in paths:
+        directory, name = os.path.split(str(path))
+        by_dir.setdefault(directory, []).append(name)
+
+    sizes = {}
+    for directory, names in by_dir.items():
+        found = {}
+        try:
+            with os.scandir(directory or '.') as entries:
+                for entry in entries:
+                    if entry.is_file():
+                        found[entry.name] = entry.stat().st_size
+        except FileNotFoundError:
+            pass
+        for name in names:
+            sizes[os.path.join(directory, name)] = found.get(name, None)
+    return sizes
+
+
+def cached_listing(downloader, directory, max_age=600):
+    """
+    The listing (path: size) of a remote directory, from the cache if it
+    is younger than `max_age` seconds. Empty listings are not cached: the
+    directory may not exist yet, or the listing failed.
+    """
+    key = (downloader.host, downloader.port, directory)
+    with _listing_lock:
+        cached = _listing_cache.get(key, None)
+    if (cached is not None) and (time.time() - cached[0] < max_age):
+        return cached[1]
+
+    listing = downloader.listdir_sizes(directory)
+    if listing:
+        with _listing_lock:
+            _listing_cache[key] = (time.time(), listing)
+    return listing
+
+
+def _match(listing, remote_path):
+    """the listed path (and size) that matches the (wildcard) path"""
+    from fnmatch import fnmatch
+
+    if remote_path in listing:
+        return remote_path, listing[remote_path]
+    matches = [p for p in listing if fnmatch(p, remote_path)]
+    if len(matches) == 1:
+        return matches[0], listing[matches[0]]
+    return None, None
+
+
+def http_size(downloader, remote):
+    """the exact size from the index page, otherwise from a HEAD request"""
+    from .download import urlparse_path
+
+    path = urlparse_path(remote)
+    listing = downloader.listdir_meta(os.path.dirname(path)) or {}
+    size = listing.get(path, {}).get('size', None)
+    return downloader.remote_size(remote) if size is None else size
+
+
+def plan_record(record, dates, connections=4, validate=False):
+    """
+    Plans the download of a record (see Catalog.plan). Returns a list of
+    rows (dictionaries with PLAN_COLUMNS).
+    """
+    from .utils import make_date_path_pairs
+
+    remote_url = record.config.remote.url
+    pairs = make_date_path_pairs(dates, remote_url, record.config.local_store)
+    return plan_pairs(record, pairs, connections, validate)
+
+
+def plan_pairs(record, pairs, connections=4, validate=False, downloader=None):
+    """
+    Plans the download of the (remote, local) pairs of a record (see
+    plan_record). With a `downloader` the remote files are checked on that
+    connection, which is not closed.
+    """
+    from concurrent.futures import ThreadPoolExecutor
+    from urllib.parse import urlparse
+    from .download import Downloader
+
+    remote_url = record.config.remote.url
+    host = remote_url.parsed.netloc
+    scheme = remote_url.parsed.scheme
+    local_sizes = scan_local_dirs([local for remote, local in pairs])
+
+    rows = []
+    missing = []
+    for remote, local in pairs:
+        local = str(local)
+        size = local_sizes[local]
+        exists = bool(size)
+        if exists and validate:
+            exists = Downloader.is_local_file_valid(local)
+        row = dict(
+            record=record.name,
+            host=host,
+            remote=str(remote),
+            local=local,
+            state='local_exists' if exists else 'missing',
+            local_bytes=size,
+            expected_bytes=None,
+        )
+        rows += (row,)
+        if not exists:
+            missing += (row,)
+
+    # the CDS has no listing and the size is not known before the request
+    if (not missing) or (scheme == 'cds'):
+        return rows
+
+    def connect():
+        if downloader is not None:
+            return downloader
+        connection = record._initiate_connection()
+        connection.verbose = 0
+        return connection
+
+    def check_files(chunk):
+        """checks the remote files of the rows (on one connection)"""
+        connection = connect()
+        try:
+            for row in chunk:
+                remote_path = urlparse(row['remote']).path
+                if scheme in ('http', 'https'):
+                    # the index page resolves wildcards and missing files
+                    remote = connection.get_remote_pathname_match(
+                        row['remote']
+                    )
+                    size = -1 if remote is None else None
+                    if remote is not None:
+                        size = http_size(connection, remote)
+                    if size == -1:
+                        row['state'] = 'remote_not_exist'
+                    else:
+                        row['expected_bytes'] = size
+                    continue
+                directory = os.path.dirname(remote_path)
+                listing = cached_listing(connection, directory)
+                path, size = _match(listing, remote_path)
+                if path is None:
+                    row['state'] = 'remote_not_exist'
+                else:
+                    row['expected_bytes'] = size
+        finally:
+            if connection is not downloader:
+                connection.close_connection()
+
+    if downloader is not None:
+        connections = 1
+    if scheme in ('http', 'https'):
+        chunks = [missing[i::connections] for i in range(connections)]
+    else:
+        # one listing per directory: rows of a directory stay together
+        by_dir = {}
+        for row in missing:
+            directory = os.path.dirname(urlparse(row['remote']).path)
+            by_dir.setdefault(directory, []).append(row)
+        groups = list(by_dir.values())
+        chunks = [sum(groups[i::connections], []) for i in range(connections)]
+    chunks = [chunk for chunk in chunks if chunk]
+
+    with ThreadPoolExecutor(max_workers=len(chunks)) as pool:
+        futures = [pool.submit(check_files, chunk) for chunk in chunks]
+        for future, chunk in zip(futures, chunks):
+            try:
+                future.result()
+            except Exception as error:
+                for row in chunk:
+                    if row['state'] == 'missing':
+                        row['state'] = 'unknown'
+                        row['error'] = f'{type(error).__name__}: {error}'
+
+    return rows
+
+
+def plan(records, dates, connections=4, validate=False):
+    """
+    Plans the download of several records at the same time and returns a
+    pandas.DataFrame. See Catalog.plan.
+    """
+    import pandas as pd
+    from concurrent.futures import ThreadPoolExecutor
+
+    with ThreadPoolExecutor(max_workers=max(1, len(records))) as pool:
+        futures = [
+            pool.submit(plan_record, record, dates, connections, validate)
+            for record in records
+        ]
+        rows = sum([future.result() for future in futures], [])
+
+    table = pd.DataFrame(rows)
+    columns = PLAN_COLUMNS + [c for c in table.columns if c == 'error']
+    return table.reindex(columns=columns)
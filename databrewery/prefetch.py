@@ -0,0 +1,257 @@
+"""
+Background downloads of the next dates of Record.local_files.
+
+Processing loops often ask for the files of one date at a time:
+
+    for day in days:
+        files = record.local_files(day, auto_download=True, prefetch=4)
+        process(files)
+
+With `prefetch` the files of the next dates are downloaded in a background
+thread while the caller works on the files it got. `prefetch=N` looks N
+steps ahead, where a step is the distance between the dates of a request,
+or between two requests, or the finest date field of the local_store
+(e.g. one day for %d). `prefetch='auto'` only prefetches once the requests
+are sequential, i.e. the last AUTO_REQUESTS requests followed each other
+with the same gap, and looks AUTO_LOOKAHEAD steps ahead.
+
+At most PREFETCH_DEPTH files wait in the queue. The queue is dropped when
+a request does not follow the last one, and the thread stops when the
+caller has not asked for files for PREFETCH_IDLE seconds (or with
+Record.stop_prefetch).
+"""
+import os
+import threading
+import time
+from collections import deque
+
+# files that wait for the background thread at most
+PREFETCH_DEPTH = 8
+# seconds without requests after which the background thread stops
+PREFETCH_IDLE = 60
+# sequential requests after which prefetch='auto' starts
+AUTO_REQUESTS = 3
+# steps that prefetch='auto' looks ahead
+AUTO_LOOKAHEAD = 4
+
+# the step of the finest date field of a template
+FIELD_STEPS = [
+    ('%S', dict(seconds=1)),
+    ('%M', dict(minutes=1)),
+    ('%H', dict(hours=1)),
+    ('%d', dict(days=1)),
+    ('%j', dict(days=1)),
+    ('%m', dict(months=1)),
+    ('%b', dict(months=1)),
+    ('%Y', dict(years=1)),
+]
+
+
+def template_step(date_path):
+    """the step of the finest date field of a DatePath (one day default)"""
+    from pandas import DateOffset
+
+    for field, step in FIELD_STEPS:
+        if field in str(date_path):
+            return DateOffset(**step)
+    return DateOffset(days=1)
+
+
+def date_gap(start, end):
+    """
+    end - start as a number of months if both are on the same day and
+    time of different months (months differ in length), else a Timedelta
+    """
+    from pandas import DateOffset
+
+    same_day = (start.day, start.time()) == (end.day, end.time())
+    months = (end.year - start.year) * 12 + end.month - start.month
+    if same_day and months:
+        return DateOffset(months=months)
+    return end - start
+
+
+class Prefetcher:
+    """
+    Downloads the files of the dates that follow the requests of
+    Record.local_files in a background thread (see the module docstring)
+    """
+
+    def __init__(self, record, depth=PREFETCH_DEPTH, idle=PREFETCH_IDLE):
+        """
+        Parameters
+        ==========
+        record: Record
+            downloads with record._fetch
+        depth: int
+            the maximum number of files in the queue
+        idle: float
+            seconds without requests after which the thread stops
+        """
+        self.record = record
+        self.depth = depth
+        self.idle = idle
+        # (first, last) date of the latest requests
+        self.history = deque(maxlen=AUTO_REQUESTS)
+        self.queue = deque()
+        # local paths that are queued or downloading
+        self.pending = set()
+        # local paths that were downloaded in the background
+        self.fetched = []
+        self._cond = threading.Condition()
+        self._thread = None
+        self._stopped = False
+        self._last_request = time.time()
+
+    def __repr__(self):
+        state = 'running' if self._thread is not None else 'idle'
+        return (
+            f'{self.__class__.__name__}({self.record.name}, {state}, '
+            f'queued={len(self.queue)})'
+        )
+
+    def _gaps(self):
+        """the gaps between the latest requests"""
+        history = list(self.history)
+        pairs = zip(history[:-1], history[1:])
+        return [date_gap(prev[1], this[0]) for prev, this in pairs]
+
+    def upcoming(self, dates, lookahead):
+        """
+        The dates to prefetch after a request of `dates`, empty if the
+        request does not follow the last one or the requests are not
+        sequential (lookahead='auto')
+        """
+        import pandas as pd
+
+        gaps = self._gaps()
+        if gaps and pd.Timestamp(0) + gaps[-1] <= pd.Timestamp(0):
+            return pd.DatetimeIndex([])  # the caller went back
+        if lookahead == 'auto':
+            sequential = len(gaps) == AUTO_REQUESTS - 1
+            if not (sequential and all(g == gaps[0] for g in gaps)):
+                return pd.DatetimeIndex([])
+            lookahead = AUTO_LOOKAHEAD
+
+        if len(dates) > 1:
+            step = date_gap(dates[0], dates[1])
+        elif gaps:
+            step = gaps[-1]
+        else:
+            step = template_step(self.record.config.local_store)
+        upcoming = [dates[-1] + step * (i + 1) for i in range(lookahead)]
+        return pd.DatetimeIndex(upcoming)
+
+    def request(self, dates, lookahead):
+        """
+        Queues the files that follow a request of Record.local_files.
+
+        Parameters
+        ==========
+        dates: date-like string or object
+            the dates of the request (see Record.local_files)
+        lookahead: int or 'auto'
+            the number of steps to prefetch
+        """
+        import pandas as pd
+        from .utils import get_dates
+
+        dates = get_dates(dates)
+        if isinstance(dates, pd.Timestamp):
+            dates = pd.DatetimeIndex([dates])
+        if not len(dates):
+            return
+        with self._cond:
+            self._stopped = False
+            self._last_request = time.time()
+            self.history.append((dates[0], dates[-1]))
+            upcoming = self.upcoming(dates, lookahead)
+
+        pairs = []
+        if len(upcoming):
+            pairs, skipped = self.record._date_path_pairs(upcoming)
+        pairs = [(str(remote), str(local)) for remote, local in pairs]
+        wanted = {local for remote, local in pairs}
+        with self._cond:
+            # files that the caller skipped are not downloaded
+            dropped = [p for p in self.queue if p[1] not in wanted]
+            for pair in dropped:
+                self.queue.remove(pair)
+                self.pending.discard(pair[1])
+            for remote, local in pairs:
+                if len(self.queue) >= self.depth:
+                    break
+                if (local in self.pending) or os.path.isfile(local):
+                    continue
+                self.queue.append((remote, local))
+                self.pending.add(local)
+            if self.queue and (self._thread is None):
+                self._thread = threading.Thread(target=self._run, daemon=True)
+                self._thread.start()
+            self._cond.notify_all()
+
+    def _run(self):
+        from warnings import warn
+
+        # the connections of the thread stay open between the files
+        connections = {}
+        try:
+            while True:
+                with self._cond:
+                    while not (self.queue or self._stopped):
+                        wait = self.idle - (time.time() - self._last_request)
+                        if wait <= 0:
+                            break
+                        self._cond.wait(wait)
+                    if self._stopped or not self.queue:
+                        self._thread = None
+                        self._cond.notify_all()
+                        return
+                    remote, local = self.queue.popleft()
+
+                try:
+                    out = self.record._fetch([(remote, local)], connections)
+                    if out['downloaded'] or out['updated']:
+                        self.fetched += (local,)
+                except Exception as error:
+                    # the caller downloads the file again
+                    warn(f'Prefetching {local} failed: {error}')
+                    self.record._close_connections(connections)
+                finally:
+                    with self._cond:
+                        self.pending.discard(local)
+                        self._cond.notify_all()
+        finally:
+            self.record._close_connections(connections)
+
+    def wait(self, timeout=None):
+        """
+        Waits until the queued files are downloaded. Returns False after
+        `timeout` seconds.
+        """
+        t0 = time.time()
+        with self._cond:
+            while self.pending:
+                remaining = None
+                if timeout is not None:
+                    remaining = timeout - (time.time() - t0)
+                    if remaining <= 0:
+                        return False
+                self._cond.wait(remaining)
+        return True
+
+    def stop(self):
+        """
+        Drops the queue and waits for the file that is downloading (if
+        any)
+        """
+        with self._cond:
+            self._stopped = True
+            for remote, local in self.queue:
+                self.pending.discard(local)
+            self.queue.clear()
+            self.history.clear()
+            thread = self._thread
+            self._cond.notify_all()
+        if thread is not None:
+            thread.join()
@@ -44,14 +44,14 @@ def center_coords_at_0(xds):
     def strictly_increasing(L):
         return all([x < y for x, y in zip(L, L[1:])])
 
-    x = xds['lon'].values
+    x = xds['lon'].values.copy()
     y = xds['lat'].values
 
     x[x >= 180] -= 360
+    xds = xds.assign_coords(lon=x)
     if not strictly_increasing(x):
         sort_idx = np.argsort(x)
         xds = xds.isel(**{'lon': sort_idx})
-        xds['lon'].values = x[sort_idx]
         xds = _netcdf_add_brew_hist(xds, 'center coords -> 0:360 to -180:180')
 
     if not strictly_increasing(y):
@@ -149,9 +149,7 @@ def interpolate_1deg(xds, method='linear'):
 def resample_time_1D(xds):
     attrs = xds.attrs
 
-    xds = xds.resample(time='1D', keep_attrs=True).mean(
-        'time', keep_attrs=True
-    )
+    xds = xds.resample(time='1D').mean('time', keep_attrs=True)
 
     xds.attrs.update(attrs)
     xds = _netcdf_add_brew_hist(xds, 'resampled to time to 1D')
@@ -164,10 +162,8 @@ def resample_time_1M(xds):
 
     attrs = xds.attrs
 
-    xds = xds.resample(time='1MS', keep_attrs=True).mean(
-        'time', keep_attrs=True
-    )
-    xds.time.values += pd.Timedelta('14D')
+    xds = xds.resample(time='1MS').mean('time', keep_attrs=True)
+    xds = xds.assign_coords(time=xds.time.to_index() + pd.Timedelta('14D'))
 
     xds.attrs.update(attrs)
     xds = _netcdf_add_brew_hist(xds, 'resampled to time to 1M')
@@ -188,7 +184,7 @@ def fill_time_monthly_to_daily(xds):
     t0 = pd.Timestamp(f'{year_0}-{mon_0}-01')
     t1 = pd.Timestamp(f'{year_1}-{mon_1}-01')
 
-    date_range = pd.date_range(start=t0, end=t1, freq='1D', closed='left')
+    date_range = pd.date_range(start=t0, end=t1, freq='1D')[:-1]
     xds = xds.reindex(time=date_range, method='nearest')
 
     xds = _netcdf_add_brew_hist(xds, 'time filled from monthly to daily')
@@ -252,7 +248,7 @@ def gunzip(zip_path, dest_path=None):
 
     with gzip.open(zip_path, 'rb') as f_in:
         with open(dest_path, 'wb') as f_out:
-            shutil.copyfileobj(f_in, f_out)
+            shutil.copyfileobj(f_in, f_out, 2 ** 20)
             return f_out
 
 
@@ -297,16 +293,41 @@ def _netcdf_add_brew_hist(xds, msg, key='history'):
     return xds
 
 
-def apply_process_pipeline(xds, pipe):
+def apply_process_pipeline(xds, pipe, profile=None, profile_attr=None):
     """
     Applies a list of functions to an xarray.Dataset object.
     Functions must accept a Dataset and return a Dataset
+
+    Parameters
+    ==========
+    xds: xarray.Dataset
+        the input data (can also be a file name if the first function in
+        the pipe opens the file)
+    pipe: list
+        the functions applied in order
+    profile: databrewery.metrics.PipelineProfile
+        opt-in profiling; the wall time, CPU time, peak memory and output
+        size of each function are recorded in the profile
+    profile_attr: str
+        if given with a profile, the profile of this run is written as
+        JSON to the attribute with this name (e.g. `brew_profile`), next
+        to the `history` attribute
     """
-    attrs = xds.attrs
-    for func in pipe:
-        xds = func(xds)
+    attrs = getattr(xds, 'attrs', None)
+    file = None if attrs is not None else xds
+    start = 0 if profile is None else len(profile)
 
-    xds.attrs = attrs
+    for stage, func in enumerate(pipe):
+        if profile is None:
+            xds = func(xds)
+        else:
+            xds = profile.run(func, xds, stage=stage, file=file)
+
+    if attrs is not None:
+        xds.attrs = attrs
+    if (profile is not None) and (profile_attr is not None):
+        msg = profile.to_json(start)
+        xds = _netcdf_add_brew_hist(xds, msg, profile_attr)
     return xds
 
 
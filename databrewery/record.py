@@ -3,14 +3,17 @@ class Record:
     Stores the information for an entry in the catalog file
     """
 
-    def __init__(self, record_name, config_dict, verbose=2):
+    def __init__(self, record_name, config_dict, verbose=2, catalog_file=None):
         """
         Should be called by the Catalog class as requires a
-        preformatted catalog dictionary (config_dict)
+        preformatted catalog dictionary (config_dict). The catalog_file is
+        read again by the workers of a work queue (see workqueue.py)
         """
+        from .metrics import DownloadMetrics
         from .utils import DictObject
 
         self.name = record_name
+        self.catalog_file = catalog_file
         self.debug = True if verbose == 2 else False
         self.verbose = verbose
 
@@ -24,14 +27,161 @@ class Record:
                 pipe = PipeFiles(key, self, self.config.pipelines[key])
                 setattr(self, key, pipe)
         self._reset_download_results()
+        self.metrics = DownloadMetrics(record=self.name)
+        self._manifest = None
+        self._missing = None
+        # local path: remote path on each mirror (see _date_path_pairs)
+        self._alternates = {}
+        # the URL of a read-through cache (see serve.py)
+        self.cache = getattr(self.config.remote, 'cache', None)
+        # the quota of the local_store (see storage.make_budgets)
+        self.storage = None
+        # background downloads of local_files (see prefetch.py)
+        self._prefetcher = None
 
     def _reset_download_results(self):
         self.download_results = {
             'remote_not_exist': [],
             'local_exists': [],
             'downloaded': [],
+            'updated': [],
+            'failed': [],
         }
 
+    @property
+    def manifest(self):
+        """the mirror.Manifest of the downloaded files (see download_data)"""
+        from .mirror import Manifest
+
+        if self._manifest is None:
+            self._manifest = Manifest(self.name)
+        return self._manifest
+
+    @property
+    def missing(self):
+        """
+        the remote files that were not found recently (see
+        coverage.MissingCache). Use `missing.clear()` to probe them again.
+        """
+        from .coverage import MissingCache
+
+        if self._missing is None:
+            port = getattr(self.config.remote, 'port', None)
+            self._missing = MissingCache(self.name, port=port)
+        return self._missing
+
+    @property
+    def mirrors(self):
+        """
+        the servers of the files, the url first (see routing.py), or only
+        the cache if the remote has one (see serve.py)
+        """
+        from .routing import cache_mirror, get_mirrors
+
+        if self.cache is not None:
+            return [cache_mirror(self)]
+        return get_mirrors(self.config.remote)
+
+    @property
+    def coverage(self):
+        """the stored coverage (see discover_coverage), None if unknown"""
+        from .coverage import get_coverage
+
+        return get_coverage(self.name)
+
+    def discover_coverage(self, dates):
+        """
+        Finds the first and last date with a remote file from directory
+        listings (FTP and SFTP). Dates outside of this coverage are skipped
+        by download_data for a day (see coverage.py).
+
+        Parameters
+        ==========
+        dates: date-like string or object
+            the dates to search, e.g. slice('2000-01-01', None)
+
+        Returns
+        =======
+        coverage: dict
+            start and end (the first and last date with a file) and the
+            first and last date that was searched. None if the remote
+            cannot be listed
+        """
+        from .coverage import discover_coverage
+
+        coverage = discover_coverage(self, dates)
+        if coverage is not None:
+            self._print(
+                f'Coverage of {self.name}: {coverage["start"]} to '
+                f'{coverage["end"]}'
+            )
+        return coverage
+
+    def _date_path_pairs(self, dates):
+        """
+        The (remote, local) pairs of the dates without those that are known
+        to be missing on the remote (outside of the coverage or found
+        missing recently) and do not exist locally.
+
+        Returns
+        =======
+        pairs, skipped: list
+            (remote, local) tuples
+        """
+        import os
+        from .coverage import clip_dates
+        from .utils import make_date_path_pairs
+
+        paths = self.mirrors[0].url, self.config['local_store']
+        inside, outside = clip_dates(dates, self.coverage)
+        self._find_alternates(inside)
+
+        pairs, skipped = [], []
+        if len(inside):
+            for remote, local in make_date_path_pairs(inside, *paths):
+                if (remote in self.missing) and not os.path.isfile(local):
+                    skipped += ((remote, local),)
+                else:
+                    pairs += ((remote, local),)
+        if len(outside):
+            for remote, local in make_date_path_pairs(outside, *paths):
+                if (remote, local) in pairs:
+                    continue
+                elif os.path.isfile(local):
+                    pairs += ((remote, local),)
+                else:
+                    skipped += ((remote, local),)
+
+        return pairs, skipped
+
+    def _find_alternates(self, dates):
+        """keeps the remote path of each mirror for the local files"""
+        from .utils import make_date_path_pairs
+
+        mirrors = self.mirrors
+        if (len(mirrors) == 1) or (not len(dates)):
+            return
+        urls = [m.url for m in mirrors]
+        paths = make_date_path_pairs(dates, *urls, self.config.local_store)
+        for *remotes, local in paths:
+            self._alternates[str(local)] = [str(r) for r in remotes]
+
+    def _update_missing(self, file_pairs, results):
+        """
+        adds the files of file_pairs that were not found to the negative
+        cache and removes those that were downloaded
+        """
+        remotes = {str(local): remote for remote, local in file_pairs}
+
+        def remote_files(*keys):
+            files = [str(f) for key in keys for f in results.get(key, [])]
+            return [remotes[f] for f in files if f in remotes]
+
+        missing = remote_files('remote_not_exist')
+        found = remote_files('downloaded', 'updated')
+        self.missing.add(missing)
+        self.missing.discard(found)
+
     def __str__(self):
         return str(self.config)
 
@@ -39,29 +189,47 @@ class Record:
         if self.verbose >= 1:
             print(*msg)
 
-    def _initiate_connection(self):
+    def _initiate_connection(self, mirror=None, manifest=None, **kwargs):
         """
         Function makes a connection to the server. This is done per download
         thread and NOT per file. This approach is quicker. The host type and
         download protocol is also determined here.
 
         Returns a downloader object that can then download specified files
-        from the server
+        from the server. Keyword arguments are passed to the downloader.
+        In mirror mode the downloader compares files with the `manifest`
+        (see mirror.Manifest).
+        The connection is made to the url of the remote unless another
+        `mirror` (see routing.Mirror) is given.
         """
         from .download import determine_connection_type
 
-        url = self.config['remote']['url']
+        if mirror is None:
+            mirror = self.mirrors[0]
+        url = mirror.url
 
-        self._downloader = determine_connection_type(url)
+        downloader_class = determine_connection_type(url)
 
         host = url.parsed.netloc
-        login_dict = self.config.remote.__dict__.copy()
-        login_dict.pop('url')
-        connect = self._downloader(host, **login_dict)
+        login_dict = mirror.login.copy()
+        if url.parsed.scheme in ('http', 'https'):
+            login_dict['scheme'] = url.parsed.scheme
+        if manifest is not None:
+            login_dict['manifest'] = manifest
+        login_dict.update(kwargs)
+        connect = downloader_class(host, **login_dict)
 
         return connect
 
-    def _download_single_process(self, remote_local_files):
+    def _download_single_process(
+        self,
+        remote_local_files,
+        verbose=None,
+        mirror=None,
+        manifest=None,
+        metrics=None,
+        connections=None,
+    ):
         """
         Downloads files on a single process using a db.Downloader instance.
 
@@ -70,6 +238,18 @@ class Record:
         remote_local_files: list
             a list of file pairs, where each pair is the remote and local
             save paths to the files.
+        verbose: int
+            verbosity of the downloader, defaults to the Record verbosity
+        mirror: routing.Mirror
+            the server to download from, defaults to the url
+        manifest: mirror.Manifest
+            the manifest of mirror mode (see download_data)
+        metrics: metrics.DownloadMetrics
+            collects the events of the files, defaults to self.metrics
+        connections: dict
+            open downloaders by routing.Mirror. The connection to the mirror
+            is taken from it and kept open in it for the next call (see
+            _fetch and _close_connections)
 
         Returns
         -------
@@ -78,105 +258,478 @@ class Record:
             - downloaded
             - remote_not_exist
             - local_exists
+            - updated (mirror mode)
+            - failed (transient errors after all retries, the host is
+              parked by its circuit breaker, or a CDS request failed)
         """
         import os
         from warnings import warn
-
-        downloader = self._initiate_connection()
-        downloader.verbose = self.verbose
+        from .retry import HostUnavailable, is_retryable
 
         msg_decipher = {
             0: 'downloaded',
             1: 'remote_not_exist',
             2: 'local_exists',
+            3: 'updated',
+            4: 'failed',
         }
         download_status = {k: [] for k in msg_decipher.values()}
-        for remote, local in remote_local_files:
-            # download_file returns a code that is described by the
+        if mirror is None:
+            mirror = self.mirrors[0]
+        if metrics is None:
+            metrics = self.metrics
+
+        pending = [(remote, local) for remote, local in remote_local_files]
+        while pending:
+            downloader = None
+            if connections is not None:
+                downloader = connections.pop(mirror, None)
+            reused = downloader is not None
+            done = set()
+            # download_files returns codes that are described by the
             # msg_decipher codes above
             try:
-                msg = downloader.download_file(remote, local)
-                download_status[msg_decipher[msg]] += (local,)
+                if downloader is None:
+                    downloader = self._initiate_connection(mirror, manifest)
+                downloader.verbose = (
+                    self.verbose if verbose is None else verbose
+                )
+                downloader.metrics.record = self.name
+                for remote, local, msg in downloader.download_files(pending):
+                    download_status[msg_decipher[msg]] += (local,)
+                    done.add(local)
+                pending = []
             except (Exception, KeyboardInterrupt) as error:
                 # catches any exception so that file is deleted if incomplete
-                if os.path.isfile(local):
-                    os.remove(local)
+                local, partial = None, None
+                if downloader is not None:
+                    local = downloader.current_file
+                    partial = downloader.current_local
+                if (partial is not None) and os.path.isfile(partial):
+                    os.remove(partial)
                     warn(
                         '\n\n'
                         + '#' * 80
-                        + f'\nRemoved partially downloaded file {local}\n'
+                        + f'\nRemoved partially downloaded file {partial}\n'
                         + '#' * 80
                         + '\n'
                     )
                 # downloader connection closed to avoid too many connections
-                downloader.close_connection()
-                # raises caught error at the end
-                raise error
+                if downloader is not None:
+                    downloader.close_connection()
+                    metrics.extend(downloader.metrics)
 
-        # close connection at the end of the downloading
-        downloader.close_connection()
+                # raises fatal errors, transient errors only fail the file
+                parked = isinstance(error, HostUnavailable)
+                if not (parked or is_retryable(error)):
+                    raise error
+                pending = [(r, l) for r, l in pending if l not in done]
+                if reused and not parked:
+                    # the server may have closed the kept connection
+                    continue
+                failed = [l for r, l in pending if parked or (l == local)]
+                # the failed file is not known (e.g. while connecting)
+                failed = failed or [l for r, l in pending]
+                warn(f'{len(failed)} {self.name} files failed: {error}')
+                download_status['failed'] += failed
+                pending = [(r, l) for r, l in pending if l not in failed]
+                continue
+
+            metrics.extend(downloader.metrics)
+            if connections is not None:
+                downloader.metrics.reset()
+                connections[mirror] = downloader
+            else:
+                # close connection at the end of the downloading
+                downloader.close_connection()
 
         return download_status
 
-    def _download_multiple_processes(self, remote_local_files, njobs):
-        from multiprocessing import Process, Queue
+    def _download_multiple_threads(
+        self,
+        remote_local_files,
+        njobs,
+        mirror=None,
+        manifest=None,
+        metrics=None,
+    ):
+        """
+        Downloads the files with `njobs` connections, where each connection
+        runs in its own thread. Downloading is I/O bound, so threads are
+        used rather than processes.
+        """
+        from concurrent.futures import ThreadPoolExecutor
 
-        # TODO: Will be better to use joblib and
+        # progress bars of parallel downloads overwrite each other
+        verbose = 1 if self.verbose == 2 else self.verbose
 
         paths = remote_local_files
-        verbose = self.verbose
-        verbose = 1 if verbose == 2 else verbose
-
-        # step = paths.shape[0] // njobs
-        processes = []
-        split_paths = []
-        for i in range(njobs):
-            # i0 = i * step
-            # i1 = (i+1) * step
-            # split_paths += paths[i0:i1],
-            split_paths += (paths[i:njobs],)
-
-        processes = []
-        queue = Queue()
-        for i in range(njobs):
-            p = Process(
-                target=self._download_single_process, args=(split_paths[i])
-            )
-            processes += (p,)
-            p.start()
+        split_paths = [paths[i::njobs] for i in range(njobs)]
+        with ThreadPoolExecutor(max_workers=njobs) as pool:
+            futures = [
+                pool.submit(
+                    self._download_single_process,
+                    chunk,
+                    verbose,
+                    mirror,
+                    manifest,
+                    metrics,
+                )
+                for chunk in split_paths
+            ]
+            results = [future.result() for future in futures]
+
+        download_status = {}
+        for status in results:
+            for key, files in status.items():
+                download_status[key] = download_status.get(key, []) + files
 
-        # TODO single download no longer returns to queue
-        missing_files = []
-        for p in processes:
-            missing_files += queue.get()
-            p.join()
+        return download_status
+
+    def _download_adaptive(
+        self,
+        remote_local_files,
+        max_jobs=8,
+        mirror=None,
+        manifest=None,
+        metrics=None,
+    ):
+        """
+        Downloads the files with a number of connections that adapts to the
+        server (see concurrency.HostLimiter). Each worker thread takes the
+        next file when the host limit allows it and closes its connection
+        while it waits. Files that are refused because the server is
+        overloaded are put back in the queue.
+        """
+        import os
+        import threading
+        import time
+        from collections import deque
+        from concurrent.futures import ThreadPoolExecutor
+        from .concurrency import get_limiter, is_overload_error
+        from .retry import HostUnavailable, is_retryable
 
-        return missing_files
+        if mirror is None:
+            mirror = self.mirrors[0]
+        if metrics is None:
+            metrics = self.metrics
+        host = mirror.host
+        limiter = get_limiter(host, max_limit=max_jobs)
+        verbose = 1 if self.verbose == 2 else self.verbose
 
-    def _download_data(self, file_pairs, njobs=1):
-        from multiprocessing import cpu_count
+        msg_decipher = {
+            0: 'downloaded',
+            1: 'remote_not_exist',
+            2: 'local_exists',
+            3: 'updated',
+            4: 'failed',
+        }
+        download_status = {k: [] for k in msg_decipher.values()}
+        # (remote, local, number of times refused by the server)
+        queue = deque((r, l, 0) for r, l in remote_local_files)
+        lock = threading.Lock()
+        errors = []
+
+        def next_file():
+            with lock:
+                if queue and not errors:
+                    return queue.popleft()
+
+        def worker():
+            downloader = None
+            while True:
+                epoch = limiter.try_acquire()
+                if epoch is None:
+                    # idle connections also count for the server limit
+                    if downloader is not None:
+                        downloader.close_connection()
+                        metrics.extend(downloader.metrics)
+                        downloader = None
+                    epoch = limiter.acquire()
+
+                item = next_file()
+                if item is None:
+                    limiter.release()
+                    break
+                remote, local, attempt = item
+                try:
+                    if downloader is None:
+                        # overload errors are handled by the limiter
+                        downloader = self._initiate_connection(
+                            mirror, manifest, retry_overload=False
+                        )
+                        downloader.verbose = verbose
+                        downloader.metrics.record = self.name
+                    downloader.queue_depth = len(queue)
+                    msg = downloader.download_file(remote, local)
+                except (Exception, KeyboardInterrupt) as error:
+                    limiter.release()
+                    if downloader is not None:
+                        # removes the partially downloaded file
+                        partial = downloader.current_local
+                        if (partial is not None) and os.path.isfile(partial):
+                            os.remove(partial)
+                        downloader.close_connection()
+                        metrics.extend(downloader.metrics)
+                        downloader = None
+                    if is_overload_error(error) and (attempt < 5):
+                        limiter.overload(epoch)
+                        with lock:
+                            queue.appendleft((remote, local, attempt + 1))
+                        time.sleep(0.1 * 2 ** attempt)
+                        continue
+                    # transient errors (after retries) only fail the file
+                    parked = isinstance(error, HostUnavailable)
+                    if parked or is_retryable(error):
+                        with lock:
+                            download_status['failed'] += (local,)
+                        continue
+                    with lock:
+                        errors.append(error)
+                    break
+
+                limiter.release()
+                event = downloader.metrics.events[-1]
+                if msg in (0, 3):
+                    limiter.success(
+                        event['total'],
+                        event['bytes'] or 0,
+                        event['first_byte'],
+                    )
+                with lock:
+                    download_status[msg_decipher[msg]] += (local,)
+
+            if downloader is not None:
+                downloader.close_connection()
+                metrics.extend(downloader.metrics)
+
+        nworkers = max(1, min(limiter.max_limit, len(queue)))
+        with ThreadPoolExecutor(max_workers=nworkers) as pool:
+            futures = [pool.submit(worker) for _ in range(nworkers)]
+            [future.result() for future in futures]
+        limiter.save()
+        self._print(f'Connection limit for {host}: {limiter.limit:.0f}')
+
+        if errors:
+            raise errors[0]
+
+        return download_status
+
+    def _download_data(self, file_pairs, njobs=1, mirror=False):
         from numpy import array
 
         file_pairs = array(file_pairs)
+        nfiles = file_pairs.shape[0]
+        remote = self.config['remote']
 
-        ncpus = cpu_count() - 1
-        njobs = ncpus if njobs > ncpus else njobs
+        if njobs == 'auto':
+            # the CDS queues requests itself (see CDS.download_files)
+            if remote['url'].parsed.scheme == 'cds':
+                njobs = 1
+        else:
+            njobs = max(1, min(njobs, nfiles))
 
         self._print(
-            f'Downloading {file_pairs.shape[0]} '
-            f'{self.name} files with {njobs} jobs'
+            f'Downloading {nfiles} {self.name} files with {njobs} jobs'
         )
 
-        if njobs == 1:
-            out = self._download_single_process(file_pairs)
+        if self.storage is not None:
+            self._make_room(file_pairs.tolist())
 
-        # FIXME: parallel downloads are currently broken.
-        if njobs > 1:
-            out = self._download_multiple_processes(file_pairs, njobs)
+        # passed per call: background downloads (see _fetch) do not use
+        # mirror mode
+        manifest = self.manifest if mirror else None
+        try:
+            if len(self.mirrors) > 1:
+                out = self._download_mirrors(
+                    file_pairs.tolist(), njobs, manifest
+                )
+            else:
+                out = self._download_from(
+                    file_pairs.tolist(), njobs, manifest=manifest
+                )
+        finally:
+            if manifest is not None:
+                manifest.flush()
 
+        self._update_missing(file_pairs.tolist(), out)
         self.download_results = out
 
-    def download_data(self, dates, njobs=1):
+    def _make_room(self, file_pairs, downloader=None):
+        """
+        removes files if the download would go over the quota, the sizes
+        are checked on `downloader` if given
+        """
+        removed = self.storage.reserve(self, file_pairs, downloader)
+        if removed:
+            self._print(
+                f'Removed {len(removed)} {self.storage.policy.upper()} '
+                f'files to stay below the quota of {self.name}'
+            )
+
+    def _fetch(self, file_pairs, connections=None):
+        """
+        Downloads the files on one connection without changing
+        download_results, e.g. in a background thread (see prefetch.py and
+        serve.py). Returns the status of the files like _download_from.
+
+        A thread that fetches files one after the other passes the same
+        `connections` dict to each call, so that the connections stay open
+        between the calls. The thread closes them with _close_connections.
+        """
+        if self.storage is not None:
+            downloader = None
+            if connections is not None:
+                downloader = connections.get(self.mirrors[0], None)
+            self._make_room(file_pairs, downloader)
+        if len(self.mirrors) > 1:
+            out = self._download_mirrors(file_pairs, connections=connections)
+        else:
+            out = self._download_from(file_pairs, connections=connections)
+        self._update_missing(file_pairs, out)
+        return out
+
+    def _close_connections(self, connections):
+        """closes the downloaders that _fetch kept open in `connections`"""
+        while connections:
+            mirror, downloader = connections.popitem()
+            downloader.close_connection()
+            self.metrics.extend(downloader.metrics)
+
+    def _download_from(
+        self,
+        file_pairs,
+        njobs=1,
+        mirror=None,
+        manifest=None,
+        metrics=None,
+        connections=None,
+    ):
+        """
+        downloads the files from one server (see _download_data). Only a
+        single connection is kept open in `connections` (see _fetch).
+        """
+        if njobs == 'auto':
+            max_jobs = getattr(self.config['remote'], 'max_connections', 8)
+            return self._download_adaptive(
+                file_pairs, max_jobs, mirror, manifest, metrics
+            )
+        elif njobs == 1:
+            return self._download_single_process(
+                file_pairs,
+                mirror=mirror,
+                manifest=manifest,
+                metrics=metrics,
+                connections=connections,
+            )
+        njobs = max(1, min(njobs, len(file_pairs)))
+        return self._download_multiple_threads(
+            file_pairs, njobs, mirror, manifest, metrics
+        )
+
+    def _download_mirrors(
+        self, file_pairs, njobs=1, manifest=None, connections=None
+    ):
+        """
+        Downloads the files from the fastest healthy mirror (see
+        routing.MirrorSet). Files that fail or do not exist on a mirror are
+        tried on the next one. With more than one job the files are spread
+        over the mirrors, each with `njobs` connections. A file is only
+        `remote_not_exist` if no mirror has it.
+        """
+        from concurrent.futures import ThreadPoolExecutor
+        from .metrics import STATUS_NAMES, DownloadMetrics
+        from .routing import MirrorSet
+
+        mirrors = MirrorSet(self)
+        index = {m: i for i, m in enumerate(mirrors.mirrors)}
+        # local path: the remote path on each mirror
+        remotes, tried = {}, {}
+        for remote, local in file_pairs:
+            local = str(local)
+            remotes[local] = self._alternates.get(local, [str(remote)])
+            # files that are not in _alternates are only on the url
+            n = len(remotes[local])
+            tried[local] = set(mirrors.mirrors[n:])
+        failed = set()
+
+        def download(mirror, files):
+            pairs = [(remotes[f][index[mirror]], f) for f in files]
+            # the events of this call only, other threads may download
+            # files of the record at the same time
+            metrics = DownloadMetrics(record=self.name)
+            out = self._download_from(
+                pairs, njobs, mirror, manifest, metrics, connections
+            )
+            mirrors.observe(mirror, metrics.events)
+            self.metrics.extend(metrics)
+            return out
+
+        download_status = {k: [] for k in STATUS_NAMES.values()}
+        pending = list(remotes)
+        while pending:
+            samples = {
+                m: remotes[pending[0]][i]
+                for m, i in index.items()
+                if i < len(remotes[pending[0]])
+            }
+            assignments = mirrors.assign(
+                pending, mirrors.rank(samples), tried, spread=njobs != 1
+            )
+            # files without a mirror that can still be tried
+            assigned = {f for files in assignments.values() for f in files}
+            for local in pending:
+                if local not in assigned:
+                    key = 'failed' if local in failed else 'remote_not_exist'
+                    download_status[key] += (local,)
+            if not assignments:
+                break
+
+            with ThreadPoolExecutor(max_workers=len(assignments)) as pool:
+                futures = {
+                    mirror: pool.submit(download, mirror, files)
+                    for mirror, files in assignments.items()
+                }
+                results = {m: f.result() for m, f in futures.items()}
+
+            pending = []
+            for mirror, out in results.items():
+                for key, files in out.items():
+                    for local in map(str, files):
+                        tried[local].add(mirror)
+                        if key == 'failed':
+                            failed.add(local)
+                        if key in ('remote_not_exist', 'failed'):
+                            pending += (local,)
+                        else:
+                            download_status[key] += (local,)
+                retry = len(out['remote_not_exist']) + len(out['failed'])
+                if retry:
+                    self._print(
+                        f'{retry} {self.name} files not downloaded from '
+                        f'{mirror.key}, trying other mirrors'
+                    )
+
+        return download_status
+
+    def _download_queued(self, file_pairs, queue, mirror=False):
+        """
+        Puts the files in a work queue and waits until the workers have
+        reported all of them (see workqueue.py)
+        """
+        from .workqueue import WorkQueue
+
+        if not isinstance(queue, WorkQueue):
+            queue = WorkQueue(queue)
+        file_pairs = [
+            (str(remote), str(local)) for remote, local in file_pairs
+        ]
+        nfiles = queue.put(self, file_pairs, mirror=mirror)
+        self._print(f'Queued {nfiles} {self.name} files in {queue.path}')
+        files = [local for remote, local in file_pairs]
+        self.download_results = queue.wait(self.name, files)
+
+    def download_data(self, dates, njobs=1, mirror=False, queue=None):
         """
         Download files for given dates.
 
@@ -187,27 +740,51 @@ class Record:
                 1) a single datelike string or pandas.Timestamp
                 2) slice of datelike string or pandas.Timestamp
                 3) a pandas.DatetimeIndex object made with pandas.date_range
-        njobs: int
+        njobs: int or 'auto'
             number of parallel connections to download with. Be carefuly,
             some servers do not accept a large amount of connections.
+            With 'auto', the number of connections adapts to the server
+            up to `max_connections` in the catalog (default 8), and the
+            learned limit is remembered for the next session. If the
+            remote has `mirrors`, files come from the fastest mirror and
+            are tried on the others if they fail or are missing. With more
+            than one job the files are spread over the mirrors, with
+            `njobs` connections per mirror (see routing.py).
+        mirror: bool
+            if True, existing files are downloaded again when the remote
+            file has changed (size, modification time or ETag) since it was
+            downloaded. The remote metadata of downloaded files is kept in
+            a manifest per record (see mirror.Manifest).
+        queue: str or workqueue.WorkQueue
+            a work queue on a shared file system. The files are put in the
+            queue and downloaded by workers on any node (`brewery work
+            <queue>`, with their own njobs), and
+            download_data waits until the workers have reported all files.
+            Files fail if no worker claims or reports a file for longer
+            than the ttl of the queue (see WorkQueue.wait).
 
         Returns
         =======
         download_results: dict
             a dictionary containing information about downloaded, existing
-            and files that could not be downloaded.
+            and files that could not be downloaded. In mirror mode, files
+            that were downloaded again are listed under `updated`. Files
+            that are known to be missing on the remote (see
+            discover_coverage and `missing`) are not probed again and are
+            listed under `remote_not_exist`.
         """
-        from .utils import make_date_path_pairs
-
-        paths = make_date_path_pairs(
-            dates, self.config['remote']['url'], self.config['local_store']
-        )
+        paths, skipped = self._date_path_pairs(dates)
 
-        self._download_data(paths, njobs=njobs)
+        if queue is None:
+            self._download_data(paths, njobs=njobs, mirror=mirror)
+        else:
+            self._download_queued(paths, queue, mirror=mirror)
+        skipped = [local for remote, local in skipped]
+        self.download_results['remote_not_exist'] += skipped
 
         return self.download_results
 
-    def local_files(self, dates, njobs=1, auto_download=False):
+    def local_files(self, dates, njobs=1, auto_download=False, prefetch=None):
         """
         A wrapper around download_data that returns the names of
         local files. If the local files do not exist, then tries
@@ -220,12 +797,17 @@ class Record:
                 1) a single datelike string or pandas.Timestamp
                 2) slice of datelike string or pandas.Timestamp
                 3) a pandas.DatetimeIndex object made with pandas.date_range
-        njobs: int (1)
-            number of parallel connections to download with. Be carefuly,
-            some servers do not accept a large amount of connections.
+        njobs: int or 'auto' (1)
+            number of parallel connections to download with (see
+            download_data).
         auto_download: bool (False)
             will automatically download files if set to True, if False
             will ask for confirmation
+        prefetch: int or 'auto' (None)
+            downloads the files of the next `prefetch` dates in a
+            background thread while the files of these dates are used.
+            'auto' starts once the calls ask for sequential dates (see
+            prefetch.py)
 
         Returns
         =======
@@ -234,11 +816,18 @@ class Record:
             these files are exact replicas of the remote files and no
             processing has been applied.
         """
-        from .utils import is_file_valid, make_date_path_pairs, DictObject
+        from .utils import is_file_valid, DictObject
 
-        paths = make_date_path_pairs(
-            dates, self.config['remote']['url'], self.config['local_store']
-        )
+        if prefetch:
+            if self._prefetcher is None:
+                from .prefetch import Prefetcher
+
+                self._prefetcher = Prefetcher(self)
+            self._prefetcher.request(dates, prefetch)
+
+        # remote files that are known to be missing are skipped, which
+        # also prevents a loop of downloads
+        paths, skipped = self._date_path_pairs(dates)
 
         exists_locally = []
         download_pairs = []
@@ -246,8 +835,7 @@ class Record:
             if is_file_valid(path_local):
                 self.download_results['local_exists'] += (path_local,)
                 exists_locally += (path_local,)
-            # download results contains missing URLs - prevents loop download
-            elif path_remote not in self.download_results['remote_not_exist']:
+            elif path_local not in self.download_results['failed']:
                 download_pairs += ((path_remote, path_local),)
 
         if download_pairs != []:
@@ -260,6 +848,8 @@ class Record:
                 self._download_data(download_pairs, njobs)
                 return self.local_files(dates)
             else:
+                if self.storage is not None:
+                    self.storage.touch(exists_locally)
                 return exists_locally
         elif exists_locally is []:
             raise FileNotFoundError('No files returned for dates')
@@ -282,9 +872,19 @@ class Record:
                 print(summary)
                 print(DictObject(results))
             self._reset_download_results()
+            if self.storage is not None:
+                self.storage.touch(exists_locally)
 
             return exists_locally
 
+    def stop_prefetch(self):
+        """
+        Stops the background downloads of local_files and drops the files
+        that are queued
+        """
+        if self._prefetcher is not None:
+            self._prefetcher.stop()
+
 
 class PipeFiles:
     """
@@ -296,6 +896,8 @@ class PipeFiles:
     """
 
     def __init__(self, name, parent, pipe_dict):
+        self.name = name
+        self.profile = None
         self._parent = parent
         self._funcs = pipe_dict['functions']
         self._data_path = pipe_dict['data_path']
@@ -318,7 +920,8 @@ class PipeFiles:
 
         return paths
 
-    def _get_file_opener(self, name):
+    @staticmethod
+    def _get_file_opener(name):
         if name.endswith('.nc'):
             from xarray import open_dataset
 
@@ -326,7 +929,8 @@ class PipeFiles:
         else:
             return open
 
-    def _get_file_closer(self, obj):
+    @staticmethod
+    def _get_file_closer(obj):
         from xarray import Dataset, DataArray
         from pandas import Series, DataFrame
 
@@ -335,13 +939,116 @@ class PipeFiles:
         elif isinstance(obj, (DataFrame, Series)):
             return lambda s: obj.to_hdf(s, key='main')
 
-    def _pipeline(self, file_pairs):
-        from . import preprpocess as prep
+    def process(self, dates, profile=False, auto_download=False):
+        """
+        Applies the pipeline functions to the local files of the given
+        dates and saves the output to the pipeline data_path.
+
+        Parameters
+        ==========
+        dates: date-like string or object
+            see Record.local_files
+        profile: bool (False)
+            records the wall time, CPU time, peak memory and output size of
+            each function for every file. The profile of each file is
+            written to the `brew_profile` attribute of the output and the
+            aggregated table is returned by `pipe.profile.summary()`
+        auto_download: bool (False)
+            passed to Record.local_files for missing raw files
+
+        Returns
+        =======
+        processed_files: list
+            the file names of the processed files
+        """
+        from .utils import is_file_valid
+
+        self._parent.local_files(dates, auto_download=auto_download)
+
+        file_pairs = [
+            (local, processed)
+            for remote, local, processed in self(dates)
+            if is_file_valid(local)
+        ]
+        self._pipeline(file_pairs, profile=profile)
+
+        return [processed for local, processed in file_pairs]
+
+    def stream(self, dates, workers=None, njobs=1, evict=False, profile=False):
+        """
+        Downloads and processes the files of the given dates at the same
+        time: each raw file is processed in a process pool as soon as it is
+        downloaded, while the next files download (see stream.py).
+
+        The processes of the pool are spawned and import the main module
+        again, so a script must call stream under
+        `if __name__ == '__main__':`.
+
+        Parameters
+        ==========
+        dates: date-like string or object
+            see Record.local_files
+        workers: int
+            processes that run the pipeline functions, defaults to the
+            number of CPUs
+        njobs: int
+            files that are downloaded at the same time
+        evict: bool (False)
+            removes each raw file once its output is written
+        profile: bool (False)
+            see process
+
+        Returns
+        =======
+        processed_files: list
+            the file names of the processed files
+        """
+        from .stream import StreamExecutor
+
+        executor = StreamExecutor(self, workers=workers, njobs=njobs)
+        processed = executor.run(dates, evict=evict, profile=profile)
+        self.profile = executor.profile
+        return processed
+
+    def _pipeline(
+        self, file_pairs, profile=False, profile_attr='brew_profile'
+    ):
+        from .metrics import PipelineProfile
+
+        self.profile = PipelineProfile() if profile else None
 
         for file_raw, file_process in file_pairs:
-            opener = self._get_file_opener(file_raw)
+            self._process_file(
+                file_raw,
+                file_process,
+                self._funcs,
+                profile=self.profile,
+                profile_attr=profile_attr,
+            )
+
+    @staticmethod
+    def _process_file(
+        file_raw, file_process, funcs, profile=None, profile_attr=None
+    ):
+        """
+        Applies the functions to one raw file and writes the output. The
+        output is written to a temporary file first, so that an output
+        that exists is complete (see storage.StorageBudget.is_protected).
+        """
+        import os
+        from . import preprocess as prep
 
-            pipeline = [opener] + self._funcs
-            processed = prep.apply_process_pipeline(file_raw, pipeline)
-            closer = self._get_file_closer(processed)
-            closer(file_process)
+        opener = PipeFiles._get_file_opener(file_raw)
+
+        pipeline = [opener] + list(funcs)
+        processed = prep.apply_process_pipeline(
+            file_raw,
+            pipeline,
+            profile=profile,
+            profile_attr=profile_attr,
+        )
+        os.makedirs(os.path.dirname(file_process), exist_ok=True)
+        closer = PipeFiles._get_file_closer(processed)
+        partial = f'{file_process}.brew-process'
+        closer(partial)
+        os.replace(partial, file_process)
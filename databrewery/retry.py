@@ -0,0 +1,236 @@
+"""
+Retries of failed downloads and a circuit breaker per host.
+
+Errors are classified as retryable (dropped connections, timeouts, FTP 4xx,
+HTTP and S3 5xx/408/429, SSH errors) or fatal (wrong login, permission denied,
+FTP 5xx, HTTP 4xx, local disk errors). Retryable errors are retried with
+exponential backoff and jitter after reconnecting (see
+Downloader.download_file). When a host keeps failing, its circuit breaker
+opens and downloads from the host are parked (HostUnavailable) for a cool
+down period, while downloads from other hosts continue.
+"""
+import errno
+import random
+import threading
+import time
+
+RETRY_HTTP_CODES = (408, 425, 429)
+RETRY_ERRNOS = (
+    errno.ECONNRESET,
+    errno.ECONNABORTED,
+    errno.ECONNREFUSED,
+    errno.EPIPE,
+    errno.ETIMEDOUT,
+    errno.ENETUNREACH,
+    errno.EHOSTUNREACH,
+)
+
+_breakers = {}
+_breakers_lock = threading.Lock()
+
+
+class HostUnavailable(Exception):
+    """raised when the circuit breaker of a host is open"""
+
+    pass
+
+
+class IncompleteDownload(EOFError):
+    """raised when a downloaded file is smaller than the remote file"""
+
+    pass
+
+
+def http_status(error):
+    """
+    The HTTP status code of a requests.HTTPError or of a botocore
+    ClientError (S3), None for other errors.
+    """
+    response = getattr(error, 'response', None)
+    if isinstance(response, dict):
+        return response.get('ResponseMetadata', {}).get('HTTPStatusCode')
+    return getattr(response, 'status_code', None)
+
+
+def is_retryable(error):
+    """
+    True if the error is transient, i.e. the download may succeed if it is
+    tried again (after reconnecting).
+    """
+    import ftplib
+    import socket
+
+    if isinstance(error, HostUnavailable):
+        return False
+
+    # HTTP (requests.HTTPError has the response) and S3
+    status_code = http_status(error)
+    if status_code is not None:
+        return (status_code in RETRY_HTTP_CODES) or (status_code >= 500)
+    try:
+        from requests import exceptions as rex
+
+        retry = (rex.ConnectionError, rex.Timeout, rex.ChunkedEncodingError)
+        if isinstance(error, retry):
+            return True
+        if isinstance(error, rex.RequestException):
+            return False
+        # read timeouts of the raw stream of a response (see HTTP)
+        from urllib3 import exceptions as uex
+
+        if isinstance(error, (uex.TimeoutError, uex.ProtocolError)):
+            return True
+    except ImportError:
+        pass
+
+    try:
+        from botocore import exceptions as bex
+
+        retry = (bex.ConnectionError, bex.HTTPClientError)
+        if isinstance(error, retry + (bex.IncompleteReadError,)):
+            return True
+        if isinstance(error, bex.BotoCoreError):
+            return False
+    except ImportError:
+        pass
+
+    # FTP: 4xx replies are temporary, 5xx are permanent
+    if isinstance(error, ftplib.error_perm):
+        return False
+    if isinstance(error, (ftplib.error_temp, ftplib.error_reply)):
+        return True
+    if isinstance(error, (ftplib.error_proto, EOFError)):
+        return True
+
+    # SFTP
+    try:
+        import paramiko
+
+        if isinstance(error, paramiko.AuthenticationException):
+            return False
+        if isinstance(error, paramiko.SSHException):
+            return True
+    except ImportError:
+        pass
+
+    if isinstance(error, (ConnectionError, TimeoutError, socket.timeout)):
+        return True
+    # cdsapi raises a bare Exception when its own retries are used up
+    if (type(error) is Exception) and (str(error) == 'Could not connect'):
+        return True
+    if isinstance(error, OSError):
+        # paramiko raises OSError('Socket is closed') without an errno
+        closed = str(error) == 'Socket is closed'
+        return closed or (error.errno in RETRY_ERRNOS)
+    return False
+
+
+class RetryPolicy:
+    """
+    Exponential backoff with jitter: the n-th retry waits a random time
+    between (1 - jitter) and 1 times backoff * 2 ** n, but no longer than
+    max_backoff seconds. The jitter spreads out the retries of parallel
+    connections so that they do not hit a recovering server together.
+    """
+
+    def __init__(self, retries=3, backoff=1.0, max_backoff=60, jitter=0.5):
+        """
+        Parameters
+        ==========
+        retries: int
+            the number of times a failed download is tried again
+        backoff: float
+            the wait in seconds before the first retry
+        max_backoff: float
+            the maximum wait in seconds
+        jitter: float
+            the fraction (0-1) of the wait that is random
+        """
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.jitter = jitter
+
+    def __repr__(self):
+        return (
+            f'{self.__class__.__name__}(retries={self.retries}, '
+            f'backoff={self.backoff}, max_backoff={self.max_backoff})'
+        )
+
+    def delay(self, attempt):
+        """seconds to wait before retry number `attempt` (starts at 0)"""
+        wait = min(self.backoff * 2 ** attempt, self.max_backoff)
+        return wait * (1 - self.jitter * random.random())
+
+    def should_retry(self, error, attempt):
+        return (attempt < self.retries) and is_retryable(error)
+
+
+def get_breaker(host, **kwargs):
+    """returns the CircuitBreaker of the host (shared by all downloaders)"""
+    with _breakers_lock:
+        if host not in _breakers:
+            _breakers[host] = CircuitBreaker(host, **kwargs)
+        return _breakers[host]
+
+
+class CircuitBreaker:
+    """
+    Stops downloads from a host that keeps failing.
+
+    The breaker opens after `threshold` failures in a row (of all
+    connections to the host). While open, check() raises HostUnavailable.
+    After `cooldown` seconds one trial download is let through (half open):
+    if it succeeds the breaker closes, otherwise it opens again.
+    """
+
+    def __init__(self, host, threshold=5, cooldown=60):
+        self.host = host
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.failures = 0
+        self.opened = None
+        self._trial = False
+        self._lock = threading.Lock()
+
+    def __repr__(self):
+        return (
+            f'{self.__class__.__name__}({self.host}, state={self.state}, '
+            f'failures={self.failures})'
+        )
+
+    @property
+    def state(self):
+        if self.opened is None:
+            return 'closed'
+        if time.time() - self.opened < self.cooldown:
+            return 'open'
+        return 'half-open'
+
+    def check(self):
+        """raises HostUnavailable if downloads from the host are parked"""
+        with self._lock:
+            state = self.state
+            if state == 'closed':
+                return
+            if (state == 'half-open') and not self._trial:
+                self._trial = True
+                return
+        wait = self.cooldown - (time.time() - self.opened)
+        raise HostUnavailable(
+            f'{self.host} failed {self.failures} times in a row, '
+            f'downloads are parked for {max(wait, 0):.0f} s'
+        )
+
+    def success(self):
+        with self._lock:
+            self.failures = 0
+            self.opened = None
+            self._trial = False
+
+    def failure(self):
+        with self._lock:
+            self.failures += 1
+            if self._trial or (self.failures >= self.threshold):
+                self.opened = time.time()
+                self._trial = False
@@ -0,0 +1,315 @@
+"""
+Mirrors: several servers that host the same files of a record.
+
+The remote block of a catalog entry can list `mirrors` after the `url`,
+either as URL templates or as blocks with a url and their own login
+(username, password or service, port). The URL templates are formatted
+with the same dates as the url, so that every mirror has a remote path
+for each local file.
+
+The mirrors are ranked by the expected time to download a file: the
+latency (the time to connect, probed once per PROBE_TTL) plus a typical
+file over the throughput that was measured in earlier downloads. Mirrors
+that could not be reached, or whose circuit breaker is open (see
+retry.CircuitBreaker), are skipped. The speeds are kept between sessions
+(see state.JSONStore).
+
+Files go to the fastest mirror. A file that fails or does not exist on a
+mirror is tried on the next one (see Record.download_data). With more than
+one job a batch is spread over the mirrors in proportion to their speed.
+
+A record with a `cache` only downloads from the read-through cache (see
+cache_mirror and serve.py).
+"""
+import os
+import time
+
+# seconds after which the latency of a mirror is probed again
+PROBE_TTL = 3600
+# seconds that a mirror that could not be reached is skipped
+DOWN_TTL = 300
+# bytes of a typical file, weighs the latency against the throughput
+TYPICAL_FILE_SIZE = 16 * 2 ** 20
+# weight of the latest measurement in the moving average of the throughput
+SPEED_SMOOTHING = 0.3
+# the remote options that are the login of the url (not of the mirrors)
+CREDENTIALS = ('username', 'password', 'service')
+
+
+class Mirror:
+    """
+    a server of a record: the URL template and the login options. The
+    speeds are kept per server (key), mirrors are equal if they also have
+    the same URL template.
+    """
+
+    def __init__(self, url, login):
+        """
+        Parameters
+        ==========
+        url: utils.URL
+            the URL template of the remote files
+        login: dict
+            keyword arguments for the downloader (username, port, ...)
+        """
+        self.url = url
+        self.login = login
+        port = login.get('port', None)
+        self.host = url.parsed.netloc
+        self.key = self.host if port is None else f'{self.host}:{port}'
+
+    def __repr__(self):
+        return f'{self.__class__.__name__}({self.key})'
+
+    def __eq__(self, other):
+        if not isinstance(other, Mirror):
+            return False
+        return (self.key, str(self.url)) == (other.key, str(other.url))
+
+    def __hash__(self):
+        return hash((self.key, str(self.url)))
+
+    @property
+    def breaker(self):
+        """the circuit breaker of the host (shared with the downloaders)"""
+        from .retry import get_breaker
+
+        return get_breaker(self.host)
+
+
+def get_mirrors(remote):
+    """
+    The Mirror of the url and of each entry in `mirrors` of a remote
+    block (see config.py), in the order of the catalog.
+
+    Parameters
+    ==========
+    remote: utils.DictObject
+        the remote block of a catalog entry
+    """
+    from .utils import URL
+
+    options = remote.__dict__.copy()
+    url = options.pop('url')
+    options.pop('max_connections', None)
+    options.pop('cache', None)
+    entries = options.pop('mirrors', [])
+
+    mirrors = [Mirror(url, options)]
+    for entry in entries:
+        login = {k: v for k, v in options.items() if k != 'port'}
+        if isinstance(entry, str):
+            mirrors += (Mirror(URL(entry), login),)
+            continue
+        entry = entry.__dict__.copy()
+        if 'username' in entry:
+            # the mirror has its own account
+            login = {k: v for k, v in login.items() if k not in CREDENTIALS}
+        login.update(entry)
+        mirrors += (Mirror(URL(login.pop('url')), login),)
+    return mirrors
+
+
+def store_root(date_path):
+    """the directory of a DatePath up to the first date placeholder"""
+    path = str(date_path)
+    head = path.split('{', 1)[0]
+    if head == path:
+        return os.path.dirname(path)
+    return head.rsplit(os.sep, 1)[0]
+
+
+def cache_mirror(record):
+    """
+    The Mirror of the read-through cache of a record (see serve.py): the
+    url template is the local_store below its root, on the cache server.
+    """
+    from .utils import URL
+
+    local_store = str(record.config.local_store)
+    path = os.path.relpath(local_store, store_root(local_store))
+    cache = record.cache.parsed
+    # the port is given to the downloader (see Downloader._check_host_valid)
+    base = cache._replace(netloc=cache.hostname).geturl().rstrip('/')
+    url = URL(f'{base}/records/{record.name}/{path}')
+    # the cache does not list directories: files are downloaded on request
+    login = dict(directory_index=False)
+    if cache.port is not None:
+        login['port'] = cache.port
+    for key in ('retries', 'retry_backoff', 'buffer_size', 'segments'):
+        if hasattr(record.config.remote, key):
+            login[key] = record.config.remote[key]
+    return Mirror(url, login)
+
+
+class MirrorSet:
+    """
+    Ranks the mirrors of a record by their speed and assigns files to them.
+    """
+
+    def __init__(self, record, mirrors=None, store='mirrors.json'):
+        """
+        Parameters
+        ==========
+        record: Record
+            connections are made with record._initiate_connection
+        mirrors: list
+            Mirror objects, by default those of the record
+        store: str
+            the state file where the speeds are kept
+        """
+        from .state import JSONStore
+
+        self.record = record
+        self.mirrors = record.mirrors if mirrors is None else mirrors
+        self.store = JSONStore(store)
+
+    def __repr__(self):
+        return f'{self.__class__.__name__}({self.mirrors})'
+
+    def __len__(self):
+        return len(self.mirrors)
+
+    def stats(self, mirror):
+        """latency, throughput, checked and down of a mirror (or None)"""
+        empty = dict(latency=None, throughput=None, checked=0, down=None)
+        return {**empty, **self.store.get(mirror.key, {})}
+
+    def _save(self, mirror, **stats):
+        self.store[mirror.key] = {**self.stats(mirror), **stats}
+
+    def probe(self, mirror, remote=None):
+        """
+        Connects to the mirror and asks for the metadata of the `remote`
+        file (see Downloader.remote_stat). The time it took is stored as the
+        latency. Returns False (and the mirror is down for DOWN_TTL) if the
+        mirror could not be reached or refused the login.
+        """
+        from .retry import is_retryable
+
+        t0 = time.perf_counter()
+        try:
+            downloader = self.record._initiate_connection(
+                mirror=mirror, retries=0
+            )
+            try:
+                if remote is not None:
+                    downloader.remote_stat(remote)
+            finally:
+                downloader.close_connection()
+        except Exception as error:
+            if is_retryable(error):
+                mirror.breaker.failure()
+            self._save(mirror, checked=time.time(), down=time.time())
+            return False
+        latency = time.perf_counter() - t0
+        self._save(mirror, latency=latency, checked=time.time(), down=None)
+        return True
+
+    def healthy(self, mirror):
+        """False if the mirror was down recently or its breaker is open"""
+        if mirror.breaker.state == 'open':
+            return False
+        down = self.stats(mirror)['down']
+        return (down is None) or (time.time() - down >= DOWN_TTL)
+
+    def expected_time(self, mirror):
+        """
+        Seconds to download a typical file from the mirror. Mirrors with
+        an unknown throughput are given the best known throughput, so that
+        they are tried.
+        """
+        stats = self.stats(mirror)
+        speeds = [self.stats(m)['throughput'] for m in self.mirrors]
+        speeds = [s for s in speeds if s]
+        throughput = stats['throughput'] or max(speeds, default=None)
+        expected = stats['latency'] or 0.0
+        if throughput:
+            expected += TYPICAL_FILE_SIZE / throughput
+        return expected
+
+    def rank(self, samples=None):
+        """
+        The healthy mirrors from fastest to slowest. Mirrors whose latency
+        is older than PROBE_TTL are probed first.
+
+        Parameters
+        ==========
+        samples: dict
+            mirror: the remote path of a file that is used for the probe
+        """
+        samples = {} if samples is None else samples
+        healthy = []
+        for mirror in self.mirrors:
+            if not self.healthy(mirror):
+                continue
+            if time.time() - self.stats(mirror)['checked'] >= PROBE_TTL:
+                if not self.probe(mirror, samples.get(mirror, None)):
+                    continue
+            healthy += (mirror,)
+        # sorted is stable: mirrors with the same speed keep their order
+        return sorted(healthy, key=self.expected_time)
+
+    def observe(self, mirror, events):
+        """
+        Updates the throughput of the mirror with the downloaded files of
+        the metrics events (see metrics.EVENT_FIELDS).
+        """
+        nbytes, seconds = 0, 0.0
+        for event in events:
+            if event['status'] not in ('downloaded', 'updated'):
+                continue
+            nbytes += event['bytes'] or 0
+            seconds += event['total'] - (event['connect'] or 0.0)
+        if (nbytes == 0) or (seconds <= 0):
+            return
+        throughput = nbytes / seconds
+        previous = self.stats(mirror)['throughput']
+        if previous:
+            throughput = (
+                SPEED_SMOOTHING * throughput
+                + (1 - SPEED_SMOOTHING) * previous
+            )
+        self._save(mirror, throughput=throughput)
+
+    def assign(self, files, ranked, tried=None, spread=False):
+        """
+        Assigns files to mirrors.
+
+        Parameters
+        ==========
+        files: list
+            local paths
+        ranked: list
+            the healthy mirrors from fastest to slowest (see rank)
+        tried: dict
+            local path: set of the mirrors that were tried for the file
+        spread: bool
+            if True the files are spread over the mirrors in proportion to
+            their speed (1 / expected time), otherwise each file goes to the
+            fastest mirror that was not tried
+
+        Returns
+        =======
+        assignments: dict
+            mirror: list of local paths. Files without a mirror that was not
+            tried are left out
+        """
+        tried = {} if tried is None else tried
+        weights = {m: 1 / max(self.expected_time(m), 1e-3) for m in ranked}
+        assignments = {}
+        for local in files:
+            candidates = [m for m in ranked if m not in tried.get(local, ())]
+            if not candidates:
+                continue
+            if spread:
+
+                def load(mirror):
+                    count = len(assignments.get(mirror, []))
+                    return (count + 1) / weights[mirror]
+
+                mirror = min(candidates, key=load)
+            else:
+                mirror = candidates[0]
+            assignments.setdefault(mirror, []).append(local)
+        return assignments
@@ -0,0 +1,392 @@
+"""
+Catalog-wide download scheduler (see Catalog.sync).
+
+Files of all selected records go into one scheduler that is served by a
+pool of connections. When a connection is free, the scheduler picks the
+host with the fewest active connections (relative to its priority) among
+the hosts that are below their own limit, and then the record of that host
+that has had the smallest share of downloads relative to its priority. A
+host that is slow or at its limit therefore does not hold up the others:
+free connections are filled with work for other hosts.
+"""
+import threading
+import time
+from collections import deque
+
+STATUS_KEYS = {
+    0: 'downloaded',
+    1: 'remote_not_exist',
+    2: 'local_exists',
+    3: 'updated',
+    4: 'failed',
+}
+
+
+class SyncScheduler:
+    """
+    Fair scheduler of (record, remote, local) download tasks.
+
+    Hosts are shared fairly: each host gets at most `per_host` connections
+    and free connections go to the host with the fewest active connections
+    per unit of priority. Within a host, records are served by weighted
+    fair queuing on the number of files served divided by the priority.
+    """
+
+    def __init__(self, tasks, per_host=None, priorities=None):
+        """
+        Parameters
+        ==========
+        tasks: list
+            (record, remote, local) tuples, where record is a Record
+        per_host: int, dict or 'auto'
+            the maximum number of connections per host. A dictionary maps
+            hosts (routing.Mirror.key, host:port if the remote has a port)
+            to limits (hosts that are missing are not limited).
+            With 'auto' the limits adapt to the servers (see
+            concurrency.HostLimiter)
+        priorities: dict
+            record name: weight (default 1). A record with weight 2 gets
+            twice the share of connections of a record with weight 1
+        """
+        self.per_host = per_host
+        self.priorities = {} if priorities is None else priorities
+
+        self.queues = {}  # host: {record name: deque of tasks}
+        self.records = {}
+        for record, remote, local in tasks:
+            host = record.mirrors[0].key
+            host_queues = self.queues.setdefault(host, {})
+            queue = host_queues.setdefault(record.name, deque())
+            queue.append((record, remote, local, 0))
+            self.records[record.name] = record
+
+        self.active = {host: 0 for host in self.queues}
+        self.served = {name: 0 for name in self.records}
+        self.limiters = {}
+        if per_host == 'auto':
+            from .concurrency import get_limiter
+
+            for host in self.queues:
+                self.limiters[host] = get_limiter(host)
+
+        self._cond = threading.Condition()
+        self._stopped = False
+
+    def __len__(self):
+        return sum(len(q) for hq in self.queues.values() for q in hq.values())
+
+    def __repr__(self):
+        return (
+            f'{self.__class__.__name__}(hosts={len(self.queues)}, '
+            f'records={len(self.records)}, pending={len(self)})'
+        )
+
+    def _priority(self, name):
+        return float(self.priorities.get(name, 1))
+
+    def _host_limit(self, host):
+        if isinstance(self.per_host, dict):
+            return self.per_host.get(host, None)
+        elif self.per_host == 'auto':
+            return int(self.limiters[host].limit)
+        return self.per_host
+
+    def _host_priority(self, host):
+        names = [n for n, q in self.queues[host].items() if q]
+        return max(self._priority(n) for n in names)
+
+    def _pick(self, current=None):
+        """returns the next task or None if all hosts are busy"""
+        hosts = []
+        for host, host_queues in self.queues.items():
+            if not any(host_queues.values()):
+                continue
+            limit = self._host_limit(host)
+            if (limit is not None) and (self.active[host] >= limit):
+                continue
+            hosts += (host,)
+        if not hosts:
+            return None
+
+        def host_key(host):
+            share = self.active[host] / self._host_priority(host)
+            return share, host != current
+
+        host = min(hosts, key=host_key)
+        names = [n for n, q in self.queues[host].items() if q]
+
+        def record_key(name):
+            share = self.served[name] / self._priority(name)
+            return share, name != current
+
+        name = min(names, key=record_key)
+        if self.limiters:
+            epoch = self.limiters[host].try_acquire()
+            if epoch is None:
+                return None
+        else:
+            epoch = None
+
+        self.active[host] += 1
+        self.served[name] += 1
+        record, remote, local, attempt = self.queues[host][name].popleft()
+        return dict(
+            host=host,
+            record=record,
+            remote=remote,
+            local=local,
+            attempt=attempt,
+            epoch=epoch,
+        )
+
+    def next_task(self, current=None):
+        """
+        Waits for the next task. Returns None when all files are done.
+
+        Parameters
+        ==========
+        current: str
+            the record that the worker is connected to; it is preferred
+            when the shares are equal, so that connections are reused
+        """
+        with self._cond:
+            while True:
+                if self._stopped:
+                    return None
+                task = self._pick(current)
+                if task is not None:
+                    return task
+                # nothing left and no running task can put one back
+                if (len(self) == 0) and (sum(self.active.values()) == 0):
+                    return None
+                self._cond.wait(timeout=1)
+
+    def task_done(self, task, requeue=False):
+        """frees the connection of the task and puts it back if requeue"""
+        with self._cond:
+            self.active[task['host']] -= 1
+            if task['epoch'] is not None:
+                self.limiters[task['host']].release()
+            if requeue:
+                name = task['record'].name
+                self.served[name] -= 1
+                item = (
+                    task['record'],
+                    task['remote'],
+                    task['local'],
+                    task['attempt'] + 1,
+                )
+                self.queues[task['host']][name].appendleft(item)
+            self._cond.notify_all()
+
+    def drop_host(self, host):
+        """removes the waiting tasks of a host and returns them"""
+        with self._cond:
+            dropped = []
+            for queue in self.queues[host].values():
+                dropped += [
+                    (r, remote, local) for r, remote, local, a in queue
+                ]
+                queue.clear()
+            return dropped
+
+    def drop_record(self, name):
+        """removes the waiting tasks of a record and returns them"""
+        with self._cond:
+            host = self.records[name].mirrors[0].key
+            queue = self.queues[host][name]
+            dropped = [(r, remote, local) for r, remote, local, a in queue]
+            queue.clear()
+            return dropped
+
+    def stop(self):
+        with self._cond:
+            self._stopped = True
+            self._cond.notify_all()
+
+
+def sync(
+    records,
+    dates,
+    max_connections=8,
+    per_host=None,
+    priorities=None,
+    mirror=False,
+):
+    """
+    Downloads the files of several records with one pool of connections.
+    See Catalog.sync for the parameters.
+
+    Returns
+    =======
+    results: dict
+        record name: download results (downloaded, remote_not_exist,
+        local_exists, updated, failed)
+    errors: dict
+        record name: the error that stopped the record
+    """
+    import os
+    from concurrent.futures import ThreadPoolExecutor
+    from warnings import warn
+    from .concurrency import is_overload_error
+    from .download import Downloader
+    from .retry import HostUnavailable, is_retryable
+
+    results = {}
+    for record in records:
+        results[record.name] = {k: [] for k in STATUS_KEYS.values()}
+    errors = {}
+    lock = threading.Lock()
+
+    def add_result(name, key, local):
+        with lock:
+            results[name][key] += (local,)
+
+    # the CDS queues and batches requests itself (see CDS.download_files)
+    # and records with mirrors are downloaded from the fastest mirror (see
+    # Record._download_mirrors): both are downloaded with download_data
+    direct_records = []
+    tasks = []
+    probed = {}
+    for record in records:
+        remote_url = record.config.remote.url
+        if (remote_url.parsed.scheme == 'cds') or (len(record.mirrors) > 1):
+            direct_records += (record,)
+            continue
+        # remote files that are known to be missing are not probed again
+        pairs, skipped = record._date_path_pairs(dates)
+        skipped = [local for remote, local in skipped]
+        results[record.name]['remote_not_exist'] += skipped
+        probed[record.name] = pairs
+        if record.storage is not None:
+            record._make_room(pairs)
+        for remote, local in pairs:
+            # existing files do not need a connection (unless mirroring)
+            if (not mirror) and Downloader.is_local_file_valid(local):
+                results[record.name]['local_exists'] += (local,)
+            else:
+                tasks += ((record, remote, local),)
+
+    scheduler = SyncScheduler(tasks, per_host=per_host, priorities=priorities)
+    nworkers = max(1, min(max_connections, len(tasks)))
+    retry_overload = per_host != 'auto'
+
+    def fail_files(dropped, error):
+        for record, remote, local in dropped:
+            add_result(record.name, 'failed', local)
+        if dropped:
+            warn(f'{len(dropped)} files failed: {error}')
+
+    def close(downloader, record):
+        if downloader is not None:
+            downloader.close_connection()
+            record.metrics.extend(downloader.metrics)
+
+    def worker():
+        # the connection of the worker and the record it belongs to
+        downloader, connected = None, None
+        while True:
+            current = None if connected is None else connected.name
+            task = scheduler.next_task(current)
+            if task is None:
+                break
+            record, local = task['record'], task['local']
+            try:
+                if connected is not record:
+                    close(downloader, connected)
+                    downloader, connected = None, None
+                    kwargs = dict(retry_overload=retry_overload)
+                    if mirror:
+                        kwargs['manifest'] = record.manifest
+                    downloader = record._initiate_connection(**kwargs)
+                    downloader.verbose = min(record.verbose, 1)
+                    downloader.metrics.record = record.name
+                    connected = record
+                downloader.queue_depth = len(scheduler)
+                t0 = time.perf_counter()
+                msg = downloader.download_file(task['remote'], local)
+            except Exception as error:
+                # removes the partially downloaded file
+                partial = getattr(downloader, 'current_local', None)
+                if (partial is not None) and os.path.isfile(partial):
+                    os.remove(partial)
+                close(downloader, connected)
+                downloader, connected = None, None
+
+                overload = is_overload_error(error)
+                if overload and (task['epoch'] is not None):
+                    if task['attempt'] < 5:
+                        limiter = scheduler.limiters[task['host']]
+                        limiter.overload(task['epoch'])
+                        scheduler.task_done(task, requeue=True)
+                        time.sleep(0.1 * 2 ** task['attempt'])
+                        continue
+
+                scheduler.task_done(task)
+                add_result(record.name, 'failed', local)
+                if isinstance(error, HostUnavailable):
+                    # parks the host, the other hosts continue
+                    fail_files(scheduler.drop_host(task['host']), error)
+                elif not is_retryable(error):
+                    # a fatal error (e.g. wrong login) stops the record
+                    with lock:
+                        errors[record.name] = error
+                    fail_files(scheduler.drop_record(record.name), error)
+                continue
+
+            scheduler.task_done(task)
+            add_result(record.name, STATUS_KEYS[msg], local)
+            if (task['epoch'] is not None) and (msg in (0, 3)):
+                event = downloader.metrics.events[-1]
+                scheduler.limiters[task['host']].success(
+                    time.perf_counter() - t0,
+                    event['bytes'] or 0,
+                    event['first_byte'],
+                )
+
+        close(downloader, connected)
+
+    def download_direct(record):
+        njobs = 1
+        if record.config.remote.url.parsed.scheme != 'cds':
+            # connections per mirror
+            njobs = per_host
+            if isinstance(per_host, dict):
+                njobs = per_host.get(record.mirrors[0].key, None)
+        try:
+            return record.download_data(dates, njobs=njobs or 1, mirror=mirror)
+        except Exception as error:
+            with lock:
+                errors[record.name] = error
+
+    nthreads = nworkers + len(direct_records)
+    with ThreadPoolExecutor(max_workers=nthreads) as pool:
+        futures = [pool.submit(worker) for _ in range(nworkers)]
+        direct_futures = [
+            pool.submit(download_direct, r) for r in direct_records
+        ]
+        try:
+            [future.result() for future in futures]
+        except KeyboardInterrupt as error:
+            # signals reach the main thread only: the workers stop after
+            # their current file
+            scheduler.stop()
+            raise error
+        for record, future in zip(direct_records, direct_futures):
+            out = future.result()
+            if out is not None:
+                results[record.name].update(out)
+
+    for limiter in scheduler.limiters.values():
+        limiter.save()
+    for record in records:
+        if record.name in probed:
+            record._update_missing(probed[record.name], results[record.name])
+        record.download_results = results[record.name]
+        if mirror:
+            record.manifest.flush()
+    if errors:
+        for name, error in errors.items():
+            warn(f'{name} stopped with {type(error).__name__}: {error}')
+
+    return results, errors
@@ -0,0 +1,269 @@
+"""
+A read-through cache of the local_store for other nodes (`brewery serve`).
+
+The server gives the files of the records of a catalog over HTTP (with
+Range requests):
+
+    /records/<record>/<path in the local_store>
+    /pipelines/<record>/<pipeline>/<path in the data_path>
+
+A file of a record that is not in the local_store is downloaded from the
+remote of the record first (see Record.download_data), and requests for a
+file that is being downloaded wait for that download. Pipeline outputs are
+only served if they exist.
+
+Other catalogs point their records at the cache with the `cache` option
+of the remote block (e.g. cache: http://node:8080). The files are then
+downloaded from the cache instead of the url, so that a cluster downloads
+each file from the remote once. The paths below the local_store (and the
+record names) must be the same in both catalogs.
+"""
+import os
+import re
+import threading
+from concurrent.futures import Future
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+
+from .routing import store_root
+
+# the port of `brewery serve`
+CACHE_PORT = 8080
+# bytes per write to the socket
+SEND_BUFFER = 2 ** 20
+
+RANGE = re.compile(r'bytes=(\d*)-(\d*)$')
+
+
+# http.server.ThreadingHTTPServer is new in Python 3.7
+class CacheServer(ThreadingMixIn, HTTPServer):
+    """
+    Serves the local_store of the records of a catalog and downloads
+    missing files from their remotes. Concurrent requests for a file that
+    is missing are merged into one download.
+    """
+
+    daemon_threads = True
+
+    def __init__(self, catalog, address=('', CACHE_PORT), records=None):
+        """
+        Parameters
+        ==========
+        catalog: Catalog
+            the records that are served. Their own `cache` is ignored
+        address: tuple
+            (host, port) of the server
+        records: list
+            names of the records to serve, defaults to all records
+        """
+        from .record import Record
+
+        super().__init__(address, CacheHandler)
+        self.verbose = catalog.verbose
+        self.records = {}
+        for name, record in vars(catalog).items():
+            if not isinstance(record, Record):
+                continue
+            if (records is None) or (name in records):
+                # files are downloaded from the remote, not from a cache
+                record.cache = None
+                self.records[name] = record
+        self._downloads = {}  # local path: Future of the status
+        self._lock = threading.Lock()
+
+    def __repr__(self):
+        host, port = self.server_address[:2]
+        return f'{self.__class__.__name__}({host}:{port}, {len(self.records)})'
+
+    def resolve(self, path):
+        """
+        The local path of a request path and the record it belongs to
+        (None for pipeline outputs). Returns (None, None) if the path is
+        not a file of a record.
+        """
+        from urllib.parse import unquote
+
+        parts = unquote(path.split('?', 1)[0]).strip('/').split('/')
+        if (parts[0] == 'records') and (len(parts) > 2):
+            record = self.records.get(parts[1], None)
+            if record is None:
+                return None, None
+            root = store_root(record.config.local_store)
+            rest = parts[2:]
+        elif (parts[0] == 'pipelines') and (len(parts) > 3):
+            record = self.records.get(parts[1], None)
+            pipe = getattr(record, parts[2], None)
+            data_path = getattr(pipe, '_data_path', None)
+            if data_path is None:
+                return None, None
+            record = None
+            root = store_root(data_path)
+            rest = parts[3:]
+        else:
+            return None, None
+
+        root = os.path.normpath(os.path.expanduser(root))
+        local = os.path.normpath(os.path.join(root, *rest))
+        # no paths outside of the local_store (e.g. /../)
+        if not local.startswith(root + os.sep):
+            return None, None
+        return local, record
+
+    def fetch(self, record, local):
+        """
+        Downloads a missing file of the record. Returns the status of
+        download_results (local_exists if the file is there).
+        """
+        from .utils import get_dates, parse_date
+
+        if os.path.isfile(local):
+            return 'local_exists'
+
+        def normpath(path):
+            return os.path.normpath(os.path.expanduser(str(path)))
+
+        date = parse_date(normpath(record.config.local_store), local)
+        if date is None:
+            return 'remote_not_exist'
+        pairs, skipped = record._date_path_pairs(get_dates([date]))
+        pairs = [(str(r), str(l)) for r, l in pairs if normpath(l) == local]
+        if not pairs:
+            return 'remote_not_exist'
+
+        with self._lock:
+            future = self._downloads.get(local, None)
+            owner = future is None
+            if owner:
+                future = self._downloads[local] = Future()
+        if not owner:
+            # downloaded by another request
+            return future.result()
+
+        try:
+            out = record._fetch(pairs)
+            future.set_result([k for k, files in out.items() if files][0])
+        except BaseException as error:
+            future.set_exception(error)
+        finally:
+            with self._lock:
+                del self._downloads[local]
+        return future.result()
+
+
+class CacheHandler(BaseHTTPRequestHandler):
+    """GET and HEAD requests of the CacheServer"""
+
+    server_version = 'brewery'
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        if self.server.verbose >= 2:
+            super().log_message(format, *args)
+
+    def do_GET(self):
+        self.send_file(body=True)
+
+    def do_HEAD(self):
+        self.send_file(body=False)
+
+    def send_file(self, body=True):
+        from email.utils import formatdate
+
+        local, record = self.server.resolve(self.path)
+        if local is None:
+            return self.send_error(404)
+        if os.path.isdir(local):
+            # the listing of a cache is incomplete
+            return self.send_error(403, 'Directory listings are off')
+        if record is not None:
+            try:
+                status = self.server.fetch(record, local)
+            except Exception as error:
+                return self.send_error(502, str(error))
+            if status == 'failed':
+                return self.send_error(502, 'Upstream download failed')
+        if not os.path.isfile(local):
+            return self.send_error(404)
+
+        file = open(local, 'rb')
+        try:
+            stat = os.fstat(file.fileno())
+            start, stop = 0, stat.st_size
+            match = RANGE.match(self.headers.get('Range', ''))
+            if match is not None:
+                first, last = match.groups()
+                if first:
+                    start = int(first)
+                    stop = min(int(last) + 1 if last else stop, stop)
+                elif last:
+                    start = max(stop - int(last), 0)
+                if start >= stop:
+                    self.send_response(416)
+                    self.send_header('Content-Range', f'bytes */{stop}')
+                    self.send_header('Content-Length', '0')
+                    return self.end_headers()
+                self.send_response(206)
+                content_range = f'bytes {start}-{stop - 1}/{stat.st_size}'
+                self.send_header('Content-Range', content_range)
+            else:
+                self.send_response(200)
+            self.send_header('Content-Type', 'application/octet-stream')
+            self.send_header('Content-Length', str(stop - start))
+            self.send_header('Accept-Ranges', 'bytes')
+            modified = formatdate(stat.st_mtime, usegmt=True)
+            self.send_header('Last-Modified', modified)
+            etag = f'"{stat.st_size:x}-{int(stat.st_mtime):x}"'
+            self.send_header('ETag', etag)
+            self.end_headers()
+            if body:
+                file.seek(start)
+                self.copy(file, stop - start)
+        finally:
+            file.close()
+
+    def copy(self, file, count):
+        """writes `count` bytes of the file to the socket"""
+        try:
+            self.connection.sendfile(file, offset=file.tell(), count=count)
+        except (AttributeError, OSError):
+            # e.g. a TLS socket
+            while count > 0:
+                data = file.read(min(SEND_BUFFER, count))
+                if not data:
+                    break
+                self.wfile.write(data)
+                count -= len(data)
+
+
+def serve(catalog_file, host='', port=CACHE_PORT, records=None, verbose=1):
+    """
+    Serves the local_store of the catalog until interrupted (see
+    CacheServer).
+
+    Parameters
+    ==========
+    catalog_file: str
+        the catalog with the records that are served
+    host: str
+        the address to listen on, all addresses by default
+    port: int
+        the port to listen on
+    records: list
+        names of the records to serve, defaults to all records
+    verbose: int
+        1 prints the address, 2 every request
+    """
+    from .core import Catalog
+
+    catalog = Catalog(catalog_file, verbose=0)
+    server = CacheServer(catalog, (host, port), records)
+    server.verbose = verbose
+    if verbose:
+        names = ', '.join(server.records)
+        print(f'Serving {names} on port {server.server_address[1]}')
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
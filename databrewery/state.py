@@ -0,0 +1,165 @@
+"""
+Small persistent state that is kept between sessions, e.g. the request IDs
+of queued CDS requests. State is stored as JSON files in ~/.databrewery or
+in the directory given by the DATABREWERY_STATE_DIR environment variable.
+"""
+import json
+import os
+import threading
+from contextlib import contextmanager
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    import msvcrt
+
+    fcntl = None
+
+
+def state_dir():
+    """
+    returns the directory where state files are kept (created by the first
+    JSONStore.save)
+    """
+    path = os.environ.get('DATABREWERY_STATE_DIR', '~/.databrewery')
+    return os.path.expanduser(path)
+
+
+@contextmanager
+def file_lock(path):
+    """
+    An exclusive lock of `path` between processes (with a `.lock` file
+    next to it), e.g. around a read-modify-write of a state file
+    """
+    with open(f'{path}.lock', 'a') as file:
+        if fcntl is not None:
+            fcntl.flock(file.fileno(), fcntl.LOCK_EX)
+        else:
+            file.seek(0)
+            msvcrt.locking(file.fileno(), msvcrt.LK_LOCK, 1)
+        try:
+            yield
+        finally:
+            if fcntl is not None:
+                fcntl.flock(file.fileno(), fcntl.LOCK_UN)
+            else:
+                file.seek(0)
+                msvcrt.locking(file.fileno(), msvcrt.LK_UNLCK, 1)
+
+
+class JSONStore:
+    """
+    A dictionary that is saved to a JSON file every time it is changed.
+    Writes are atomic (temporary file + rename), so a crashed process
+    never leaves a half written file behind. Several processes can share
+    a store: a save reads the file again under a file lock and only writes
+    the keys that this process changed.
+    """
+
+    def __init__(self, name):
+        """
+        Parameters
+        ==========
+        name: str
+            the file name in the state directory (e.g. cds_requests.json)
+            or an absolute path
+        """
+        self.path = os.path.join(state_dir(), name)
+        self._lock = threading.RLock()
+        self._data = self._load()
+        # keys changed (or removed) since the last save
+        self._changed = set()
+        self._removed = set()
+
+    def __repr__(self):
+        return f'{self.__class__.__name__}({self.path}, n={len(self)})'
+
+    def _load(self):
+        try:
+            with open(self.path) as file:
+                return json.load(file)
+        except (FileNotFoundError, ValueError):
+            return {}
+
+    def reload(self):
+        """reads the file again (e.g. if changed by another process)"""
+        with self._lock:
+            self._data = self._load()
+
+    def save(self):
+        """merges the changed keys into the file"""
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        with self._lock, file_lock(self.path):
+            data = self._load()
+            for key in self._removed:
+                data.pop(key, None)
+            for key in self._changed:
+                data[key] = self._data[key]
+            tmp = f'{self.path}.{os.getpid()}.{threading.get_ident()}.tmp'
+            with open(tmp, 'w') as file:
+                json.dump(data, file, indent=1, default=str)
+            os.replace(tmp, self.path)
+            self._data = data
+            self._changed.clear()
+            self._removed.clear()
+
+    def _set(self, key, value):
+        self._data[key] = value
+        self._changed.add(key)
+        self._removed.discard(key)
+
+    def _del(self, key):
+        del self._data[key]
+        self._removed.add(key)
+        self._changed.discard(key)
+
+    def __len__(self):
+        return len(self._data)
+
+    def __contains__(self, key):
+        return key in self._data
+
+    def __iter__(self):
+        return iter(list(self._data))
+
+    def __getitem__(self, key):
+        return self._data[key]
+
+    def __setitem__(self, key, value):
+        with self._lock:
+            self._set(key, value)
+            self.save()
+
+    def __delitem__(self, key):
+        with self._lock:
+            self._del(key)
+            self.save()
+
+    def get(self, key, default=None):
+        return self._data.get(key, default)
+
+    def pop(self, key, default=None):
+        with self._lock:
+            value = self._data.get(key, default)
+            if key in self._data:
+                self._del(key)
+                self.save()
+        return value
+
+    def items(self):
+        return list(self._data.items())
+
+    def discard(self, keys):
+        """removes the keys that exist (saved once)"""
+        with self._lock:
+            keys = [k for k in keys if k in self._data]
+            for key in keys:
+                self._del(key)
+            if keys:
+                self.save()
+
+    def update(self, other):
+        with self._lock:
+            for key, value in dict(other).items():
+                self._set(key, value)
+            self.save()
@@ -0,0 +1,321 @@
+"""
+Storage budgets of the local_store.
+
+A record can be given a quota in the catalog:
+
+    storage:
+        quota: 500 GB
+        policy: lru  # or lfu
+        pinned: [[2015-01-01, 2015-12-31]]
+        pool: scratch
+
+Record.local_files stores when a file was last returned and how often in
+the state directory (see state.JSONStore, written in batches). Before a
+download that would go over the quota (with the remote sizes of the files,
+see planner.py), the least recently (lru) or least frequently (lfu) used
+raw files are removed until the download fits. Files of pinned date
+ranges, files whose pipeline outputs do not exist yet and the files of the
+current download are never removed. Records with the same pool share one
+quota (the smallest quota of the pool), e.g. all records on a scratch disk.
+"""
+import atexit
+import os
+import threading
+import time
+
+# bytes of the units of the quota
+UNITS = {
+    '': 1,
+    'B': 1,
+    'KB': 10 ** 3,
+    'MB': 10 ** 6,
+    'GB': 10 ** 9,
+    'TB': 10 ** 12,
+    'KIB': 2 ** 10,
+    'MIB': 2 ** 20,
+    'GIB': 2 ** 30,
+    'TIB': 2 ** 40,
+}
+POLICIES = ('lru', 'lfu')
+# files whose accesses are kept in memory before access.json is written
+ACCESS_BATCH = 100
+# seconds after which the kept accesses are written anyway
+ACCESS_INTERVAL = 60
+
+
+def parse_size(size):
+    """bytes of a size with a unit, e.g. '500 GB' or '1.5TiB'"""
+    import re
+
+    match = re.fullmatch(r'\s*([\d.]+)\s*([a-zA-Z]*)\s*', str(size))
+    unit = None if match is None else match.group(2).upper()
+    if unit not in UNITS:
+        raise ValueError(f'{size} is not a size, e.g. 500 GB')
+    return int(float(match.group(1)) * UNITS[unit])
+
+
+def make_budgets(records):
+    """
+    Creates the StorageBudget of each pool of records with a `storage`
+    block and assigns it to `record.storage`
+
+    Parameters
+    ==========
+    records: list
+        Record objects
+    """
+    pools = {}
+    for record in records:
+        storage = getattr(record.config, 'storage', None)
+        if storage is None:
+            continue
+        pool = getattr(storage, 'pool', record.name)
+        pools.setdefault(pool, []).append(record)
+
+    budgets = {}
+    for pool, members in pools.items():
+        quota = min(m.config.storage.quota for m in members)
+        policy = getattr(members[0].config.storage, 'policy', 'lru')
+        budgets[pool] = StorageBudget(members, quota, policy)
+        for record in members:
+            record.storage = budgets[pool]
+    return budgets
+
+
+class StorageBudget:
+    """
+    The quota of the raw files of one or more records (see the module
+    docstring). Accesses are counted with touch and files are removed with
+    make_room.
+    """
+
+    def __init__(
+        self,
+        records,
+        quota,
+        policy='lru',
+        store='access.json',
+        batch=ACCESS_BATCH,
+    ):
+        """
+        Parameters
+        ==========
+        records: list
+            the records that share the quota
+        quota: int
+            the most bytes of the raw files
+        policy: str
+            lru removes the least recently used files first, lfu the least
+            frequently used files (and of those the least recent)
+        store: str
+            the state file of the accesses
+        batch: int
+            the number of files whose accesses are kept before saving
+        """
+        from .state import JSONStore
+
+        if policy not in POLICIES:
+            raise ValueError(f'policy must be one of {POLICIES}')
+        self.records = list(records)
+        self.quota = quota
+        self.policy = policy
+        self.access = JSONStore(store)
+        self.batch = batch
+        # local path: (last access, number of accesses) since the last flush
+        self._touched = {}
+        self._flushed = time.time()
+        self._lock = threading.Lock()
+        atexit.register(self.flush)
+
+    def __repr__(self):
+        names = ', '.join(r.name for r in self.records)
+        return (
+            f'{self.__class__.__name__}({names}, quota={self.quota}, '
+            f'policy={self.policy})'
+        )
+
+    def files(self):
+        """
+        The raw files of the records
+
+        Returns
+        =======
+        files: dict
+            local path: (record, date, size in bytes)
+        """
+        from glob import glob
+        from .utils import date_path_glob, parse_date
+
+        files = {}
+        for record in self.records:
+            local_store = os.path.expanduser(str(record.config.local_store))
+            for local in glob(date_path_glob(local_store)):
+                # temporary files of downloads (see lease.py)
+                if '.brew-' in os.path.basename(local):
+                    continue
+                date = parse_date(local_store, local)
+                if (date is None) or (local_store.format(t=date) != local):
+                    continue
+                try:
+                    files[local] = record, date, os.path.getsize(local)
+                except FileNotFoundError:
+                    pass
+        return files
+
+    def usage(self):
+        """bytes of the raw files"""
+        return sum(size for record, date, size in self.files().values())
+
+    def touch(self, files):
+        """
+        counts an access of the local files. The accesses are saved every
+        `batch` files or ACCESS_INTERVAL seconds (see flush).
+        """
+        now = time.time()
+        with self._lock:
+            for local in map(str, files):
+                local = os.path.expanduser(local)
+                atime, count = self._touched.get(local, (now, 0))
+                self._touched[local] = (now, count + 1)
+            full = len(self._touched) >= self.batch
+            due = full or (now - self._flushed >= ACCESS_INTERVAL)
+        if due:
+            self.flush()
+
+    def flush(self):
+        """adds the kept accesses to those of other processes and saves"""
+        with self._lock:
+            touched, self._touched = self._touched, {}
+            self._flushed = time.time()
+            if not touched:
+                return
+            self.access.reload()
+            entries = {}
+            for local, (atime, count) in touched.items():
+                if not os.path.isfile(local):
+                    continue  # removed since, e.g. evicted by a stream
+                entry = self.access.get(local, {'count': 0})
+                count += entry['count']
+                entries[local] = dict(atime=atime, count=count)
+            self.access.update(entries)
+
+    def is_protected(self, record, date):
+        """True if the file is pinned or a pipeline still needs it"""
+        import pandas as pd
+
+        storage = getattr(record.config, 'storage', None)
+        for start, end in getattr(storage, 'pinned', []):
+            if pd.Timestamp(start) <= date <= pd.Timestamp(end):
+                return True
+        pipelines = getattr(record.config, 'pipelines', None)
+        for name in [] if pipelines is None else pipelines:
+            data_path = str(pipelines[name]['data_path'])
+            output = os.path.expanduser(data_path.format(t=date))
+            if not os.path.isfile(output):
+                return True
+        return False
+
+    def candidates(self, keep=()):
+        """
+        The files that can be removed in the order of the policy
+
+        Parameters
+        ==========
+        keep: list
+            local paths that must not be removed
+        """
+        keep = {os.path.expanduser(str(local)) for local in keep}
+        files = []
+        for local, (record, date, size) in self.files().items():
+            if (local in keep) or self.is_protected(record, date):
+                continue
+            # files that were never returned count from their download
+            entry = self.access.get(local, {})
+            atime = entry.get('atime', None)
+            if atime is None:
+                atime = os.path.getmtime(local)
+            count = entry.get('count', 0)
+            order = (count, atime) if self.policy == 'lfu' else (atime,)
+            files += ((order, local, size),)
+        return [(local, size) for order, local, size in sorted(files)]
+
+    def make_room(self, nbytes, keep=()):
+        """
+        Removes files until `nbytes` more fit in the quota.
+
+        Parameters
+        ==========
+        nbytes: int
+            the bytes that will be downloaded
+        keep: list
+            local paths that must not be removed
+
+        Returns
+        =======
+        removed: list
+            the local paths that were removed
+        """
+        self.flush()
+        with self._lock:
+            excess = self.usage() + nbytes - self.quota
+            if excess <= 0:
+                return []
+            removed = []
+            for local, size in self.candidates(keep):
+                if excess <= 0:
+                    break
+                try:
+                    os.remove(local)
+                except FileNotFoundError:
+                    continue
+                removed += (local,)
+                excess -= size
+            self.access.discard(removed)
+        return removed
+
+    def reserve(self, record, file_pairs, downloader=None):
+        """
+        Makes room for the files that are not in the local_store yet. The
+        sizes come from the remote listings (see planner.plan_pairs);
+        files of unknown size count with the mean size of the other files.
+        The files of file_pairs are kept.
+
+        Parameters
+        ==========
+        record: Record
+            the record of the files
+        file_pairs: list
+            (remote, local) pairs
+        downloader: download.Downloader
+            a connection to the remote, by default the planner connects
+
+        Returns
+        =======
+        removed: list
+            the local paths that were removed
+        """
+        from .planner import plan_pairs
+
+        file_pairs = [
+            (str(remote), os.path.expanduser(str(local)))
+            for remote, local in file_pairs
+        ]
+        locals_ = [local for remote, local in file_pairs]
+        missing = [(r, l) for r, l in file_pairs if not os.path.isfile(l)]
+        if not missing:
+            return []
+
+        sizes = [None] * len(missing)
+        # a cache serves other paths than those of the url
+        if getattr(record, 'cache', None) is None:
+            rows = plan_pairs(record, missing, downloader=downloader)
+            gone = 'remote_not_exist'
+            sizes = [
+                0 if r['state'] == gone else r['expected_bytes'] for r in rows
+            ]
+        known = [size for size in sizes if size is not None]
+        if not known:
+            known = [size for r, date, size in self.files().values()]
+        mean = sum(known) // len(known) if known else 0
+        nbytes = sum(mean if size is None else size for size in sizes)
+        return self.make_room(nbytes, keep=locals_)
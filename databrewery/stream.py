@@ -0,0 +1,233 @@
+"""
+Overlaps the downloads and the processing of a pipeline.
+
+PipeFiles.process downloads all raw files of the dates first and then
+processes them, so the network and the CPUs take turns. PipeFiles.stream
+runs both stages at the same time:
+
+    catalog.oc_cci.mon_1deg.stream(slice('2010', '2015'), workers=4)
+
+Download threads (njobs), each with its own connection, emit each raw
+file once it is downloaded and valid into a queue of STREAM_DEPTH files.
+The pipeline functions run on the files of the queue in a process pool
+(workers), and the output of a file is written as soon as the file is
+processed. The download threads
+wait while the queue is full, so that at most STREAM_DEPTH + njobs +
+workers raw files are held. Raw files can then be removed once their
+outputs are written: with `evict=True` directly, or by the quota of the
+record (see storage.py), which keeps raw files until their outputs exist.
+
+The workers are spawned, i.e. each worker imports the main module of the
+caller again. Scripts that stream must therefore run it under
+`if __name__ == '__main__':`.
+"""
+import multiprocessing
+import os
+import queue
+import threading
+import warnings
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+
+# raw files that are downloaded but not processed yet at most
+STREAM_DEPTH = 4
+# seconds between checks of the process pool while waiting for downloads
+STREAM_POLL = 0.1
+
+
+def process_in_worker(file_raw, file_process, funcs, profile, profile_attr):
+    """
+    Processes one file in a worker of the pool (see PipeFiles._process_file)
+    and returns the stages of the profile
+    """
+    from .metrics import PipelineProfile
+    from .record import PipeFiles
+
+    profile = PipelineProfile() if profile else None
+    PipeFiles._process_file(
+        file_raw, file_process, funcs, profile, profile_attr
+    )
+    return [] if profile is None else profile.stages
+
+
+class StreamExecutor:
+    """
+    Downloads the raw files of a pipeline in threads and processes them in
+    a process pool as they arrive (see the module docstring)
+    """
+
+    def __init__(self, pipe, workers=None, njobs=1, depth=STREAM_DEPTH):
+        """
+        Parameters
+        ==========
+        pipe: PipeFiles
+            the pipeline of a record
+        workers: int
+            processes of the pool, defaults to the number of CPUs
+        njobs: int
+            download threads
+        depth: int
+            raw files in the queue between the stages at most
+        """
+        self.pipe = pipe
+        self.record = pipe._parent
+        self.workers = workers or os.cpu_count() or 1
+        self.njobs = max(int(njobs), 1)
+        self.depth = depth
+        self.profile = None
+        self._reset()
+
+    def __repr__(self):
+        return (
+            f'{self.__class__.__name__}({self.record.name}.{self.pipe.name}, '
+            f'workers={self.workers}, njobs={self.njobs})'
+        )
+
+    def _reset(self):
+        # raw files by the stage they reached
+        self.results = {
+            'processed': [],
+            'evicted': [],
+            'not_downloaded': [],
+            'failed': [],
+        }
+        self._queue = queue.Queue(maxsize=self.depth)
+        self._stop = threading.Event()
+        self._lock = threading.Lock()
+
+    def _download(self, file_pairs):
+        """a download thread: emits the valid raw files into the queue"""
+        from .utils import is_file_valid
+
+        # the connections of the thread stay open between the files
+        connections = {}
+        try:
+            while not self._stop.is_set():
+                with self._lock:
+                    if not file_pairs:
+                        break
+                    remote, local = file_pairs.pop(0)
+                if not is_file_valid(local):
+                    try:
+                        self.record._fetch([(remote, local)], connections)
+                    except Exception as error:
+                        warnings.warn(f'Downloading {local} failed: {error}')
+                        self.record._close_connections(connections)
+                if not is_file_valid(local):
+                    with self._lock:
+                        self.results['not_downloaded'] += (local,)
+                    continue
+                self._put(local)
+        finally:
+            self.record._close_connections(connections)
+            self._put(None)  # this thread is done
+
+    def _put(self, item):
+        """waits while the queue is full, unless the stream stopped"""
+        while not self._stop.is_set():
+            try:
+                return self._queue.put(item, timeout=STREAM_POLL)
+            except queue.Full:
+                pass
+
+    def run(self, dates, evict=False, profile=False):
+        """
+        Downloads and processes the files of the dates. The first error of
+        the pipeline functions stops the downloads and is raised.
+
+        Parameters
+        ==========
+        dates: date-like string or object
+            see Record.local_files
+        evict: bool
+            removes each raw file once its output is written
+        profile: bool
+            collects a metrics.PipelineProfile of all files in `profile`
+
+        Returns
+        =======
+        processed_files: list
+            the file names of the processed files, in the order of dates
+        """
+        from .metrics import PipelineProfile
+
+        self._reset()
+        self.profile = PipelineProfile() if profile else None
+        outputs = {
+            str(local): str(processed)
+            for remote, local, processed in self.pipe(dates)
+        }
+        pairs, skipped = self.record._date_path_pairs(dates)
+        file_pairs = [(str(r), str(l)) for r, l in pairs]
+        file_pairs = [(r, l) for r, l in file_pairs if l in outputs]
+        self.results['not_downloaded'] += [str(l) for r, l in skipped]
+
+        threads = [
+            threading.Thread(
+                target=self._download, args=(file_pairs,), daemon=True
+            )
+            for _ in range(self.njobs)
+        ]
+        for thread in threads:
+            thread.start()
+
+        # workers are spawned: forking while the download threads hold
+        # locks (e.g. of HDF5) can hang the workers
+        context = multiprocessing.get_context('spawn')
+        try:
+            pool = ProcessPoolExecutor(self.workers, mp_context=context)
+        except TypeError:
+            # mp_context is new in Python 3.7, older versions fork
+            pool = ProcessPoolExecutor(self.workers)
+        try:
+            self._consume(pool, outputs, evict)
+        finally:
+            self._stop.set()
+            for thread in threads:
+                thread.join()
+            pool.shutdown(wait=True)
+
+        processed = set(self.results['processed'])
+        return [outputs[local] for local in outputs if local in processed]
+
+    def _consume(self, pool, outputs, evict):
+        """submits the queued files to the pool, at most one per worker"""
+        futures = {}
+        running = self.njobs
+        while running or futures:
+            for future in [f for f in futures if f.done()]:
+                self._finish(future, futures.pop(future), outputs, evict)
+            if (not running) or (len(futures) >= self.workers):
+                if futures:
+                    wait(futures, return_when=FIRST_COMPLETED)
+                continue
+            try:
+                local = self._queue.get(timeout=STREAM_POLL)
+            except queue.Empty:
+                continue
+            if local is None:
+                running -= 1
+                continue
+            future = pool.submit(
+                process_in_worker,
+                local,
+                outputs[local],
+                self.pipe._funcs,
+                self.profile is not None,
+                'brew_profile',
+            )
+            futures[future] = local
+
+    def _finish(self, future, local, outputs, evict):
+        """gathers a processed file and removes the raw file if evict"""
+        error = future.exception()
+        if error is not None:
+            self.results['failed'] += (local,)
+            raise error
+        if self.profile is not None:
+            self.profile.stages += future.result()
+        self.results['processed'] += (local,)
+        if evict and os.path.isfile(outputs[local]):
+            os.remove(local)
+            self.results['evicted'] += (local,)
+            if self.record.storage is not None:
+                self.record.storage.access.discard([local])
@@ -1,8 +1,12 @@
 import pprint
+import threading
 from warnings import warn
 
 import pandas as pd
 
+# the HDF5 library behind netCDF4 is not thread safe
+_netcdf_lock = threading.Lock()
+
 
 class DictObject(object):
     """
@@ -256,9 +260,13 @@ def is_file_valid(local_path):
 
     # has an opener been passed, if not assumes file is valid
     if local_path.endswith('.nc'):
-        from netCDF4 import Dataset as opener
+        from netCDF4 import Dataset
 
-        error = OSError
+        try:
+            with _netcdf_lock, Dataset(local_path):
+                return True
+        except OSError:
+            return False
     elif local_path.endswith('.zip'):
         from zipfile import ZipFile as opener, BadZipFile as error
     else:
@@ -275,6 +283,61 @@ def is_file_valid(local_path):
         return False
 
 
+def parse_date(date_path, path):
+    """
+    The date of a path that was formatted from a DatePath template (the
+    inverse of DatePath.format). The date comes from the placeholder with
+    the most date fields, and fields that are not in the template are the
+    first possible (e.g. day 1 of monthly files).
+
+    Parameters
+    ==========
+    date_path: str or DatePath
+        the template, e.g. /data/{t:%Y}/sst_{t:%Y%m%d}.nc
+    path: str
+        a path of the template, e.g. /data/2012/sst_20120131.nc
+
+    Returns
+    =======
+    date: pandas.Timestamp
+        None if the path does not match the template
+    """
+    import re
+    from datetime import datetime
+    from string import Formatter
+
+    pattern, formats = '', []
+    for literal, field, spec, conversion in Formatter().parse(str(date_path)):
+        pattern += re.escape(literal)
+        if field is not None:
+            pattern += '(.+?)'
+            formats += (spec,)
+    match = re.fullmatch(pattern, str(path))
+    if (match is None) or (not formats):
+        return None
+
+    i = max(range(len(formats)), key=lambda i: formats[i].count('%'))
+    try:
+        return pd.Timestamp(datetime.strptime(match.group(i + 1), formats[i]))
+    except ValueError:
+        return None
+
+
+def date_path_glob(date_path):
+    """
+    A glob pattern of all the paths of a DatePath template, i.e. the date
+    placeholders are replaced with *
+    """
+    from string import Formatter
+
+    pattern = ''
+    for literal, field, spec, conversion in Formatter().parse(str(date_path)):
+        pattern += literal
+        if field is not None:
+            pattern += '*'
+    return pattern
+
+
 def make_date_path_pairs(dates, *date_paths):
     """
     Helper function that creates paired paths from a given date range and
@@ -0,0 +1,437 @@
+"""
+Distributed downloads with a work queue on a shared file system.
+
+A coordinator (Record.download_data with `queue`) writes the planned
+(remote, local) pairs of a record into a SQLite database, split into
+batches. Workers on any node that sees the database (`brewery work
+<queue>`, see work) claim one batch at a time, download it with the record
+of the catalog file and report the status of each file. A claim is a
+lease that the worker renews while it downloads: the batch of a worker
+that died is claimed again by another worker once the lease has expired,
+and fails after MAX_CLAIMS claims. The coordinator waits until every file
+is reported and gathers the results into download_results.
+
+The database must be on a file system where the locks of SQLite work
+(e.g. a local disk, NFSv4 or Lustre). The catalog file and the local_store
+must be at the same paths on all nodes (see lease.py).
+"""
+import json
+import os
+import socket
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+
+# files per batch that a worker claims
+BATCH_SIZE = 16
+# seconds after which the batch of a worker that stopped renewing is free
+QUEUE_LEASE_TTL = 120
+# a batch that was claimed this many times without a report fails
+MAX_CLAIMS = 3
+# seconds between checks of the queue while waiting
+QUEUE_POLL = 1.0
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS files (
+    catalog TEXT NOT NULL,
+    record TEXT NOT NULL,
+    remote TEXT NOT NULL,
+    local TEXT NOT NULL,
+    alternates TEXT,
+    mirror INTEGER NOT NULL DEFAULT 0,
+    batch INTEGER NOT NULL,
+    state TEXT NOT NULL DEFAULT 'pending',
+    status TEXT,
+    worker TEXT,
+    expires REAL,
+    claims INTEGER NOT NULL DEFAULT 0,
+    PRIMARY KEY (record, local)
+);
+CREATE INDEX IF NOT EXISTS files_batch ON files (batch);
+CREATE INDEX IF NOT EXISTS files_state ON files (state);
+"""
+
+
+def worker_name():
+    """host:pid:thread of the calling worker"""
+    host = socket.gethostname()
+    return f'{host}:{os.getpid()}:{threading.get_ident()}'
+
+
+class WorkQueue:
+    """
+    The files of one or more records in a SQLite database. Each file is
+    pending, claimed (by a worker, until the lease expires) or done (with
+    the status of download_results).
+    """
+
+    def __init__(self, path, batch_size=BATCH_SIZE, ttl=QUEUE_LEASE_TTL):
+        """
+        Parameters
+        ==========
+        path: str
+            the database file, created if it does not exist
+        batch_size: int
+            files per batch (see put)
+        ttl: float
+            seconds that a claim lasts if it is not renewed
+        """
+        self.path = str(path)
+        self.batch_size = batch_size
+        self.ttl = ttl
+        db = self._connect()
+        try:
+            db.executescript(SCHEMA)
+        finally:
+            db.close()
+
+    def __repr__(self):
+        counts = ', '.join(f'{k}={v}' for k, v in self.counts().items())
+        return f'{self.__class__.__name__}({self.path}, {counts})'
+
+    def _connect(self):
+        # autocommit: transactions are started explicitly
+        return sqlite3.connect(self.path, timeout=60, isolation_level=None)
+
+    @contextmanager
+    def _transaction(self):
+        """a connection in a write transaction (one writer at a time)"""
+        db = self._connect()
+        try:
+            db.execute('BEGIN IMMEDIATE')
+            try:
+                yield db
+            except BaseException:
+                db.execute('ROLLBACK')
+                raise
+            db.execute('COMMIT')
+        finally:
+            db.close()
+
+    def put(self, record, file_pairs, mirror=False):
+        """
+        Adds the files of a record in batches of `batch_size` files. Files
+        that are in the queue already are pending again.
+
+        Parameters
+        ==========
+        record: Record
+            a record that was read from a catalog file
+        file_pairs: list
+            (remote, local) pairs
+        mirror: bool
+            download the files in mirror mode (see Record.download_data)
+        """
+        if record.catalog_file is None:
+            raise ValueError(
+                f'{record.name} must be read from a catalog file to be '
+                'downloaded by workers'
+            )
+        catalog = os.path.abspath(record.catalog_file)
+
+        with self._transaction() as db:
+            last = db.execute('SELECT MAX(batch) FROM files').fetchone()[0]
+            first = 0 if last is None else last + 1
+            rows = []
+            for i, (remote, local) in enumerate(file_pairs):
+                alternates = record._alternates.get(str(local), None)
+                if alternates is not None:
+                    alternates = json.dumps(alternates)
+                batch = first + i // self.batch_size
+                rows += (
+                    (
+                        catalog,
+                        record.name,
+                        str(remote),
+                        str(local),
+                        alternates,
+                        int(mirror),
+                        batch,
+                    ),
+                )
+            db.executemany(
+                'INSERT OR REPLACE INTO files (catalog, record, remote, '
+                'local, alternates, mirror, batch) '
+                'VALUES (?, ?, ?, ?, ?, ?, ?)',
+                rows,
+            )
+        return len(rows)
+
+    def claim(self, worker):
+        """
+        Claims the first batch that is pending or whose claim expired.
+        Batches that were claimed MAX_CLAIMS times fail instead.
+
+        Returns
+        =======
+        claim: dict
+            batch, catalog, record, mirror, pairs (list of (remote, local))
+            and alternates (local: remote on each mirror), or None if no
+            batch is free
+        """
+        with self._transaction() as db:
+            while True:
+                row = db.execute(
+                    'SELECT batch, MAX(claims) FROM files '
+                    "WHERE state = 'pending' "
+                    "OR (state = 'claimed' AND expires < ?) "
+                    'GROUP BY batch ORDER BY batch LIMIT 1',
+                    (time.time(),),
+                ).fetchone()
+                if row is None:
+                    return None
+                batch, claims = row
+                if claims < MAX_CLAIMS:
+                    break
+                # the workers of this batch keep dying
+                db.execute(
+                    "UPDATE files SET state = 'done', status = 'failed' "
+                    "WHERE batch = ? AND state != 'done'",
+                    (batch,),
+                )
+
+            db.execute(
+                "UPDATE files SET state = 'claimed', worker = ?, "
+                'expires = ?, claims = claims + 1 '
+                "WHERE batch = ? AND state != 'done'",
+                (worker, time.time() + self.ttl, batch),
+            )
+            rows = db.execute(
+                'SELECT catalog, record, remote, local, alternates, mirror '
+                "FROM files WHERE batch = ? AND state = 'claimed'",
+                (batch,),
+            ).fetchall()
+
+        pairs, alternates = [], {}
+        for catalog, record, remote, local, alt, mirror in rows:
+            pairs += ((remote, local),)
+            if alt is not None:
+                alternates[local] = json.loads(alt)
+        return dict(
+            batch=batch,
+            catalog=catalog,
+            record=record,
+            mirror=bool(mirror),
+            pairs=pairs,
+            alternates=alternates,
+        )
+
+    def renew(self, batch, worker):
+        """extends the claim, False if the batch is no longer claimed"""
+        with self._transaction() as db:
+            cursor = db.execute(
+                'UPDATE files SET expires = ? WHERE batch = ? '
+                "AND worker = ? AND state = 'claimed'",
+                (time.time() + self.ttl, batch, worker),
+            )
+            return cursor.rowcount > 0
+
+    @contextmanager
+    def renewing(self, batch, worker):
+        """renews the claim every ttl / 3 seconds in a background thread"""
+        stop = threading.Event()
+
+        def renew():
+            while not stop.wait(self.ttl / 3):
+                if not self.renew(batch, worker):
+                    return
+
+        thread = threading.Thread(target=renew, daemon=True)
+        thread.start()
+        try:
+            yield
+        finally:
+            stop.set()
+            thread.join()
+
+    def release(self, batch, worker):
+        """gives a claimed batch back, e.g. after a fatal error"""
+        with self._transaction() as db:
+            db.execute(
+                "UPDATE files SET state = 'pending', expires = NULL "
+                "WHERE batch = ? AND worker = ? AND state = 'claimed'",
+                (batch, worker),
+            )
+
+    def report(self, batch, results):
+        """
+        Marks the files of a batch as done.
+
+        Parameters
+        ==========
+        batch: int
+            the claimed batch
+        results: dict
+            status: list of local files (see Record.download_results).
+            Files of the batch that are not in results failed
+        """
+        rows = [
+            (status, batch, str(local))
+            for status, files in results.items()
+            for local in files
+        ]
+        with self._transaction() as db:
+            # the first report counts if a claim expired during download
+            db.executemany(
+                "UPDATE files SET state = 'done', status = ?, expires = NULL "
+                "WHERE batch = ? AND local = ? AND state != 'done'",
+                rows,
+            )
+            db.execute(
+                "UPDATE files SET state = 'done', status = 'failed', "
+                "expires = NULL WHERE batch = ? AND state != 'done'",
+                (batch,),
+            )
+
+    def counts(self):
+        """the number of pending, claimed and done files"""
+        db = self._connect()
+        try:
+            rows = db.execute(
+                'SELECT state, COUNT(*) FROM files GROUP BY state'
+            ).fetchall()
+        finally:
+            db.close()
+        return {'pending': 0, 'claimed': 0, 'done': 0, **dict(rows)}
+
+    def results(self, record, files=None):
+        """
+        The files of the record that are done by status, like
+        Record.download_results.
+
+        Parameters
+        ==========
+        record: str
+            the name of the record
+        files: list
+            local paths, defaults to all files of the record
+        """
+        from .metrics import STATUS_NAMES
+
+        db = self._connect()
+        try:
+            rows = db.execute(
+                "SELECT local, status FROM files WHERE record = ? "
+                "AND state = 'done'",
+                (record,),
+            ).fetchall()
+        finally:
+            db.close()
+
+        wanted = None if files is None else set(map(str, files))
+        results = {k: [] for k in STATUS_NAMES.values()}
+        for local, status in rows:
+            if (wanted is None) or (local in wanted):
+                results.setdefault(status, []).append(local)
+        return results
+
+    def latest_claim(self, record):
+        """the latest expiry of the claimed files of the record (or None)"""
+        db = self._connect()
+        try:
+            return db.execute(
+                'SELECT MAX(expires) FROM files WHERE record = ? '
+                "AND state = 'claimed'",
+                (record,),
+            ).fetchone()[0]
+        finally:
+            db.close()
+
+    def fail(self, record, files):
+        """marks the files of the record that are not done as failed"""
+        rows = [(record, str(local)) for local in files]
+        with self._transaction() as db:
+            db.executemany(
+                "UPDATE files SET state = 'done', status = 'failed', "
+                'expires = NULL WHERE record = ? AND local = ? '
+                "AND state != 'done'",
+                rows,
+            )
+
+    def wait(self, record, files, timeout=None, poll=QUEUE_POLL):
+        """
+        Waits until all files of the record are done and returns the
+        results (see results). The files that are not done fail after
+        `timeout` seconds, or once no file of the record was reported and
+        no claim was made or renewed for longer than ttl (e.g. no worker
+        runs).
+        """
+        nfiles = len(set(map(str, files)))
+        t0 = stalled = time.time()
+        progress = None
+        while True:
+            results = self.results(record, files)
+            ndone = sum(len(v) for v in results.values())
+            if ndone >= nfiles:
+                return results
+            now = time.time()
+            latest = (ndone, self.latest_claim(record))
+            if latest != progress:
+                progress, stalled = latest, now
+            expired = (timeout is not None) and (now - t0 >= timeout)
+            if expired or (now - stalled > self.ttl):
+                self.fail(record, files)
+                return self.results(record, files)
+            time.sleep(poll)
+
+
+def work(queue, njobs=1, wait=0, verbose=0):
+    """
+    Downloads batches of the queue until all files are done. A worker
+    also waits for the claims of other workers, because their batches are
+    free again if the workers die.
+
+    Parameters
+    ==========
+    queue: str or WorkQueue
+        the queue database
+    njobs: int or 'auto'
+        connections per batch (see Record.download_data)
+    wait: float
+        seconds to wait for files if the queue is empty, e.g. if the
+        workers start before the coordinator
+    verbose: int
+        the verbosity of the records
+
+    Returns
+    =======
+    nbatches: int
+        the number of batches that this worker downloaded
+    """
+    from .core import Catalog
+
+    if not isinstance(queue, WorkQueue):
+        queue = WorkQueue(queue)
+    worker = worker_name()
+    catalogs = {}
+    t0 = time.time()
+    nbatches = 0
+    while True:
+        claim = queue.claim(worker)
+        if claim is None:
+            counts = queue.counts()
+            empty = sum(counts.values()) == 0
+            if counts['claimed'] or (empty and time.time() - t0 < wait):
+                time.sleep(QUEUE_POLL)
+                continue
+            return nbatches
+
+        catalog_file = claim['catalog']
+        if catalog_file not in catalogs:
+            catalogs[catalog_file] = Catalog(catalog_file, verbose=verbose)
+        record = getattr(catalogs[catalog_file], claim['record'])
+        record._alternates.update(claim['alternates'])
+
+        batch = claim['batch']
+        try:
+            with queue.renewing(batch, worker):
+                record._download_data(
+                    claim['pairs'], njobs=njobs, mirror=claim['mirror']
+                )
+        except BaseException as error:
+            queue.release(batch, worker)
+            raise error
+        queue.report(batch, record.download_results)
+        record._reset_download_results()
+        nbatches += 1
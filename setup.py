@@ -12,6 +12,8 @@ with open('requirements.txt') as f:
     install_requires = f.read().strip().split('\n')
 
 test_requirements = ['pytest-cov']
+# optional dependencies of the downloaders, e.g. pip install dataBrewery[s3]
+extras_require = {'s3': ['boto3'], 'sftp': ['paramiko>=3.3', 'pysftp']}
 CLASSIFIERS = [
     'Development Status :: 3 - Alpha',
     'License :: OSI Approved :: MIT License',
@@ -28,12 +30,14 @@ setup(
     maintainer_email='luke.gregor@usys.ethz.chu',
     description='Download Dataset for Oceanography',
     install_requires=install_requires,
+    extras_require=extras_require,
     python_requires='>=3.6',
     license='MIT',
     long_description=long_description,
     classifiers=CLASSIFIERS,
     name='dataBrewery',
     packages=find_packages(),
+    entry_points={'console_scripts': ['brewery=databrewery.cli:main']},
     test_suite='databrewery/tests',
     tests_require=test_requirements,
     url='https://github.com/luke-gregor/dataBrewery',
@@ -0,0 +1,70 @@
+import pytest
+
+
+@pytest.fixture(autouse=True)
+def state_dir(tmp_path, monkeypatch):
+    """keeps the state files of the tests out of ~/.databrewery"""
+    path = tmp_path / 'state'
+    monkeypatch.setenv('DATABREWERY_STATE_DIR', str(path))
+    return path
+
+
+class SyntheticRemote:
+    """
+    The smos_cci record of catalog_template.yaml on synthetic remote trees
+    in tmp_path (see benchmarks/servers.py)
+    """
+
+    def __init__(self, tmp_path):
+        self.tmp_path = tmp_path
+        self.remote_paths = None
+
+    def make_tree(self, dates, size=2 ** 14, root='remote'):
+        """
+        Creates the files of the dates in tmp_path / root and returns the
+        directory (to serve with a stand-in)
+        """
+        from benchmarks import servers
+
+        records = {'smos_cci': servers.template_records()['smos_cci']}
+        self.remote_paths = servers.make_synthetic_tree(
+            self.tmp_path / root, dates, size=size, records=records
+        )
+        return self.tmp_path / root
+
+    def make_catalog(
+        self, standin, local='local', mirrors=(), name='catalog.yaml', **entry
+    ):
+        """
+        Writes a catalog file with the record on the stand-in. The local
+        store is in tmp_path / local and `entry` is added to the record
+        (e.g. storage or pipelines, dicts are merged into the blocks of
+        the record, e.g. remote).
+        """
+        import yaml
+        from benchmarks import servers
+
+        catalog_file = servers.make_catalog(
+            self.tmp_path / name,
+            standin,
+            self.remote_paths,
+            str(self.tmp_path / local),
+            mirrors=mirrors,
+        )
+        if entry:
+            with open(catalog_file) as file:
+                catalog = yaml.safe_load(file)
+            record = catalog['smos_cci']
+            for key, value in entry.items():
+                if isinstance(record.get(key, None), dict):
+                    record[key].update(value)
+                else:
+                    record[key] = value
+            with open(catalog_file, 'w') as file:
+                yaml.safe_dump(catalog, file)
+        return catalog_file
+
+
+@pytest.fixture
+def synthetic(tmp_path):
+    return SyntheticRemote(tmp_path)
@@ -1,5 +1,6 @@
 import os
 
+import pandas as pd
 import pytest
 
 from databrewery import Catalog
@@ -96,3 +97,1289 @@ def test_download_ftp_password():
     flist2 = db.oc_cci.local_files('2012-01-01', auto_download=True)
 
     assert flist1 == flist2
+
+
+def test_download_metrics_export(tmp_path):
+    from databrewery.metrics import DownloadMetrics, new_event
+
+    metrics = DownloadMetrics(record='sst_oi_bulk')
+    for status, nbytes in [('downloaded', 2 ** 20), ('remote_not_exist', 0)]:
+        event = new_event(host='data.nodc.noaa.gov', status=status)
+        event.update(bytes=nbytes, total=0.5, first_byte=0.1)
+        metrics.add(event)
+
+    summary = metrics.summary(by=['record', 'host'])
+    row = summary.loc[('sst_oi_bulk', 'data.nodc.noaa.gov')]
+    assert row.files == 2
+    assert row.downloaded == 1
+    assert row.MB_per_s == 2
+
+    metrics.to_jsonl(tmp_path / 'events.jsonl')
+    lines = open(tmp_path / 'events.jsonl').read().splitlines()
+    assert len(lines) == 2
+
+    metrics.to_prometheus(tmp_path / 'brewery.prom')
+    prom = open(tmp_path / 'brewery.prom').read()
+    assert (
+        'databrewery_download_bytes_total'
+        '{record="sst_oi_bulk",host="data.nodc.noaa.gov"} 1048576'
+    ) in prom
+
+
+def test_download_parallel_local_http(tmp_path):
+    from benchmarks import servers
+
+    dates = pd.date_range('2012-01-01', periods=6, freq='1D')
+    records = {'smos_cci': servers.template_records()['smos_cci']}
+    remote_paths = servers.make_synthetic_tree(
+        tmp_path / 'remote', dates, size=2 ** 14, records=records
+    )
+    with servers.HTTPStandIn(tmp_path / 'remote') as standin:
+        catalog_file = servers.make_catalog(
+            tmp_path / 'catalog.yaml',
+            standin,
+            remote_paths,
+            str(tmp_path / 'local'),
+        )
+        record = Catalog(catalog_file, verbose=0).smos_cci
+        results = record.download_data(dates, njobs=3)
+
+    assert len(results['downloaded']) == 6
+    assert record.metrics.summary().loc['localhost', 'downloaded'] == 6
+
+
+def test_download_adaptive_connections(tmp_path, monkeypatch):
+    import json
+    from benchmarks import servers
+    from databrewery import concurrency
+
+    monkeypatch.setattr(concurrency, '_limiters', {})
+
+    dates = pd.date_range('2012-01-01', periods=30, freq='1D')
+    records = {'smos_cci': servers.template_records()['smos_cci']}
+    remote_paths = servers.make_synthetic_tree(
+        tmp_path / 'remote', dates, size=2 ** 14, records=records
+    )
+    standin = servers.HTTPStandIn(
+        tmp_path / 'remote', latency=0.02, max_connections=3
+    )
+    with standin:
+        catalog_file = servers.make_catalog(
+            tmp_path / 'catalog.yaml',
+            standin,
+            remote_paths,
+            str(tmp_path / 'local'),
+        )
+        record = Catalog(catalog_file, verbose=0).smos_cci
+        results = record.download_data(dates, njobs='auto')
+
+    limiter = concurrency.get_limiter('localhost')
+    reasons = [reason for t, limit, reason in limiter.history]
+    assert len(results['downloaded']) == 30
+    assert 'throughput' in reasons
+    # refused requests make the limiter back off and are downloaded later
+    assert (standin.refused == 0) or ('overload' in reasons)
+    assert 1 <= limiter.limit <= 8
+
+    # the learned limit is the starting point of the next session
+    with open(tmp_path / 'state' / 'host_limits.json') as file:
+        assert json.load(file)['localhost']['limit'] == limiter.limit
+
+    # a burst of refusals of requests started with the same limit counts once
+    epoch = limiter.acquire()
+    limit = limiter.limit
+    limiter.overload(epoch)
+    limiter.overload(epoch)
+    limiter.release()
+    assert limiter.limit == max(limit / 2, 1)
+
+
+def test_download_retry_and_circuit_breaker(tmp_path, monkeypatch):
+    from benchmarks import servers
+    from databrewery import retry
+
+    monkeypatch.setattr(retry, '_breakers', {})
+
+    dates = pd.date_range('2012-01-01', periods=20, freq='1D')
+    records = {'smos_cci': servers.template_records()['smos_cci']}
+    remote_paths = servers.make_synthetic_tree(
+        tmp_path / 'remote', dates, size=2 ** 14, records=records
+    )
+    standin = servers.HTTPStandIn(tmp_path / 'remote', fault_rate=0.2, seed=1)
+    with standin:
+        catalog_file = servers.make_catalog(
+            tmp_path / 'catalog.yaml',
+            standin,
+            remote_paths,
+            str(tmp_path / 'local'),
+        )
+        record = Catalog(catalog_file, verbose=0).smos_cci
+        record.config.remote.retries = 5
+        record.config.remote.retry_backoff = 0.01
+        results = record.download_data(dates)
+
+    events = record.metrics.to_dataframe()
+    assert len(results['downloaded']) == 20
+    errors = (events['status'] == 'error').sum()
+    retries = events.loc[events['status'] == 'downloaded', 'retries'].sum()
+    assert errors == retries > 0
+
+    # the server is gone: files fail, the host is parked and nothing raises
+    for file in results['downloaded']:
+        os.remove(file)
+    record.config.remote.retries = 1
+    results = record.download_data(dates)
+    breaker = retry.get_breaker('localhost')
+    assert len(results['failed']) == 20
+    assert breaker.state == 'open'
+    with pytest.raises(retry.HostUnavailable):
+        breaker.check()
+
+    # failures count without retries too
+    breaker.success()
+    record.config.remote.retries = 0
+    results = record.download_data(dates)
+    assert len(results['failed']) == 20
+    assert breaker.state == 'open'
+
+    assert not retry.is_retryable(PermissionError(13, 'denied'))
+    assert retry.is_retryable(ConnectionResetError(104, 'reset'))
+
+
+def test_download_http_timeout(synthetic, monkeypatch):
+    import time
+    from benchmarks import servers
+    from databrewery import retry
+
+    monkeypatch.setattr(retry, '_breakers', {})
+
+    dates = pd.date_range('2012-01-01', periods=2, freq='1D')
+    remote = synthetic.make_tree(dates)
+    standin = servers.HTTPStandIn(remote, latency=2)
+    with standin:
+        catalog_file = synthetic.make_catalog(
+            standin, remote=dict(timeout=[1, 0.2], retries=0)
+        )
+        record = Catalog(catalog_file, verbose=0).smos_cci
+        t0 = time.time()
+        results = record.download_data(dates)
+        assert time.time() - t0 < 2
+    assert len(results['failed']) == 2
+
+
+def test_catalog_sync_two_hosts(tmp_path):
+    import yaml
+    from benchmarks import servers
+
+    dates = pd.date_range('2012-01-01', periods=12, freq='1D')
+    templates = servers.template_records()
+    remote_paths = servers.make_synthetic_tree(
+        tmp_path / 'remote',
+        dates,
+        size=2 ** 14,
+        records={k: templates[k] for k in ['smos_cci', 'oc_cci']},
+    )
+    slow = servers.HTTPStandIn(tmp_path / 'remote', latency=0.05)
+    fast = servers.HTTPStandIn(tmp_path / 'remote')
+    fast.host = '127.0.0.1'  # a second host name
+
+    catalog = {}
+    with slow, fast:
+        for standin, name in [(slow, 'smos_cci'), (fast, 'oc_cci')]:
+            servers.make_catalog(
+                tmp_path / 'catalog.yaml',
+                standin,
+                {name: remote_paths[name]},
+                str(tmp_path / 'local'),
+            )
+            catalog.update(yaml.safe_load(open(tmp_path / 'catalog.yaml')))
+        yaml.safe_dump(catalog, open(tmp_path / 'catalog.yaml', 'w'))
+
+        cat = Catalog(tmp_path / 'catalog.yaml', verbose=0)
+        results = cat.sync(
+            dates, max_connections=4, per_host=2, priorities={'oc_cci': 2}
+        )
+        nevents = len(cat.metrics)
+        again = cat.sync(dates, records=['oc_cci'])
+
+    assert len(results['smos_cci']['downloaded']) == 12
+    assert len(results['oc_cci']['downloaded']) == 12
+    assert slow.peak_active <= 2
+    assert fast.peak_active <= 2
+    hosts = set(cat.metrics.to_dataframe()['host'])
+    assert hosts == {'localhost', '127.0.0.1'}
+    # existing files are found without connecting
+    assert len(again['oc_cci']['local_exists']) == 12
+    assert list(again) == ['oc_cci']
+    assert cat.sync_errors == {}
+    assert len(cat.metrics) == nevents
+
+
+@pytest.mark.parametrize('scheme', ['http', 'ftp', 'sftp'])
+def test_download_mirror_changed_files(tmp_path, scheme):
+    from benchmarks import servers
+
+    dates = pd.date_range('2012-01-01', periods=4, freq='1D')
+    records = {'smos_cci': servers.template_records()['smos_cci']}
+    remote_paths = servers.make_synthetic_tree(
+        tmp_path / 'remote', dates, size=2 ** 14, records=records
+    )
+    remote_files = {}
+    for t in dates:
+        path = remote_paths['smos_cci'].format(t=t).lstrip('/')
+        remote_files[os.path.basename(path)] = tmp_path / 'remote' / path
+    with servers.STANDINS[scheme](tmp_path / 'remote') as standin:
+        catalog_file = servers.make_catalog(
+            tmp_path / 'catalog.yaml',
+            standin,
+            remote_paths,
+            str(tmp_path / 'local'),
+        )
+        record = Catalog(catalog_file, verbose=0).smos_cci
+        first = record.download_data(dates, mirror=True)
+
+        # reprocessed remote files: one is larger, one has a new mtime
+        names = sorted(remote_files)
+        servers.make_netcdf(remote_files[names[0]], size=2 ** 15)
+        os.utime(remote_files[names[1]], (1.6e9, 1.6e9))
+        plain = record.download_data(dates)
+        mirror = record.download_data(dates, njobs=2, mirror=True)
+        again = record.download_data(dates, mirror=True)
+
+    assert len(first['downloaded']) == 4
+    assert len(plain['local_exists']) == 4
+    updated = sorted(os.path.basename(f) for f in mirror['updated'])
+    assert updated == names[:2]
+    assert len(mirror['local_exists']) == 2
+    assert len(again['local_exists']) == 4
+    for name in names[:2]:
+        local = [f for f in mirror['updated'] if str(f).endswith(name)][0]
+        assert os.path.getsize(local) == os.path.getsize(remote_files[name])
+    assert not list((tmp_path / 'local').rglob('*.brew-update'))
+    assert len(record.manifest) == 4
+
+
+@pytest.mark.parametrize('scheme', ['http', 'ftp', 'sftp'])
+def test_catalog_plan(tmp_path, scheme):
+    from benchmarks import servers
+
+    dates = pd.date_range('2012-01-01', periods=6, freq='1D')
+    records = {'smos_cci': servers.template_records()['smos_cci']}
+    remote_paths = servers.make_synthetic_tree(
+        tmp_path / 'remote', dates[:5], size=2 ** 14, records=records
+    )
+    with servers.STANDINS[scheme](tmp_path / 'remote') as standin:
+        catalog_file = servers.make_catalog(
+            tmp_path / 'catalog.yaml',
+            standin,
+            remote_paths,
+            str(tmp_path / 'local'),
+        )
+        catalog = Catalog(catalog_file, verbose=0)
+        catalog.smos_cci.download_data(dates[:2])
+        table = catalog.plan(dates)
+
+    states = table.set_index('local')['state'].tolist()
+    assert states == ['local_exists'] * 2 + ['missing'] * 3 + [
+        'remote_not_exist'
+    ]
+    missing = table[table['state'] == 'missing']
+    local_bytes = table['local_bytes'].iloc[0]
+    assert (missing['expected_bytes'] == local_bytes).all()
+
+    # a directory that appears after a plan is listed again
+    new = pd.date_range('2013-01-01', periods=2, freq='1D')
+    with servers.STANDINS[scheme](tmp_path / 'remote') as standin:
+        catalog_file = servers.make_catalog(
+            tmp_path / 'catalog.yaml',
+            standin,
+            remote_paths,
+            str(tmp_path / 'local'),
+        )
+        catalog = Catalog(catalog_file, verbose=0)
+        before = catalog.plan(new)['state'].tolist()
+        servers.make_synthetic_tree(
+            tmp_path / 'remote', new, size=2 ** 14, records=records
+        )
+        after = catalog.plan(new)['state'].tolist()
+    assert before == ['remote_not_exist'] * 2
+    assert after == ['missing'] * 2
+
+
+@pytest.mark.parametrize('mlsd', [True, False])
+def test_ftp_listing_metadata(tmp_path, mlsd):
+    from benchmarks import servers
+
+    dates = pd.date_range('2012-01-01', periods=3, freq='1D')
+    records = {'smos_cci': servers.template_records()['smos_cci']}
+    remote_paths = servers.make_synthetic_tree(
+        tmp_path / 'remote', dates, size=2 ** 14, records=records
+    )
+    standin = servers.FTPStandIn(tmp_path / 'remote', mlsd=mlsd)
+    with standin:
+        catalog_file = servers.make_catalog(
+            tmp_path / 'catalog.yaml',
+            standin,
+            remote_paths,
+            str(tmp_path / 'local'),
+        )
+        record = Catalog(catalog_file, verbose=0).smos_cci
+        record.verbose = 2  # progress bars need the file size
+        results = record.download_data(dates)
+
+        downloader = record._initiate_connection()
+        remote = record.config.remote.url[dates[0]]
+        meta = downloader.remote_meta(remote)
+
+        # a directory that is published later is found
+        later = tmp_path / 'remote' / 'later'
+        assert downloader.listdir_meta('/later') == {}
+        later.mkdir()
+        (later / 'a.nc').write_bytes(b'a')
+        assert list(downloader.listdir_meta('/later')) == ['/later/a.nc']
+        # and listings expire
+        (later / 'b.nc').write_bytes(b'b')
+        assert len(downloader.listdir_meta('/later')) == 1
+        downloader._listings.ttl = -1
+        assert len(downloader.listdir_meta('/later')) == 2
+        downloader.close_connection()
+
+    local = results['downloaded'][0]
+    assert len(results['downloaded']) == 3
+    assert meta['size'] == os.path.getsize(local)
+    assert abs(meta['modify'] - os.path.getmtime(local)) < 120
+    # sizes come from the listing, not from a command per file
+    assert 'SIZE' not in standin.commands
+    # LIST is only used if the server does not know MLSD
+    assert ('LIST' in standin.commands) != mlsd
+
+
+def test_missing_cache_and_coverage(tmp_path):
+    from benchmarks import servers
+
+    dates = pd.date_range('2012-01-01', periods=10, freq='1D')
+    records = {'smos_cci': servers.template_records()['smos_cci']}
+    # the product covers 3-7 January with a gap on the 5th
+    remote_paths = servers.make_synthetic_tree(
+        tmp_path / 'remote', dates[2:7], size=2 ** 12, records=records
+    )
+    gap = remote_paths['smos_cci'].format(t=dates[4]).lstrip('/')
+    os.rename(tmp_path / 'remote' / gap, tmp_path / 'gap.nc')
+
+    with servers.FTPStandIn(tmp_path / 'remote') as standin:
+        catalog_file = servers.make_catalog(
+            tmp_path / 'catalog.yaml',
+            standin,
+            remote_paths,
+            str(tmp_path / 'local'),
+        )
+        record = Catalog(catalog_file, verbose=0).smos_cci
+        coverage = record.discover_coverage(slice('2012-01-01', None))
+        first = record.download_data(dates)
+        nevents = len(record.metrics)
+
+        # a new session knows the coverage and the gap
+        record = Catalog(catalog_file, verbose=0).smos_cci
+        second = record.download_data(dates)
+        nprobed = len(record.metrics)
+
+        os.rename(tmp_path / 'gap.nc', tmp_path / 'remote' / gap)
+        record.missing.clear()
+        third = record.download_data(dates)
+
+    assert pd.Timestamp(coverage['start']) == dates[2]
+    assert pd.Timestamp(coverage['end']) == dates[6]
+    assert len(first['downloaded']) == 4
+    assert len(first['remote_not_exist']) == 6
+    # only the gap is probed, dates outside of the coverage are skipped
+    assert nevents == 5
+    assert len(second['remote_not_exist']) == 6
+    assert len(second['local_exists']) == 4
+    assert nprobed == 4
+    assert len(third['downloaded']) == 1
+    assert len(record.missing) == 0
+
+
+@pytest.mark.parametrize('index', [True, False])
+def test_http_directory_index(tmp_path, index):
+    from benchmarks import servers
+
+    dates = pd.date_range('2012-01-01', periods=6, freq='1D')
+    records = {'smos_cci': servers.template_records()['smos_cci']}
+    remote_paths = servers.make_synthetic_tree(
+        tmp_path / 'remote', dates[:4], size=2 ** 12, records=records
+    )
+    # the version in the file name is a wildcard
+    wildcard = {'smos_cci': remote_paths['smos_cci'].replace('fv1.8', 'fv*')}
+    standin = servers.HTTPStandIn(tmp_path / 'remote', index=index)
+    with standin:
+        catalog_file = servers.make_catalog(
+            tmp_path / 'catalog.yaml',
+            standin,
+            wildcard if index else remote_paths,
+            str(tmp_path / 'local'),
+        )
+        record = Catalog(catalog_file, verbose=0).smos_cci
+        results = record.download_data(dates)
+
+    files = [p for p in standin.paths if p.endswith('.nc')]
+    assert len(results['downloaded']) == 4
+    assert len(results['remote_not_exist']) == 2
+    if index:
+        # one index page, no requests for missing files
+        assert len(standin.paths) == 5
+        assert len(files) == 4
+    else:
+        assert len(files) == 6
+
+
+def test_parse_http_index_page():
+    from databrewery.download import parse_index_page
+
+    apache = (
+        '<tr><td><a href="?C=N;O=D">Name</a></td></tr>'
+        '<tr><td><a href="/data/">Parent Directory</a></td></tr>'
+        '<tr><td><a href="sst_20200102.nc">sst_20200102.nc</a></td>'
+        '<td align="right">2020-01-03 10:30  </td>'
+        '<td align="right">1.2M</td></tr>'
+        '<tr><td><a href="2021/">2021/</a></td>'
+        '<td align="right">2021-01-01 00:00  </td><td>-</td></tr>'
+    )
+    listing = parse_index_page(apache, '/data/sst')
+    assert sorted(listing) == ['/data/sst/2021', '/data/sst/sst_20200102.nc']
+    entry = listing['/data/sst/sst_20200102.nc']
+    assert entry['type'] == 'file'
+    assert entry['size'] is None  # rounded
+    assert entry['modify'] == pd.Timestamp('2020-01-03 10:30').timestamp()
+
+    nginx = (
+        '<pre><a href="../">../</a>\n'
+        '<a href="sst%2001.nc">sst 01.nc</a>   03-Jan-2020 10:30   1048576\n'
+        '</pre>'
+    )
+    entry = parse_index_page(nginx, '/data/sst')['/data/sst/sst 01.nc']
+    assert entry['size'] == 1048576
+
+    thredds = (
+        "<tr><td><a href='catalog.html?dataset=sst/sst_20200102.nc'>"
+        '<tt>sst_20200102.nc</tt></a></td><td><tt>780 bytes</tt></td>'
+        '<td><tt>2020-01-03T10:30:00Z</tt></td></tr>'
+    )
+    listing = parse_index_page(
+        thredds, '/thredds/fileServer/sst', '/thredds/catalog/sst/'
+    )
+    entry = listing['/thredds/fileServer/sst/sst_20200102.nc']
+    assert entry['size'] == 780
+
+
+@pytest.mark.parametrize('scheme', ['http', 'ftp'])
+def test_download_buffered_copy(tmp_path, scheme):
+    import filecmp
+    from benchmarks import servers
+
+    dates = pd.date_range('2012-01-01', periods=2, freq='1D')
+    records = {'smos_cci': servers.template_records()['smos_cci']}
+    remote_paths = servers.make_synthetic_tree(
+        tmp_path / 'remote', dates, size=2 ** 16, records=records
+    )
+    with servers.STANDINS[scheme](tmp_path / 'remote') as standin:
+        catalog_file = servers.make_catalog(
+            tmp_path / 'catalog.yaml',
+            standin,
+            remote_paths,
+            str(tmp_path / 'local'),
+        )
+        record = Catalog(catalog_file, verbose=0).smos_cci
+        # many reads into the same small buffer, with progress bars
+        record.config.remote.buffer_size = 1000
+        record.verbose = 2
+        results = record.download_data(dates)
+
+    assert len(results['downloaded']) == 2
+    for local in results['downloaded']:
+        name = os.path.basename(local)
+        remote = list((tmp_path / 'remote').rglob(name))[0]
+        assert filecmp.cmp(local, remote, shallow=False)
+
+
+@pytest.mark.parametrize('verbose', [0, 2])
+@pytest.mark.parametrize('scheme', ['http', 'ftp'])
+def test_download_segmented(tmp_path, scheme, verbose):
+    import filecmp
+    from benchmarks import servers
+
+    dates = pd.date_range('2012-01-01', periods=2, freq='1D')
+    records = {'smos_cci': servers.template_records()['smos_cci']}
+    remote_paths = servers.make_synthetic_tree(
+        tmp_path / 'remote', dates, size=2 ** 16 + 1, records=records
+    )
+    with servers.STANDINS[scheme](tmp_path / 'remote') as standin:
+        catalog_file = servers.make_catalog(
+            tmp_path / 'catalog.yaml',
+            standin,
+            remote_paths,
+            str(tmp_path / 'local'),
+        )
+        record = Catalog(catalog_file, verbose=0).smos_cci
+        # three ranges per file, read through a small buffer
+        record.config.remote.segments = 3
+        record.config.remote.segment_size = 2 ** 14
+        record.config.remote.buffer_size = 1000
+        record.verbose = verbose
+        results = record.download_data(dates)
+
+    if scheme == 'http':
+        assert len(standin.ranges_requested) == 6
+    else:
+        assert standin.commands.count('REST') == 6
+    assert len(results['downloaded']) == 2
+    for local in results['downloaded']:
+        name = os.path.basename(local)
+        remote = list((tmp_path / 'remote').rglob(name))[0]
+        assert filecmp.cmp(local, remote, shallow=False)
+        assert not os.path.exists(f'{local}.brew-part')
+
+
+def test_download_segmented_ranges_ignored(synthetic):
+    import filecmp
+    from benchmarks import servers
+
+    dates = pd.date_range('2012-01-01', periods=2, freq='1D')
+    remote = synthetic.make_tree(dates, size=2 ** 16 + 1)
+    with servers.HTTPStandIn(remote, ranges=False) as standin:
+        catalog_file = synthetic.make_catalog(
+            standin, remote=dict(segments=3, segment_size=2 ** 14)
+        )
+        record = Catalog(catalog_file, verbose=0).smos_cci
+        results = record.download_data(dates)
+
+    # the files are downloaded in one stream without retrying
+    events = record.metrics.to_dataframe()
+    assert len(results['downloaded']) == 2
+    assert events['retries'].sum() == 0
+    assert (events['status_code'] == 200).all()
+    for local in results['downloaded']:
+        name = os.path.basename(local)
+        assert filecmp.cmp(local, list(remote.rglob(name))[0], shallow=False)
+        assert not os.path.exists(f'{local}.brew-part')
+
+
+def test_lease_stale_recovery(tmp_path, monkeypatch):
+    import json
+    import time
+    from databrewery.lease import Lease, LeaseTimeout, pid_alive
+
+    local = str(tmp_path / 'file.nc')
+    lease = Lease(local, ttl=30, poll=0.01)
+    other = Lease(local, ttl=30, poll=0.01)
+    assert lease.try_acquire()
+    assert not other.try_acquire()
+    with pytest.raises(LeaseTimeout):
+        other.acquire(timeout=0.05)
+    lease.release()
+    assert not os.path.exists(lease.path)
+
+    # the holder process is gone
+    holder = dict(other.holder, pid=2 ** 22 + 1)
+    with open(lease.path, 'w') as file:
+        json.dump(holder, file)
+    other.acquire(timeout=1)
+    assert other.waited and (other.read_holder() == other.holder)
+    other.release()
+
+    # the lease was not renewed (e.g. the host crashed)
+    with open(lease.path, 'w') as file:
+        json.dump(dict(holder, host='elsewhere'), file)
+    os.utime(lease.path, (time.time() - 60, time.time() - 60))
+    lease.acquire(timeout=1)
+    assert lease.held
+    lease.release()
+    assert not list(tmp_path.iterdir())
+
+    # signal 0 is CTRL_C_EVENT on Windows: only the ttl breaks leases there
+    assert not pid_alive(2 ** 22 + 1)
+    monkeypatch.setattr(os, 'name', 'nt')
+    assert pid_alive(2 ** 22 + 1)
+    monkeypatch.undo()
+
+
+def test_download_leases_deduplicate(tmp_path, synthetic):
+    import threading
+    from benchmarks import servers
+
+    dates = pd.date_range('2012-01-01', periods=4, freq='1D')
+    remote = synthetic.make_tree(dates, size=2 ** 16)
+    with servers.HTTPStandIn(remote, bandwidth=2 ** 20) as standin:
+        catalog_file = synthetic.make_catalog(standin)
+        # two jobs on the same local_store at the same time
+        jobs = [Catalog(catalog_file, verbose=0).smos_cci for _ in range(2)]
+        barrier = threading.Barrier(len(jobs))
+
+        def run(record):
+            barrier.wait()
+            return record.download_data(dates)
+
+        threads = [
+            threading.Thread(target=run, args=(r,), daemon=True)
+            for r in jobs
+        ]
+        [thread.start() for thread in threads]
+        [thread.join() for thread in threads]
+
+    # every file was fetched once and the other job used it
+    files = [p for p in standin.paths if p.endswith('.nc')]
+    assert len(files) == len(dates)
+    downloaded = sum(len(r.download_results['downloaded']) for r in jobs)
+    exists = sum(len(r.download_results['local_exists']) for r in jobs)
+    assert (downloaded, exists) == (4, 4)
+    assert not list((tmp_path / 'local').rglob('*.brew-*'))
+
+
+def test_work_queue_claims(tmp_path, monkeypatch):
+    import time
+    from databrewery import workqueue
+
+    monkeypatch.setattr(workqueue, 'MAX_CLAIMS', 2)
+    record = Catalog('./catalog_template.yaml', verbose=0).smos_cci
+    queue = workqueue.WorkQueue(tmp_path / 'queue.db', batch_size=2, ttl=0.5)
+    pairs = [(f'http://host/{i}.nc', f'/data/{i}.nc') for i in range(3)]
+    assert queue.put(record, pairs) == 3
+
+    first = queue.claim('a')
+    assert first['pairs'] == pairs[:2]
+    second = queue.claim('b')
+    assert second['pairs'] == pairs[2:]
+    assert queue.claim('c') is None
+    queue.report(second['batch'], {'downloaded': ['/data/2.nc']})
+
+    # the worker died: its batch is free once the claim expired
+    time.sleep(0.6)
+    assert queue.claim('c')['batch'] == first['batch']
+    # claimed MAX_CLAIMS times without a report
+    time.sleep(0.6)
+    assert queue.claim('d') is None
+    results = queue.results(record.name)
+    assert results['downloaded'] == ['/data/2.nc']
+    assert sorted(results['failed']) == ['/data/0.nc', '/data/1.nc']
+    assert queue.counts() == dict(pending=0, claimed=0, done=3)
+
+    # no worker runs: the files fail once nothing moved for the ttl
+    more = [(f'http://host/{i}.nc', f'/data/{i}.nc') for i in range(3, 5)]
+    queue.put(record, more)
+    t0 = time.time()
+    results = queue.wait(record.name, [local for r, local in more], poll=0.05)
+    assert 0.5 <= time.time() - t0 < 5
+    assert sorted(results['failed']) == ['/data/3.nc', '/data/4.nc']
+    queue.put(record, more)
+    queue.claim('e')
+    results = queue.wait(record.name, ['/data/3.nc'], timeout=0.1, poll=0.05)
+    assert results['failed'] == ['/data/3.nc']
+    assert queue.counts()['claimed'] == 1
+
+
+def test_download_work_queue(tmp_path, synthetic):
+    import subprocess
+    import sys
+    import sqlite3
+    import databrewery
+    from benchmarks import servers
+    from databrewery.workqueue import WorkQueue
+
+    dates = pd.date_range('2012-01-01', periods=12, freq='1D')
+    remote = synthetic.make_tree(dates, size=2 ** 16)
+    queue = WorkQueue(tmp_path / 'queue.db', batch_size=1)
+    root = os.path.dirname(os.path.dirname(databrewery.__file__))
+    env = dict(os.environ, PYTHONPATH=root)
+    command = [sys.executable, '-m', 'databrewery.cli', 'work', queue.path]
+    with servers.HTTPStandIn(remote, bandwidth=2 ** 18) as standin:
+        catalog_file = synthetic.make_catalog(standin)
+        # the workers wait for the coordinator
+        workers = [
+            subprocess.Popen(command + ['--wait', '60'], env=env, cwd=root)
+            for _ in range(3)
+        ]
+        record = Catalog(catalog_file, verbose=0).smos_cci
+        results = record.download_data(dates, queue=queue)
+        assert [worker.wait(timeout=60) for worker in workers] == [0, 0, 0]
+
+    assert sorted(results['downloaded']) == sorted(
+        str(p) for p in (tmp_path / 'local').rglob('*.nc')
+    )
+    assert len(results['downloaded']) == len(dates)
+    files = [p for p in standin.paths if p.endswith('.nc')]
+    assert len(files) == len(dates)
+    db = sqlite3.connect(queue.path)
+    nworkers = db.execute('SELECT COUNT(DISTINCT worker) FROM files')
+    assert nworkers.fetchone()[0] > 1
+    db.close()
+
+
+def test_serve_read_through_cache(tmp_path, synthetic):
+    import filecmp
+    import threading
+    import requests
+    from benchmarks import servers
+    from databrewery.serve import CacheServer
+
+    dates = pd.date_range('2012-01-01', periods=6, freq='1D')
+    remote = synthetic.make_tree(dates, size=2 ** 16)
+    standin = servers.HTTPStandIn(remote, bandwidth=2 ** 20)
+    with standin:
+        catalog_file = synthetic.make_catalog(standin, local='cache')
+        server = CacheServer(Catalog(catalog_file), ('localhost', 0))
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        cache = f'http://localhost:{server.server_address[1]}'
+
+        # two nodes with their own local_store point at the cache
+        nodes = []
+        for node in ['a', 'b']:
+            node_file = synthetic.make_catalog(
+                standin, node, name=f'{node}.yaml', remote=dict(cache=cache)
+            )
+            nodes += (Catalog(node_file, verbose=0).smos_cci,)
+
+        barrier = threading.Barrier(len(nodes))
+        results = {}
+
+        def run(record):
+            barrier.wait()
+            results[record.catalog_file] = record.download_data(dates, 2)
+
+        threads = [threading.Thread(target=run, args=(r,)) for r in nodes]
+        [thread.start() for thread in threads]
+        [thread.join() for thread in threads]
+
+        missing = nodes[0].download_data(pd.Timestamp('2013-01-01'))
+        assert len(missing['remote_not_exist']) == 1
+
+        name = sorted(os.listdir(tmp_path / 'cache' / 'smos_cci'))[0]
+        url = f'{cache}/records/smos_cci/{name}'
+        req = requests.get(url, headers={'Range': 'bytes=100-199'})
+        with open(tmp_path / 'cache' / 'smos_cci' / name, 'rb') as file:
+            data = file.read()
+        assert (req.status_code, req.content) == (206, data[100:200])
+        outside = requests.get(f'{cache}/records/smos_cci/../x')
+        assert outside.status_code == 404
+        server.shutdown()
+        server.server_close()
+
+    # each file came from the remote once
+    files = [p for p in standin.paths if p.endswith('.nc')]
+    assert len(files) == len(dates)
+    assert len(results) == len(nodes)
+    for out in results.values():
+        assert len(out['downloaded']) == len(dates)
+    for name in os.listdir(tmp_path / 'cache' / 'smos_cci'):
+        for node in ['a', 'b']:
+            local = tmp_path / node / 'smos_cci' / name
+            assert filecmp.cmp(tmp_path / 'cache' / 'smos_cci' / name, local)
+
+
+def test_storage_quota_eviction(synthetic):
+    from benchmarks import servers
+    from databrewery.storage import parse_size
+
+    assert parse_size('1.5 KiB') == 1536
+    assert parse_size(10) == 10
+    with pytest.raises(ValueError):
+        parse_size('10 parsecs')
+
+    dates = pd.date_range('2012-01-01', periods=6, freq='1D')
+    remote = synthetic.make_tree(dates)
+    with servers.HTTPStandIn(remote) as standin:
+        pinned = [[str(dates[2].date()), str(dates[2].date())]]
+        storage = dict(quota='1 GB', pinned=pinned)
+        catalog_file = synthetic.make_catalog(standin, storage=storage)
+        record = Catalog(catalog_file, verbose=0).smos_cci
+        record.download_data(dates[:4])
+        size = record.storage.usage() // 4
+        record.storage.quota = int(4.5 * size)
+        record.local_files(dates[0], auto_download=True)
+        record.local_files(dates[1], auto_download=True)
+        record.local_files(dates[1], auto_download=True)
+        # the accesses are saved in batches, at the latest before evicting
+        assert len(record.storage.access) == 0
+
+        # dates[2] is pinned, dates[:2] were used and dates[3] was not
+        local = record.config.local_store
+        assert record.storage.policy == 'lru'
+        record.download_data(dates[4:5])
+        assert len(record.storage.access) == 2
+        exists = [os.path.isfile(local[date]) for date in dates]
+        assert exists == [True, True, True, False, True, False]
+
+        # dates[0] was used before dates[1] (and dates[4] was downloaded)
+        record.download_data(dates[5:])
+        exists = [os.path.isfile(local[date]) for date in dates]
+        assert exists == [False, True, True, False, True, True]
+        assert record.storage.usage() <= record.storage.quota
+
+        # lfu: dates[1] was used twice
+        record.storage.policy = 'lfu'
+        order = [local for local, size in record.storage.candidates()]
+        assert order[-1] == local[dates[1]]
+
+        # the remote size of a new file counts (four times the local ones)
+        new = pd.date_range('2012-01-07', periods=1)
+        synthetic.make_tree(new, size=2 ** 16)
+        pairs, skipped = record._date_path_pairs(new)
+        removed = record.storage.reserve(record, pairs)
+        assert sorted(removed) == [local[dates[i]] for i in (1, 4, 5)]
+
+        # a catalog sync makes room before downloading too
+        record.download_data(dates[[0, 1, 3]])
+        catalog = Catalog(catalog_file, verbose=0)
+        catalog.smos_cci.storage.quota = record.storage.quota
+        results = catalog.sync(dates[4:6])['smos_cci']
+        assert len(results['downloaded']) == 2
+        assert catalog.smos_cci.storage.usage() <= record.storage.quota
+
+
+def test_local_files_prefetch(tmp_path, synthetic):
+    from benchmarks import servers
+
+    dates = pd.date_range('2012-01-01', periods=10, freq='1D')
+    remote = synthetic.make_tree(dates)
+    with servers.HTTPStandIn(remote, latency=0.02) as standin:
+        catalog_file = synthetic.make_catalog(standin)
+        record = Catalog(catalog_file, verbose=0).smos_cci
+        local = record.config.local_store
+
+        # two days ahead of each call
+        for date in dates[:4]:
+            files = record.local_files(date, auto_download=True, prefetch=2)
+            assert files == [local[date]]
+            record._prefetcher.wait(timeout=30)
+        record.stop_prefetch()
+        exists = [os.path.isfile(local[date]) for date in dates]
+        assert exists == [True] * 6 + [False] * 4
+        assert len(record._prefetcher.fetched) == 5
+
+        # auto starts after three calls for consecutive days
+        for i in range(6, 9):
+            record.local_files(dates[i], auto_download=True, prefetch='auto')
+            record._prefetcher.wait(timeout=30)
+            assert os.path.isfile(local[dates[9]]) == (i == 8)
+        record.stop_prefetch()
+
+    # each file was downloaded once, without leftover temporary files
+    files = [p for p in standin.paths if p.endswith('.nc')]
+    assert len(files) == len(set(files)) == 10
+    leftovers = (tmp_path / 'local').rglob('*.brew-*')
+    assert list(leftovers) == []
+
+
+def test_local_files_prefetch_connection(synthetic):
+    from benchmarks import servers
+
+    dates = pd.date_range('2012-01-01', periods=5, freq='1D')
+    remote = synthetic.make_tree(dates)
+    with servers.FTPStandIn(remote) as standin:
+        catalog_file = synthetic.make_catalog(standin)
+        record = Catalog(catalog_file, verbose=0).smos_cci
+        record.local_files(dates[0], auto_download=True, prefetch=4)
+        record._prefetcher.wait(timeout=30)
+        record.stop_prefetch()
+
+    local = record.config.local_store
+    assert all(os.path.isfile(local[date]) for date in dates)
+    # one login for the request and one for the background thread
+    assert standin.commands.count('USER') == 2
+    assert len(record.metrics) == 5
+
+
+def test_pipeline_stream(tmp_path, synthetic):
+    import xarray as xr
+    from benchmarks import servers
+
+    dates = pd.date_range('2012-01-01', periods=6, freq='1D')
+    remote = synthetic.make_tree(dates)
+    with servers.HTTPStandIn(remote, latency=0.02) as standin:
+        data_path = str(tmp_path / 'processed' / 'smos_{t:%Y%m%d}.nc')
+        functions = ['databrewery.preprocess.rename_to_latlon']
+        pipelines = {'daily': dict(data_path=data_path, functions=functions)}
+        catalog_file = synthetic.make_catalog(standin, pipelines=pipelines)
+        record = Catalog(catalog_file, verbose=0).smos_cci
+        record.download_data(dates[:1])
+        processed = record.daily.stream(
+            dates, workers=2, njobs=2, evict=True, profile=True
+        )
+
+    assert processed == [data_path.format(t=date) for date in dates]
+    for file in processed:
+        with xr.open_dataset(file) as xds:
+            assert 'brew_profile' in xds.attrs
+    assert len(record.daily.profile) == 12
+
+    # raw files are removed once processed, the first was there already
+    local = record.config.local_store
+    assert not any(os.path.isfile(local[date]) for date in dates)
+    files = [p for p in standin.paths if p.endswith('.nc')]
+    assert len(files) == len(set(files)) == 6
+    assert list((tmp_path / 'processed').glob('*.brew-*')) == []
+
+
+@pytest.mark.parametrize('segments', [1, 3])
+def test_download_s3(tmp_path, synthetic, segments):
+    import filecmp
+    from benchmarks import servers
+
+    pytest.importorskip('boto3')
+    pytest.importorskip('moto.server')
+    dates = pd.date_range('2012-01-01', periods=5, freq='1D')
+    remote = synthetic.make_tree(dates[:4], size=2 ** 16 + 1)
+    with servers.S3StandIn(remote) as standin:
+        catalog_file = synthetic.make_catalog(standin)
+        record = Catalog(catalog_file, verbose=0).smos_cci
+        # listings of several pages and objects in several ranges
+        record.config.remote.page_size = 3
+        record.config.remote.segments = segments
+        record.config.remote.segment_size = 2 ** 14
+        results = record.download_data(dates, njobs=2)
+
+        # the four objects of the year come in two pages
+        path = synthetic.remote_paths['smos_cci'].format(t=dates[0])
+        listing = record._initiate_connection().listdir(os.path.dirname(path))
+
+    assert len(listing) == 4
+    assert len(results['downloaded']) == 4
+    events = record.metrics.to_dataframe()
+    codes = events.loc[events['status'] == 'downloaded', 'status_code']
+    assert (codes == (206 if segments > 1 else 200)).all()
+    assert len(results['remote_not_exist']) == 1
+    for local in results['downloaded']:
+        name = os.path.basename(local)
+        remote = list((tmp_path / 'remote').rglob(name))[0]
+        assert filecmp.cmp(local, remote, shallow=False)
+
+
+def test_download_from_mirrors(synthetic):
+    import time
+    from benchmarks import servers
+    from databrewery.routing import Mirror, MirrorSet
+    from databrewery.utils import URL
+
+    dates = pd.date_range('2012-01-01', periods=6, freq='1D')
+    # the url only has the first half of the files
+    mirror_root = synthetic.make_tree(dates[:5], size=2 ** 12, root='mirror')
+    primary_root = synthetic.make_tree(
+        dates[:3], size=2 ** 12, root='primary'
+    )
+    primary = servers.HTTPStandIn(primary_root)
+    mirror = servers.FTPStandIn(mirror_root)
+    dead = servers.HTTPStandIn(mirror_root)
+    with primary, mirror:
+        with dead:
+            pass
+        catalog_file = synthetic.make_catalog(primary, mirrors=[dead, mirror])
+        record = Catalog(catalog_file, verbose=0).smos_cci
+        record.config.remote.retries = 0
+        assert len(record.mirrors) == 3
+        results = record.download_data(dates)
+
+        # a mirror that refuses the login is down, not an error
+        url, login = record.mirrors[2].url, record.mirrors[2].login
+        refused = Mirror(url, {**login, 'password': 'wrong'})
+        assert not MirrorSet(record, [refused]).probe(refused)
+        # another directory on the same server is another mirror
+        assert Mirror(URL(f'{url}.gz'), login) != record.mirrors[2]
+
+    # missing files fail over to the mirror, the dead mirror is skipped
+    assert len(results['downloaded']) == 5
+    assert len(results['remote_not_exist']) == 1
+    stats = MirrorSet(record).stats
+    assert stats(record.mirrors[1])['down'] is not None
+    assert stats(record.mirrors[2])['throughput'] > 0
+
+    # a batch is spread over mirrors of the same speed
+    synthetic.make_tree(dates[:5], size=2 ** 12, root='primary')
+    for file in results['downloaded']:
+        os.remove(file)
+    primary = servers.HTTPStandIn(primary_root)
+    mirror = servers.HTTPStandIn(mirror_root)
+    with primary, mirror:
+        catalog_file = synthetic.make_catalog(primary, mirrors=[mirror])
+        record = Catalog(catalog_file, verbose=0).smos_cci
+        mirrors = MirrorSet(record)
+        for m in record.mirrors:
+            stats = dict(latency=0.01, throughput=1e6, checked=time.time())
+            mirrors._save(m, **stats)
+        results = record.download_data(dates[:4], njobs=2)
+
+    assert len(results['downloaded']) == 4
+    for standin in [primary, mirror]:
+        files = [p for p in standin.paths if p.endswith('.nc')]
+        assert len(files) == 2
+
+    # a catalog sync also fails over to the mirror
+    primary_root = synthetic.make_tree(dates[:2], size=2 ** 12, root='few')
+    primary = servers.HTTPStandIn(primary_root)
+    mirror = servers.HTTPStandIn(mirror_root)
+    with primary, mirror:
+        catalog_file = synthetic.make_catalog(
+            primary, local='synced', mirrors=[mirror], name='sync.yaml'
+        )
+        catalog = Catalog(catalog_file, verbose=0)
+        results = catalog.sync(dates[:4], per_host=2)['smos_cci']
+
+    assert len(results['downloaded']) == 4
+    files = [p for p in mirror.paths if p.endswith('.nc')]
+    assert len(files) >= 2
+
+
+@pytest.mark.parametrize(
+    'channels, legacy', [(1, False), (3, False), (3, True)]
+)
+def test_download_sftp_pipelined(tmp_path, monkeypatch, channels, legacy):
+    import filecmp
+    import paramiko
+    from benchmarks import servers
+    from databrewery import download
+
+    if legacy:
+        # seek and write as on Windows, readv of paramiko < 3.3
+        monkeypatch.delattr(os, 'pwrite')
+        readv = paramiko.SFTPFile.readv
+
+        def legacy_readv(self, chunks):
+            return readv(self, chunks)
+
+        monkeypatch.setattr(paramiko.SFTPFile, 'readv', legacy_readv)
+    # segments of 16 KiB so that the small files are split
+    monkeypatch.setattr(download, 'SFTP_MIN_SEGMENT', 2 ** 14)
+    dates = pd.date_range('2012-01-01', periods=2, freq='1D')
+    records = {'smos_cci': servers.template_records()['smos_cci']}
+    remote_paths = servers.make_synthetic_tree(
+        tmp_path / 'remote', dates, size=2 ** 16, records=records
+    )
+    with servers.SFTPStandIn(tmp_path / 'remote') as standin:
+        catalog_file = servers.make_catalog(
+            tmp_path / 'catalog.yaml',
+            standin,
+            remote_paths,
+            str(tmp_path / 'local'),
+        )
+        record = Catalog(catalog_file, verbose=0).smos_cci
+        record.config.remote.request_size = 4096
+        record.config.remote.max_requests = 8
+        record.config.remote.channels = channels
+        downloader = record._initiate_connection()
+        assert len(downloader.channels) == channels
+        assert downloader._readv_limit != legacy
+        downloader.close_connection()
+        results = record.download_data(dates)
+
+    assert len(results['downloaded']) == 2
+    for local in results['downloaded']:
+        name = os.path.basename(local)
+        remote = list((tmp_path / 'remote').rglob(name))[0]
+        assert filecmp.cmp(local, remote, shallow=False)
+
+
+def test_parse_ftp_list_line():
+    import time
+    from databrewery.download import parse_list_line, parse_mlsd_time
+
+    now = time.strptime('2020-03-01 12:00', '%Y-%m-%d %H:%M')
+    unix = '-rw-r--r--   1 ftp  ftp   1048576 Jan 02 10:30 a 1.nc'
+    entry = parse_list_line(unix, now=now)
+    assert entry['name'] == 'a 1.nc'
+    assert entry['size'] == 1048576
+    assert entry['modify'] == parse_mlsd_time('20200102103000')
+
+    # no year in the listing and in the future: last year
+    entry = parse_list_line(unix.replace('Jan 02', 'Dec 24'), now=now)
+    assert time.gmtime(entry['modify']).tm_year == 2019
+
+    old = 'drwxr-xr-x   2 ftp  ftp      4096 Jul 14  2011 2011'
+    assert parse_list_line(old, now=now)['type'] == 'dir'
+
+    link = 'lrwxrwxrwx   1 ftp  ftp        12 Jul 14  2011 latest -> 2011'
+    assert parse_list_line(link, now=now)['name'] == 'latest'
+
+    dos = '07-14-11  03:05PM               2048 file.nc'
+    entry = parse_list_line(dos)
+    assert entry['size'] == 2048
+    assert entry['modify'] == parse_mlsd_time('20110714150500')
+    assert parse_list_line('total 24') is None
+
+
+def test_pipeline_profile(tmp_path):
+    import json
+    import numpy as np
+    import xarray as xr
+    from databrewery import preprocess as prep
+    from databrewery.metrics import PipelineProfile
+
+    fname = str(tmp_path / 'raw.nc')
+    xr.Dataset(
+        {'sst': (('time', 'latitude', 'longitude'), np.ones((2, 4, 8)))},
+        coords={
+            'time': pd.date_range('2012-01-01', periods=2),
+            'latitude': np.linspace(-60, 60, 4),
+            'longitude': np.arange(0, 360, 45.0),
+        },
+    ).to_netcdf(fname)
+
+    profile = PipelineProfile()
+    pipe = [xr.open_dataset, prep.rename_to_latlon, prep.center_coords_at_0]
+    xds = prep.apply_process_pipeline(
+        fname, pipe, profile=profile, profile_attr='brew_profile'
+    )
+
+    stages = json.loads(xds.attrs['brew_profile'].split('] ')[-1])
+    assert [s['function'] for s in stages] == [f.__name__ for f in pipe]
+    assert stages[0]['file'] == fname
+
+    summary = profile.summary()
+    assert list(summary.calls) == [1, 1, 1]
+    assert summary.wall_fraction.sum() == pytest.approx(1)
+
+
+def test_download_cds_concurrent_and_resume(tmp_path, monkeypatch):
+    import yaml
+    from benchmarks import servers
+    from databrewery.utils import make_date_path_pairs
+
+    pytest.importorskip('cdsapi')
+    standin = servers.CDSStandIn(tmp_path / 'cds', queue_time=0.3)
+    monkeypatch.setenv('CDSAPI_URL', standin.url)
+    monkeypatch.setenv('CDSAPI_KEY', standin.key)
+
+    catalog_file = tmp_path / 'catalog.yaml'
+    yaml.safe_dump(
+        {
+            'era5': {
+                'description': 'ERA5 hourly data on single levels, monthly',
+                'doi': 'https://doi.org/10.24381/cds.adbb2d47',
+                'variables': ['wind'],
+                'remote': {
+                    'url': 'cds://reanalysis-era5-single-levels/{t:%Y-%m}',
+                    'max_in_flight': 3,
+                    'poll_interval': 0.2,
+                    # one month (3 variables x 24 hours x 31 days) per request
+                    'max_fields': 2300,
+                },
+                'local_store': str(tmp_path / 'era5_{t:%Y%m}.nc'),
+            }
+        },
+        open(catalog_file, 'w'),
+    )
+    dates = slice('2012-01', '2012-06', '1MS')
+
+    with standin:
+        record = Catalog(catalog_file, verbose=0).era5
+        # a job that was stopped after submitting two requests
+        pairs = make_date_path_pairs(
+            dates, record.config.remote.url, record.config.local_store
+        )
+        downloader = record._initiate_connection()
+        plan = downloader.plan([remote for remote, local in pairs])
+        assert len(plan) == 6
+        for (remote, local), item in zip(pairs[:2], plan):
+            path = downloader._part_path(local, item['request'])
+            downloader._submit(path, item['request'])
+
+        results = record.download_data(dates)
+
+    assert len(results['downloaded']) == 6
+    assert standin.submitted == 6
+    assert standin.max_active <= 3
+    assert not list(tmp_path.glob('.cds-part-*'))
+    xr = pytest.importorskip('xarray')
+    xds = xr.open_dataset(tmp_path / 'era5_201202.nc')
+    assert xds.time.size == 29 * 24
+    assert '10m_u_component_of_wind' in xds
+
+
+def test_download_cds_failed_requests(tmp_path, monkeypatch):
+    import yaml
+    from benchmarks import servers
+    from databrewery import retry
+
+    pytest.importorskip('cdsapi')
+    monkeypatch.setattr(retry, '_breakers', {})
+    # the request of March fails on the CDS, polls fail now and then
+    standin = servers.CDSStandIn(
+        tmp_path / 'cds',
+        queue_time=0.1,
+        fail_requests=[dict(month=['03'])],
+        fault_rate=0.2,
+        seed=1,
+    )
+    monkeypatch.setenv('CDSAPI_URL', standin.url)
+    monkeypatch.setenv('CDSAPI_KEY', standin.key)
+
+    catalog_file = tmp_path / 'catalog.yaml'
+    yaml.safe_dump(
+        {
+            'era5': {
+                'description': 'ERA5 hourly data on single levels, monthly',
+                'doi': 'https://doi.org/10.24381/cds.adbb2d47',
+                'variables': ['wind'],
+                'remote': {
+                    'url': 'cds://reanalysis-era5-single-levels/{t:%Y-%m}',
+                    'poll_interval': 0.2,
+                    'max_fields': 2300,
+                    'retries': 5,
+                    'retry_backoff': 0.01,
+                },
+                'local_store': str(tmp_path / 'era5_{t:%Y%m}.nc'),
+            }
+        },
+        open(catalog_file, 'w'),
+    )
+
+    with standin:
+        record = Catalog(catalog_file, verbose=0).era5
+        with pytest.warns(UserWarning, match='CDS request failed'):
+            results = record.download_data(slice('2012-01', '2012-04', '1MS'))
+
+    assert len(results['downloaded']) == 3
+    assert results['failed'] == [str(tmp_path / 'era5_201203.nc')]
+    assert results['remote_not_exist'] == []
+    # a failed request is not a missing file
+    assert len(record.missing) == 0
+    events = record.metrics.to_dataframe()
+    assert (events['status'] == 'failed').sum() == 1
+
+
+def test_state_store_merge(state_dir):
+    import json
+    from databrewery.state import JSONStore
+
+    # two processes that loaded the store before either wrote to it
+    first, second = JSONStore('requests.json'), JSONStore('requests.json')
+    first['a'] = 1
+    second['b'] = 2
+    second.pop('c')
+    first.discard(['a'])
+    first['d'] = 4
+
+    with open(state_dir / 'requests.json') as file:
+        assert json.load(file) == {'b': 2, 'd': 4}
+
+
+def test_plan_cds_requests():
+    from databrewery.download import plan_cds_requests
+
+    months = pd.date_range('2011-11', '2012-03', freq='MS')
+    variables = ['u10', 'v10', 'msl', 'sst']
+    base = {'time': ['00:00', '12:00']}
+
+    # small requests are batched per year
+    plan = plan_cds_requests(months, variables, base)
+    assert [p['request']['year'] for p in plan] == ['2011', '2012']
+    assert plan[1]['request']['month'] == ['01', '02', '03']
+    assert plan[1]['request']['variable'] == variables
+
+    # variables are split in even groups when a month is too large
+    plan = plan_cds_requests(months[:1], variables, base, max_fields=130)
+    assert [p['request']['variable'] for p in plan] == [
+        ['u10', 'v10'],
+        ['msl', 'sst'],
+    ]
+
+    # days are split when a single variable is too large for a month
+    plan = plan_cds_requests(months[:1], variables[:1], base, max_fields=40)
+    assert [len(p['request']['day']) for p in plan] == [20, 11]